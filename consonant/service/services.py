@@ -62,6 +62,10 @@ class Service(object):  # pragma: no cover
         """Return the object with the given UUID in the given commit."""
         raise NotImplementedError
 
+    def objects_by_uuid(self, commit, uuids):
+        """Return a UUID to object dict for a number of objects in a commit."""
+        raise NotImplementedError
+
     def raw_property_data(self, commit, object, property):
         """Return raw data for an object property in a given commit."""
         raise NotImplementedError
@@ -70,6 +74,10 @@ class Service(object):  # pragma: no cover
         """Resolve an object reference into an object and return it."""
         raise NotImplementedError
 
+    def resolve_references(self, references):
+        """Resolve object references into objects and return them."""
+        raise NotImplementedError
+
     def create_ref(self, type, commit, author, committer, message):
         """Create a new Git ref in the store."""
         raise NotImplementedError
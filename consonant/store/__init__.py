@@ -19,6 +19,7 @@
 
 
 import caches
+import expanders
 import git
 import objects
 import properties
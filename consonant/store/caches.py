@@ -18,7 +18,15 @@
 """Caching mechanisms for improving object and raw property loading."""
 
 
+import collections
+import marshal
+import os
 import pylibmc
+import re
+import sqlite3
+import threading
+import time
+import zlib
 
 
 class ObjectCache(object):  # pragma: no cover
@@ -40,6 +48,39 @@ class ObjectCache(object):  # pragma: no cover
 
         raise NotImplementedError
 
+    def read_properties_multi(self, keys):
+        """Return the cached object properties for many UUID and SHA1 tuples.
+
+        The result is a dictionary that maps the UUID and SHA1 tuples
+        found in the cache to their object properties dictionaries.
+        Tuples not found in the cache are left out.
+
+        Implementations should override this to look up all keys in
+        one go. By default, the keys are looked up one by one.
+
+        """
+
+        result = {}
+        for uuid, sha1 in keys:
+            properties = self.read_properties(uuid, sha1)
+            if properties is not None:
+                result[(uuid, sha1)] = properties
+        return result
+
+    def write_properties_multi(self, items):
+        """Store object properties for many UUID and SHA1 tuples.
+
+        The items are a dictionary that maps UUID and SHA1 tuples to
+        object properties dictionaries.
+
+        Implementations should override this to store all items in
+        one go. By default, the items are stored one by one.
+
+        """
+
+        for (uuid, sha1), properties in items.iteritems():
+            self.write_properties(uuid, sha1, properties)
+
     def read_raw_property_data(self, sha1):
         """Look up the raw property data for a given SHA1.
 
@@ -55,16 +96,146 @@ class ObjectCache(object):  # pragma: no cover
 
         raise NotImplementedError
 
+    def acquire_properties_leases(self, keys, ttl):
+        """Acquire leases for loading the properties of many objects.
+
+        A lease gives whoever holds it the exclusive right to load and
+        store the properties for a UUID and SHA1 tuple, so that when
+        many workers miss the cache at the same time, only one of them
+        does the work while the others wait for the result to appear
+        in the cache. Leases expire after ttl seconds.
+
+        Returns the set of UUID and SHA1 tuples for which leases were
+        acquired. Leases for the other tuples are held by someone else.
+
+        Caches that cannot coordinate leases grant all of them.
+
+        """
+
+        return set(keys)
+
+    def release_properties_leases(self, keys):
+        """Release leases acquired with acquire_properties_leases()."""
+
+        pass
+
+    def acquire_raw_property_data_lease(self, sha1, ttl):
+        """Acquire a lease for loading the raw property data for a SHA1.
+
+        Returns True if the lease was acquired and False if it is held
+        by someone else. Caches that cannot coordinate leases always
+        grant it. See acquire_properties_leases() for details.
+
+        """
+
+        return True
+
+    def release_raw_property_data_lease(self, sha1):
+        """Release a lease acquired with acquire_raw_property_data_lease()."""
+
+        pass
+
+
+class CacheKeyScheme(object):
+
+    """Builds versioned and namespaced keys for cache entries.
+
+    Keys have the form consonant:VERSION:NAMESPACE:KIND:ID. The version
+    is increased whenever the encoding of entries or what the loader
+    expects from them changes, so that entries written by other versions
+    are never read. The namespace keeps the entries of different stores
+    sharing a cache apart. Characters other than letters, digits, dots,
+    dashes and underscores are replaced in the namespace, as Memcached
+    does not allow whitespace or control characters in keys.
+
+    """
+
+    version = 1
+
+    def __init__(self, namespace=''):
+        self.namespace = re.sub(r'[^A-Za-z0-9._-]', '_', namespace)
+        self.prefix = 'consonant:%d:%s:' % (self.version, self.namespace)
+
+    def properties_key(self, uuid, sha1):
+        """Return the key for the properties of an object with a given SHA1."""
+
+        return '%sp:%s,%s' % (self.prefix, uuid, sha1)
+
+    def raw_property_data_key(self, sha1):
+        """Return the key for the raw property data with a given SHA1."""
+
+        return '%sr:%s' % (self.prefix, sha1)
+
+    def lease_key(self, key):
+        """Return the key for a lease on the entry with a given key."""
+
+        return '%s:lease' % key
+
+
+class PropertiesSerializer(object):
+
+    """Encodes object properties compactly for storing them in caches.
+
+    Properties are encoded with marshal, which is faster than pickle
+    and produces smaller output for the plain dictionaries, lists,
+    strings and numbers that properties consist of. Encoded properties
+    larger than compress_threshold bytes are compressed with zlib if
+    that makes them smaller. A leading byte tells which of the two
+    encodings is used. Compression is disabled if compress_threshold
+    is None.
+
+    """
+
+    def __init__(self, compress_threshold=1024, compress_level=1):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, properties):
+        """Return encoded properties or None if they cannot be encoded."""
+
+        try:
+            data = marshal.dumps(properties, 2)
+        except ValueError:
+            return None
+        if self.compress_threshold is not None \
+                and len(data) > self.compress_threshold:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < len(data):
+                return 'z' + compressed
+        return 'm' + data
+
+    def loads(self, data):
+        """Return decoded properties or None if the data is not valid."""
+
+        try:
+            if data[:1] == 'm':
+                return marshal.loads(data[1:])
+            elif data[:1] == 'z':
+                return marshal.loads(zlib.decompress(buffer(data, 1)))
+        except (EOFError, TypeError, ValueError, zlib.error):
+            pass
+        return None
+
 
 class MemcachedObjectCache(ObjectCache):  # pragma: no cover
 
-    """Object cache implementation for Memcached."""
+    """Object cache implementation for Memcached.
+
+    Raw property data larger than chunk_size bytes is split into chunks
+    stored separately, so that it fits into the 1 MB item size limit
+    of Memcached.
+
+    """
 
-    def __init__(self, servers):
+    def __init__(self, servers, chunk_size=1000 * 1000, namespace='',
+                 serializer=None):
         ObjectCache.__init__(self)
 
         self.mc = pylibmc.Client(servers)
         self.mc_pool = pylibmc.ThreadMappedPool(self.mc)
+        self.chunk_size = chunk_size
+        self.keys = CacheKeyScheme(namespace)
+        self.serializer = serializer or PropertiesSerializer()
 
     def read_properties(self, uuid, sha1):
         """Look up the object properties for a given SHA1.
@@ -75,13 +246,51 @@ class MemcachedObjectCache(ObjectCache):  # pragma: no cover
         """
 
         with self.mc_pool.reserve() as mc:
-            return mc.get('%s,%s' % (uuid, sha1))
+            data = mc.get(self.keys.properties_key(uuid, sha1))
+        return None if data is None else self.serializer.loads(data)
 
     def write_properties(self, uuid, sha1, properties):
         """Store an object properties dictionary for a given UUID and SHA1."""
 
+        data = self.serializer.dumps(properties)
+        if data is not None:
+            with self.mc_pool.reserve() as mc:
+                mc.set(self.keys.properties_key(uuid, sha1), data)
+
+    def read_properties_multi(self, keys):
+        """Return the cached object properties for many UUID and SHA1 tuples.
+
+        All keys are looked up with a single get_multi request.
+
+        """
+
+        mc_keys = dict((self.keys.properties_key(*key), key) for key in keys)
+        if not mc_keys:
+            return {}
         with self.mc_pool.reserve() as mc:
-            mc.set('%s,%s' % (uuid, sha1), properties)
+            found = mc.get_multi(mc_keys.keys())
+        result = {}
+        for mc_key, data in found.iteritems():
+            properties = self.serializer.loads(data)
+            if properties is not None:
+                result[mc_keys[mc_key]] = properties
+        return result
+
+    def write_properties_multi(self, items):
+        """Store object properties for many UUID and SHA1 tuples.
+
+        All items are stored with a single set_multi request.
+
+        """
+
+        mc_items = {}
+        for key, properties in items.iteritems():
+            data = self.serializer.dumps(properties)
+            if data is not None:
+                mc_items[self.keys.properties_key(*key)] = data
+        if mc_items:
+            with self.mc_pool.reserve() as mc:
+                mc.set_multi(mc_items)
 
     def read_raw_property_data(self, sha1):
         """Look up the raw property data for a given SHA1.
@@ -91,11 +300,686 @@ class MemcachedObjectCache(ObjectCache):  # pragma: no cover
 
         """
 
+        key = self.keys.raw_property_data_key(sha1)
         with self.mc_pool.reserve() as mc:
-            return mc.get(sha1)
+            data = mc.get(key)
+            if isinstance(data, tuple):
+                # data stored in chunks is represented by the number of
+                # chunks and the total size; if any chunk has been
+                # evicted, the data is treated as a miss
+                count, size = data
+                keys = ['%s:%d' % (key, index) for index in xrange(count)]
+                chunks = mc.get_multi(keys)
+                if len(chunks) < count:
+                    return None
+                data = ''.join(chunks[key] for key in keys)
+                if len(data) != size:
+                    return None
+            return data
 
     def write_raw_property_data(self, sha1, data):
         """Store raw property data for a given SHA1."""
 
+        key = self.keys.raw_property_data_key(sha1)
+        with self.mc_pool.reserve() as mc:
+            if len(data) <= self.chunk_size:
+                mc.set(key, data)
+            else:
+                offsets = xrange(0, len(data), self.chunk_size)
+                mc.set_multi(dict(
+                    ('%s:%d' % (key, index),
+                     data[offset:offset + self.chunk_size])
+                    for index, offset in enumerate(offsets)))
+                mc.set(key, (len(offsets), len(data)))
+
+    def acquire_properties_leases(self, keys, ttl):
+        """Acquire leases for loading the properties of many objects.
+
+        Leases are items added with add_multi, which only adds items
+        that do not exist yet, and expire with the items. Returns the
+        set of UUID and SHA1 tuples for which leases were acquired.
+
+        """
+
+        lease_keys = dict(
+            (self.keys.lease_key(self.keys.properties_key(*key)), key)
+            for key in keys)
+        if not lease_keys:
+            return set()
         with self.mc_pool.reserve() as mc:
-            mc.set(sha1, data)
+            failed = mc.add_multi(
+                dict((k, 1) for k in lease_keys), time=max(1, int(ttl)))
+        return set(key for k, key in lease_keys.iteritems()
+                   if k not in failed)
+
+    def release_properties_leases(self, keys):
+        """Release leases acquired with acquire_properties_leases()."""
+
+        lease_keys = [self.keys.lease_key(self.keys.properties_key(*key))
+                      for key in keys]
+        if lease_keys:
+            with self.mc_pool.reserve() as mc:
+                mc.delete_multi(lease_keys)
+
+    def acquire_raw_property_data_lease(self, sha1, ttl):
+        """Acquire a lease for loading the raw property data for a SHA1.
+
+        The lease is an item added with add, which only adds items that
+        do not exist yet, and expires with the item. Returns True if the
+        lease was acquired and False otherwise.
+
+        """
+
+        key = self.keys.lease_key(self.keys.raw_property_data_key(sha1))
+        with self.mc_pool.reserve() as mc:
+            return bool(mc.add(key, 1, time=max(1, int(ttl))))
+
+    def release_raw_property_data_lease(self, sha1):
+        """Release a lease acquired with acquire_raw_property_data_lease()."""
+
+        key = self.keys.lease_key(self.keys.raw_property_data_key(sha1))
+        with self.mc_pool.reserve() as mc:
+            mc.delete(key)
+
+
+class SQLiteObjectCache(ObjectCache):
+
+    """Object cache implementation using a local SQLite database file.
+
+    The cache survives restarts and can be shared safely by several
+    processes on the same host. The database is used in write-ahead
+    logging mode, so that readers are not blocked by writers, and every
+    thread uses a connection of its own.
+
+    The total size of the cached values is capped at max_size bytes.
+    Every eviction_interval seconds, a background thread checks the
+    size and, if the cap is exceeded, evicts the least recently used
+    entries until the cache is back at 90% of the cap. Evicted entries
+    are counted in the evictions attribute. Errors accessing the
+    database, e.g. because it remains locked by another process, are
+    treated as misses instead of failing the requests using the cache.
+
+    """
+
+    # read entries are marked as used at most once every that many seconds
+    # in order to avoid writing to the database on every read
+    touch_interval = 60
+
+    def __init__(self, filename, max_size=256 * 1024 * 1024,
+                 eviction_interval=60.0, namespace='', serializer=None):
+        ObjectCache.__init__(self)
+
+        self.filename = filename
+        self.keys = CacheKeyScheme(namespace)
+        self.serializer = serializer or PropertiesSerializer()
+        self.max_size = max_size
+        self.evictions = 0
+        self.local = threading.local()
+
+        db = self._connection()
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'key TEXT PRIMARY KEY, '
+                       'value BLOB NOT NULL, '
+                       'size INTEGER NOT NULL, '
+                       'atime INTEGER NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS entries_atime '
+                       'ON entries (atime)')
+            db.execute('CREATE TABLE IF NOT EXISTS leases ('
+                       'key TEXT PRIMARY KEY, '
+                       'expires REAL NOT NULL)')
+
+        self.stopped = threading.Event()
+        if eviction_interval:
+            thread = threading.Thread(target=self._evict_periodically,
+                                      args=(eviction_interval,))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        """Stop evicting entries in the background."""
+
+        self.stopped.set()
+
+    def read_properties(self, uuid, sha1):
+        """Look up the object properties for a given SHA1.
+
+        Returns an object properties dictionary if the UUID1 and SHA1 tuple
+        is found in the cache. Otherwise returns None.
+
+        """
+
+        return self.read_properties_multi([(uuid, sha1)]).get(
+            (uuid, sha1), None)
+
+    def write_properties(self, uuid, sha1, properties):
+        """Store an object properties dictionary for a given UUID and SHA1."""
+
+        self.write_properties_multi({(uuid, sha1): properties})
+
+    def read_properties_multi(self, keys):
+        """Return the cached object properties for many UUID and SHA1 tuples.
+
+        All keys are looked up with a single query.
+
+        """
+
+        db_keys = dict((self.keys.properties_key(*key), key) for key in keys)
+        result = {}
+        for db_key, data in self._read(db_keys.keys()).iteritems():
+            properties = self.serializer.loads(data)
+            if properties is not None:
+                result[db_keys[db_key]] = properties
+        return result
+
+    def write_properties_multi(self, items):
+        """Store object properties for many UUID and SHA1 tuples.
+
+        All items are stored in a single transaction.
+
+        """
+
+        db_items = []
+        for key, properties in items.iteritems():
+            data = self.serializer.dumps(properties)
+            if data is not None:
+                db_items.append((self.keys.properties_key(*key), data))
+        self._write(db_items)
+
+    def read_raw_property_data(self, sha1):
+        """Look up the raw property data for a given SHA1.
+
+        Returns the data in exactly the way it was stored if the SHA1
+        is found in the cache. Otherwise returns None.
+
+        """
+
+        key = self.keys.raw_property_data_key(sha1)
+        return self._read([key]).get(key, None)
+
+    def write_raw_property_data(self, sha1, data):
+        """Store raw property data for a given SHA1."""
+
+        self._write([(self.keys.raw_property_data_key(sha1), data)])
+
+    def acquire_properties_leases(self, keys, ttl):
+        """Acquire leases for loading the properties of many objects.
+
+        Leases are rows in a table of the database, so they are shared
+        by all processes using the cache file. Returns the set of UUID
+        and SHA1 tuples for which leases were acquired.
+
+        """
+
+        lease_keys = dict(
+            (self.keys.lease_key(self.keys.properties_key(*key)), key)
+            for key in keys)
+        return set(lease_keys[k]
+                   for k in self._acquire_leases(lease_keys.keys(), ttl))
+
+    def release_properties_leases(self, keys):
+        """Release leases acquired with acquire_properties_leases()."""
+
+        self._release_leases(
+            [self.keys.lease_key(self.keys.properties_key(*key))
+             for key in keys])
+
+    def acquire_raw_property_data_lease(self, sha1, ttl):
+        """Acquire a lease for loading the raw property data for a SHA1.
+
+        The lease is a row in a table of the database, so it is shared
+        by all processes using the cache file. Returns True if the lease
+        was acquired and False otherwise.
+
+        """
+
+        key = self.keys.lease_key(self.keys.raw_property_data_key(sha1))
+        return bool(self._acquire_leases([key], ttl))
+
+    def release_raw_property_data_lease(self, sha1):
+        """Release a lease acquired with acquire_raw_property_data_lease()."""
+
+        self._release_leases(
+            [self.keys.lease_key(self.keys.raw_property_data_key(sha1))])
+
+    def evict(self):
+        """Evict the least recently used entries if the cache is too large.
+
+        Returns the number of entries evicted.
+
+        """
+
+        db = self._connection()
+        with db:
+            total = db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= self.max_size:
+                return 0
+
+            excess = total - int(self.max_size * 0.9)
+            keys = []
+            for key, size in db.execute(
+                    'SELECT key, size FROM entries ORDER BY atime'):
+                keys.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            db.executemany('DELETE FROM entries WHERE key = ?', keys)
+        self.evictions += len(keys)
+        return len(keys)
+
+    def _connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filename, timeout=5.0)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def _read(self, keys):
+        values = {}
+        touched = []
+        now = int(time.time())
+        try:
+            db = self._connection()
+            # stay below SQLite's default limit of 999 query parameters
+            for start in xrange(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                for key, value, atime in db.execute(
+                        'SELECT key, value, atime FROM entries '
+                        'WHERE key IN (%s)' % ', '.join('?' * len(chunk)),
+                        chunk):
+                    values[key] = str(value)
+                    if atime < now - self.touch_interval:
+                        touched.append((now, key))
+            if touched:
+                with db:
+                    db.executemany(
+                        'UPDATE entries SET atime = ? WHERE key = ?', touched)
+        except sqlite3.OperationalError:
+            pass
+        return values
+
+    def _write(self, items):
+        if not items:
+            return
+        now = int(time.time())
+        try:
+            db = self._connection()
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO entries (key, value, size, atime) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(key, sqlite3.Binary(value), len(value), now)
+                     for key, value in items])
+        except sqlite3.OperationalError:
+            pass
+
+    def _acquire_leases(self, keys, ttl):
+        if not keys:
+            return []
+        now = time.time()
+        acquired = []
+        try:
+            db = self._connection()
+            with db:
+                for key in keys:
+                    db.execute('DELETE FROM leases WHERE key = ? '
+                               'AND expires < ?', (key, now))
+                    cursor = db.execute('INSERT OR IGNORE INTO leases '
+                                        '(key, expires) VALUES (?, ?)',
+                                        (key, now + ttl))
+                    if cursor.rowcount == 1:
+                        acquired.append(key)
+        except sqlite3.OperationalError:
+            # without the database, leases cannot be coordinated, so
+            # everyone gets to load the entries
+            return keys
+        return acquired
+
+    def _release_leases(self, keys):
+        if not keys:
+            return
+        try:
+            db = self._connection()
+            with db:
+                db.executemany('DELETE FROM leases WHERE key = ?',
+                               [(key,) for key in keys])
+        except sqlite3.OperationalError:
+            pass
+
+    def _evict_periodically(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.evict()
+            except sqlite3.OperationalError:
+                pass
+
+
+class LRUObjectCache(ObjectCache):
+
+    """In-process object cache that evicts the least recently used entries.
+
+    Object properties and raw property data share a single pool of at
+    most max_entries entries, holding at most max_size bytes of raw
+    property data. Raw property data larger than max_raw_data_size
+    bytes is not stored at all, leaving it to slower tiers. Once the
+    pool is full, storing a new entry evicts the entries that were
+    least recently read or written. The number of evicted entries is
+    counted in the evictions attribute.
+
+    """
+
+    def __init__(self, max_entries=10000, max_size=64 * 1024 * 1024,
+                 max_raw_data_size=1024 * 1024):
+        ObjectCache.__init__(self)
+
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.max_raw_data_size = max_raw_data_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def read_properties(self, uuid, sha1):
+        """Look up the object properties for a given SHA1.
+
+        Returns an object properties dictionary if the UUID1 and SHA1 tuple
+        is found in the cache. Otherwise returns None.
+
+        """
+
+        return self._read(('properties', uuid, sha1))
+
+    def write_properties(self, uuid, sha1, properties):
+        """Store an object properties dictionary for a given UUID and SHA1."""
+
+        self._write(('properties', uuid, sha1), properties)
+
+    def read_raw_property_data(self, sha1):
+        """Look up the raw property data for a given SHA1.
+
+        Returns the data in exactly the way it was stored if the SHA1
+        is found in the cache. Otherwise returns None.
+
+        """
+
+        return self._read(('raw', sha1))
+
+    def write_raw_property_data(self, sha1, data):
+        """Store raw property data for a given SHA1.
+
+        Data larger than max_raw_data_size bytes is not stored.
+
+        """
+
+        if len(data) <= self.max_raw_data_size:
+            self._write(('raw', sha1), data, len(data))
+
+    def acquire_properties_leases(self, keys, ttl):
+        """Acquire leases for loading the properties of many objects.
+
+        Leases are only shared by the threads of the current process.
+        Returns the set of UUID and SHA1 tuples for which leases were
+        acquired.
+
+        """
+
+        return set(key for key in keys
+                   if self._acquire_lease(('properties',) + key, ttl))
+
+    def release_properties_leases(self, keys):
+        """Release leases acquired with acquire_properties_leases()."""
+
+        for key in keys:
+            self._release_lease(('properties',) + key)
+
+    def acquire_raw_property_data_lease(self, sha1, ttl):
+        """Acquire a lease for loading the raw property data for a SHA1.
+
+        Leases are only shared by the threads of the current process.
+        Returns True if the lease was acquired and False otherwise.
+
+        """
+
+        return self._acquire_lease(('raw', sha1), ttl)
+
+    def release_raw_property_data_lease(self, sha1):
+        """Release a lease acquired with acquire_raw_property_data_lease()."""
+
+        self._release_lease(('raw', sha1))
+
+    def _acquire_lease(self, key, ttl):
+        now = time.time()
+        with self.lock:
+            if self.leases.get(key, 0) > now:
+                return False
+            self.leases[key] = now + ttl
+            return True
+
+    def _release_lease(self, key):
+        with self.lock:
+            self.leases.pop(key, None)
+
+    def _read(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            # re-insert the entry to mark it as most recently used
+            self.entries[key] = entry
+            return entry[0]
+
+    def _write(self, key, value, size=0):
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or \
+                    self.size > self.max_size:
+                evicted_key, evicted_entry = self.entries.popitem(last=False)
+                self.size -= evicted_entry[1]
+                self.evictions += 1
+
+
+class CacheTierStatistics(object):
+
+    """Hit, miss and eviction counts of a tier in a TieredObjectCache."""
+
+    def __init__(self, tier):
+        self.tier = tier
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def evictions(self):
+        """Return the number of entries evicted from the tier or None.
+
+        None is returned if the tier does not count its evictions.
+
+        """
+
+        return getattr(self.tier, 'evictions', None)
+
+
+class TieredObjectCache(ObjectCache):
+
+    """Object cache that combines several caches into tiers.
+
+    The tiers are a list of caches, ordered from the fastest to the
+    slowest, e.g. an LRUObjectCache in front of a MemcachedObjectCache.
+    Lookups try one tier after another. Entries found in a tier are
+    promoted to all tiers in front of it. Entries are written through
+    to all tiers. Hits, misses and evictions are counted per tier in
+    the statistics list.
+
+    """
+
+    def __init__(self, tiers):
+        ObjectCache.__init__(self)
+
+        self.tiers = tiers
+        self.statistics = [CacheTierStatistics(tier) for tier in tiers]
+
+    def read_properties(self, uuid, sha1):
+        """Look up the object properties for a given SHA1.
+
+        Returns an object properties dictionary if the UUID1 and SHA1 tuple
+        is found in any tier. Otherwise returns None.
+
+        """
+
+        for index, tier in enumerate(self.tiers):
+            properties = tier.read_properties(uuid, sha1)
+            if properties is not None:
+                self.statistics[index].hits += 1
+                for upper_tier in self.tiers[:index]:
+                    upper_tier.write_properties(uuid, sha1, properties)
+                return properties
+            self.statistics[index].misses += 1
+        return None
+
+    def write_properties(self, uuid, sha1, properties):
+        """Store an object properties dictionary in all tiers."""
+
+        for tier in self.tiers:
+            tier.write_properties(uuid, sha1, properties)
+
+    def read_properties_multi(self, keys):
+        """Return the cached object properties for many UUID and SHA1 tuples.
+
+        Every tier is asked once for all keys not found in the tiers in
+        front of it.
+
+        """
+
+        result = {}
+        remaining = list(keys)
+        for index, tier in enumerate(self.tiers):
+            if not remaining:
+                break
+            found = tier.read_properties_multi(remaining)
+            self.statistics[index].hits += len(found)
+            self.statistics[index].misses += len(remaining) - len(found)
+            if found:
+                for upper_tier in self.tiers[:index]:
+                    upper_tier.write_properties_multi(found)
+                result.update(found)
+                remaining = [key for key in remaining if key not in found]
+        return result
+
+    def write_properties_multi(self, items):
+        """Store properties for many UUID and SHA1 tuples in all tiers."""
+
+        for tier in self.tiers:
+            tier.write_properties_multi(items)
+
+    def read_raw_property_data(self, sha1):
+        """Look up the raw property data for a given SHA1.
+
+        Returns the data in exactly the way it was stored if the SHA1
+        is found in any tier. Otherwise returns None.
+
+        """
+
+        for index, tier in enumerate(self.tiers):
+            data = tier.read_raw_property_data(sha1)
+            if data is not None:
+                self.statistics[index].hits += 1
+                for upper_tier in self.tiers[:index]:
+                    upper_tier.write_raw_property_data(sha1, data)
+                return data
+            self.statistics[index].misses += 1
+        return None
+
+    def write_raw_property_data(self, sha1, data):
+        """Store raw property data for a given SHA1 in all tiers."""
+
+        for tier in self.tiers:
+            tier.write_raw_property_data(sha1, data)
+
+    def acquire_properties_leases(self, keys, ttl):
+        """Acquire leases for loading the properties of many objects.
+
+        Leases are acquired from the last tier only, as it is the one
+        shared most widely, e.g. by all processes using a Memcached
+        server as opposed to the threads of a single process. Returns
+        the set of UUID and SHA1 tuples for which leases were acquired.
+
+        """
+
+        return self.tiers[-1].acquire_properties_leases(keys, ttl)
+
+    def release_properties_leases(self, keys):
+        """Release leases acquired with acquire_properties_leases()."""
+
+        self.tiers[-1].release_properties_leases(keys)
+
+    def acquire_raw_property_data_lease(self, sha1, ttl):
+        """Acquire a lease for loading the raw property data for a SHA1.
+
+        The lease is acquired from the last tier only. Returns True if
+        it was acquired and False if it is held by someone else.
+
+        """
+
+        return self.tiers[-1].acquire_raw_property_data_lease(sha1, ttl)
+
+    def release_raw_property_data_lease(self, sha1):
+        """Release a lease acquired with acquire_raw_property_data_lease()."""
+
+        self.tiers[-1].release_raw_property_data_lease(sha1)
+
+
+def default_namespace(path):
+    """Return the default cache namespace for a store repository path.
+
+    This is the name of the repository directory, or of the directory
+    containing it if the path refers to the .git directory of a
+    non-bare repository.
+
+    """
+
+    path = os.path.abspath(path)
+    if os.path.basename(path) == '.git':
+        path = os.path.dirname(path)
+    return os.path.basename(path)
+
+
+def create_object_cache(local_entries=0, filename=None,
+                        max_file_size=256 * 1024 * 1024, servers=None,
+                        namespace='', statistics=False,
+                        max_local_size=64 * 1024 * 1024):
+    """Return an object cache combining the requested caches or None.
+
+    An LRUObjectCache with local_entries entries and at most
+    max_local_size bytes of raw property data, an SQLiteObjectCache
+    stored in filename and a MemcachedObjectCache for the given servers
+    are used, in this order, if requested. If more than one of them is
+    requested, they are combined in a TieredObjectCache. A single cache
+    is wrapped in a TieredObjectCache as well if statistics is set, so
+    that its hits and misses are counted.
+
+    """
+
+    tiers = []
+    if local_entries > 0:
+        tiers.append(LRUObjectCache(local_entries, max_local_size))
+    if filename:
+        tiers.append(SQLiteObjectCache(
+            filename, max_file_size, namespace=namespace))
+    if servers:
+        tiers.append(MemcachedObjectCache(servers, namespace=namespace))
+
+    if len(tiers) > 1 or (tiers and statistics):
+        return TieredObjectCache(tiers)
+    elif tiers:
+        return tiers[0]
+    else:
+        return None
@@ -18,4 +18,448 @@
 """Unit tests for caching mechanisms."""
 
 
-# TODO
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from consonant.store import caches
+
+
+class DictObjectCache(caches.ObjectCache):
+
+    """An object cache that only implements single reads and writes."""
+
+    def __init__(self):
+        self.properties = {}
+        self.reads = 0
+        self.writes = 0
+
+    def read_properties(self, uuid, sha1):
+        """Return the properties stored for a UUID and SHA1 or None."""
+
+        self.reads += 1
+        return self.properties.get((uuid, sha1), None)
+
+    def write_properties(self, uuid, sha1, properties):
+        """Store properties for a UUID and SHA1."""
+
+        self.writes += 1
+        self.properties[(uuid, sha1)] = properties
+
+
+class ObjectCacheTests(unittest.TestCase):
+
+    """Unit tests for the default implementations in ObjectCache."""
+
+    def setUp(self):
+        """Initialise an object cache with one entry."""
+
+        self.cache = DictObjectCache()
+        self.cache.write_properties('uuid1', 'sha1', {'name': 'one'})
+
+    def test_read_properties_multi_only_returns_cached_keys(self):
+        """Verify that read_properties_multi() leaves out missing keys."""
+
+        result = self.cache.read_properties_multi(
+            [('uuid1', 'sha1'), ('uuid2', 'sha1'), ('uuid1', 'sha2')])
+        self.assertEqual(result, {('uuid1', 'sha1'): {'name': 'one'}})
+        self.assertEqual(self.cache.reads, 3)
+
+    def test_read_properties_multi_with_no_keys_returns_nothing(self):
+        """Verify that read_properties_multi() works with no keys."""
+
+        self.assertEqual(self.cache.read_properties_multi([]), {})
+
+    def test_write_properties_multi_writes_all_items(self):
+        """Verify that write_properties_multi() writes every item."""
+
+        self.cache.write_properties_multi({
+            ('uuid2', 'sha1'): {'name': 'two'},
+            ('uuid3', 'sha1'): {},
+            })
+        self.assertEqual(self.cache.writes, 3)
+        self.assertEqual(
+            self.cache.read_properties_multi(
+                [('uuid1', 'sha1'), ('uuid2', 'sha1'), ('uuid3', 'sha1')]),
+            {('uuid1', 'sha1'): {'name': 'one'},
+             ('uuid2', 'sha1'): {'name': 'two'},
+             ('uuid3', 'sha1'): {}})
+
+
+class SQLiteObjectCacheTests(unittest.TestCase):
+
+    """Unit tests for the SQLiteObjectCache class."""
+
+    def setUp(self):
+        """Create a temporary directory for the cache database."""
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(self._remove_tempdir)
+        self.filename = os.path.join(self.tmpdir, 'cache.sqlite')
+
+    def _remove_tempdir(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _set_access_times(self, cache, atimes):
+        db = sqlite3.connect(self.filename)
+        with db:
+            for sha1, atime in atimes.iteritems():
+                db.execute('UPDATE entries SET atime = ? WHERE key = ?',
+                           (atime, cache.keys.raw_property_data_key(sha1)))
+        db.close()
+
+    def test_entries_are_shared_and_survive_restarts(self):
+        """Verify that entries are seen by other and later cache instances."""
+
+        cache = caches.SQLiteObjectCache(self.filename, eviction_interval=0)
+        other = caches.SQLiteObjectCache(self.filename, eviction_interval=0)
+        cache.write_properties('uuid1', 'sha1', {'name': 'one', 'n': [1]})
+        cache.write_raw_property_data('sha2', '\0binary\xff')
+        self.assertEqual(other.read_properties('uuid1', 'sha1'),
+                         {'name': 'one', 'n': [1]})
+
+        restarted = caches.SQLiteObjectCache(
+            self.filename, eviction_interval=0)
+        self.assertEqual(restarted.read_properties('uuid1', 'sha1'),
+                         {'name': 'one', 'n': [1]})
+        self.assertEqual(restarted.read_raw_property_data('sha2'),
+                         '\0binary\xff')
+        self.assertEqual(restarted.read_properties('uuid1', 'sha2'), None)
+        self.assertEqual(restarted.read_raw_property_data('sha1'), None)
+
+    def test_multi_reads_and_writes(self):
+        """Verify that many properties can be read and written at once."""
+
+        cache = caches.SQLiteObjectCache(self.filename, eviction_interval=0)
+        items = dict((('uuid%d' % i, 'sha1'), {'i': i}) for i in xrange(600))
+        cache.write_properties_multi(items)
+        keys = items.keys() + [('uuid', 'sha2')]
+        self.assertEqual(cache.read_properties_multi(keys), items)
+
+    def test_leases_are_shared_between_cache_instances(self):
+        """Verify that a lease held by one instance is seen by another."""
+
+        cache = caches.SQLiteObjectCache(self.filename, eviction_interval=0)
+        other = caches.SQLiteObjectCache(self.filename, eviction_interval=0)
+        keys = [('uuid1', 'sha1'), ('uuid2', 'sha1')]
+
+        self.assertEqual(cache.acquire_properties_leases(keys[:1], 10),
+                         set(keys[:1]))
+        self.assertEqual(other.acquire_properties_leases(keys, 10),
+                         set(keys[1:]))
+        cache.release_properties_leases(keys[:1])
+        self.assertEqual(other.acquire_properties_leases(keys, 10),
+                         set(keys[:1]))
+
+        self.assertTrue(cache.acquire_raw_property_data_lease('sha1', -1))
+        self.assertTrue(other.acquire_raw_property_data_lease('sha1', 10))
+        self.assertFalse(cache.acquire_raw_property_data_lease('sha1', 10))
+        other.release_raw_property_data_lease('sha1')
+        self.assertTrue(cache.acquire_raw_property_data_lease('sha1', 10))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        """Verify that the oldest entries are evicted above the size cap."""
+
+        cache = caches.SQLiteObjectCache(
+            self.filename, max_size=250, eviction_interval=0)
+        for sha1 in ('sha1', 'sha2', 'sha3'):
+            cache.write_raw_property_data(sha1, 'x' * 100)
+        self._set_access_times(cache, {'sha1': 3, 'sha2': 1, 'sha3': 2})
+
+        self.assertEqual(cache.evict(), 1)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.read_raw_property_data('sha2'), None)
+        self.assertEqual(cache.read_raw_property_data('sha1'), 'x' * 100)
+        self.assertEqual(cache.read_raw_property_data('sha3'), 'x' * 100)
+        self.assertEqual(cache.evict(), 0)
+
+    def test_reads_mark_entries_as_used(self):
+        """Verify that reading an entry protects it from being evicted."""
+
+        cache = caches.SQLiteObjectCache(
+            self.filename, max_size=150, eviction_interval=0)
+        cache.write_raw_property_data('sha1', 'x' * 100)
+        cache.write_raw_property_data('sha2', 'x' * 100)
+        self._set_access_times(cache, {'sha1': 1, 'sha2': 2})
+
+        self.assertEqual(cache.read_raw_property_data('sha1'), 'x' * 100)
+        self.assertEqual(cache.evict(), 1)
+        self.assertEqual(cache.read_raw_property_data('sha1'), 'x' * 100)
+        self.assertEqual(cache.read_raw_property_data('sha2'), None)
+
+
+class LRUObjectCacheTests(unittest.TestCase):
+
+    """Unit tests for the LRUObjectCache class."""
+
+    def test_least_recently_used_entries_are_evicted(self):
+        """Verify that the least recently used entries are evicted."""
+
+        cache = caches.LRUObjectCache(max_entries=2)
+        cache.write_properties('uuid1', 'sha1', {'name': 'one'})
+        cache.write_raw_property_data('sha2', 'data')
+        self.assertEqual(cache.read_properties('uuid1', 'sha1'),
+                         {'name': 'one'})
+        cache.write_properties('uuid3', 'sha3', {'name': 'three'})
+
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.read_raw_property_data('sha2'), None)
+        self.assertEqual(cache.read_properties('uuid1', 'sha1'),
+                         {'name': 'one'})
+        self.assertEqual(cache.read_properties('uuid3', 'sha3'),
+                         {'name': 'three'})
+
+    def test_raw_data_is_limited_by_size(self):
+        """Verify that raw data is evicted to stay within the size limit."""
+
+        cache = caches.LRUObjectCache(max_size=10, max_raw_data_size=6)
+        cache.write_raw_property_data('sha1', 'x' * 4)
+        cache.write_properties('uuid1', 'sha1', {'name': 'one'})
+        cache.write_raw_property_data('sha2', 'x' * 4)
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.evictions, 0)
+
+        cache.write_raw_property_data('sha3', 'x' * 6)
+        self.assertEqual(cache.size, 10)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.read_raw_property_data('sha1'), None)
+        self.assertEqual(cache.read_properties('uuid1', 'sha1'),
+                         {'name': 'one'})
+        self.assertEqual(cache.read_raw_property_data('sha2'), 'x' * 4)
+        self.assertEqual(cache.read_raw_property_data('sha3'), 'x' * 6)
+
+        cache.write_raw_property_data('sha4', 'x' * 7)
+        self.assertEqual(cache.read_raw_property_data('sha4'), None)
+        self.assertEqual(cache.size, 10)
+
+    def test_properties_and_raw_data_do_not_clash(self):
+        """Verify that properties and raw data are stored separately."""
+
+        cache = caches.LRUObjectCache()
+        cache.write_raw_property_data('sha1', 'data')
+        self.assertEqual(cache.read_properties('uuid1', 'sha1'), None)
+        self.assertEqual(cache.read_raw_property_data('sha1'), 'data')
+
+    def test_leases_are_exclusive_until_released_or_expired(self):
+        """Verify that leases are only granted once until released."""
+
+        cache = caches.LRUObjectCache()
+        keys = [('uuid1', 'sha1'), ('uuid2', 'sha1')]
+        self.assertEqual(cache.acquire_properties_leases(keys, 10),
+                         set(keys))
+        self.assertEqual(cache.acquire_properties_leases(keys, 10), set())
+        cache.release_properties_leases(keys[:1])
+        self.assertEqual(cache.acquire_properties_leases(keys, 10),
+                         set(keys[:1]))
+
+        self.assertTrue(cache.acquire_raw_property_data_lease('sha1', 0))
+        self.assertTrue(cache.acquire_raw_property_data_lease('sha1', 10))
+        self.assertFalse(cache.acquire_raw_property_data_lease('sha1', 10))
+        cache.release_raw_property_data_lease('sha1')
+        self.assertTrue(cache.acquire_raw_property_data_lease('sha1', 10))
+
+
+class TieredObjectCacheTests(unittest.TestCase):
+
+    """Unit tests for the TieredObjectCache class."""
+
+    def setUp(self):
+        """Initialise a tiered cache with an LRU cache in front."""
+
+        self.first = caches.LRUObjectCache(max_entries=10)
+        self.second = DictObjectCache()
+        self.cache = caches.TieredObjectCache([self.first, self.second])
+
+    def test_writes_go_through_to_all_tiers(self):
+        """Verify that written entries are stored in all tiers."""
+
+        self.cache.write_properties('uuid1', 'sha1', {'name': 'one'})
+        self.cache.write_properties_multi({('uuid2', 'sha1'): {}})
+        for tier in (self.first, self.second):
+            self.assertEqual(tier.read_properties('uuid1', 'sha1'),
+                             {'name': 'one'})
+            self.assertEqual(tier.read_properties('uuid2', 'sha1'), {})
+
+    def test_hits_in_lower_tiers_are_promoted(self):
+        """Verify that entries found in a lower tier are promoted."""
+
+        self.second.write_properties('uuid1', 'sha1', {'name': 'one'})
+        self.assertEqual(self.cache.read_properties('uuid1', 'sha1'),
+                         {'name': 'one'})
+        self.assertEqual(self.first.read_properties('uuid1', 'sha1'),
+                         {'name': 'one'})
+
+        self.assertEqual(self.cache.read_properties('uuid1', 'sha1'),
+                         {'name': 'one'})
+        self.assertEqual(self.cache.read_properties('uuid2', 'sha1'), None)
+
+        first, second = self.cache.statistics
+        self.assertEqual((first.hits, first.misses), (1, 2))
+        self.assertEqual((second.hits, second.misses), (1, 1))
+        self.assertEqual(first.evictions, 0)
+        self.assertEqual(second.evictions, None)
+
+    def test_multi_reads_only_ask_lower_tiers_for_misses(self):
+        """Verify that multi reads only pass on keys not found yet."""
+
+        self.first.write_properties('uuid1', 'sha1', {'name': 'one'})
+        self.second.write_properties('uuid2', 'sha1', {'name': 'two'})
+        reads = self.second.reads
+
+        result = self.cache.read_properties_multi(
+            [('uuid1', 'sha1'), ('uuid2', 'sha1'), ('uuid3', 'sha1')])
+        self.assertEqual(result, {('uuid1', 'sha1'): {'name': 'one'},
+                                  ('uuid2', 'sha1'): {'name': 'two'}})
+        self.assertEqual(self.second.reads - reads, 2)
+        self.assertEqual(self.first.read_properties('uuid2', 'sha1'),
+                         {'name': 'two'})
+
+        first, second = self.cache.statistics
+        self.assertEqual((first.hits, first.misses), (1, 2))
+        self.assertEqual((second.hits, second.misses), (1, 1))
+
+    def test_leases_are_acquired_from_the_last_tier(self):
+        """Verify that leases are coordinated by the last tier only."""
+
+        last = caches.LRUObjectCache()
+        cache = caches.TieredObjectCache([self.first, last])
+        self.assertEqual(
+            cache.acquire_properties_leases([('uuid1', 'sha1')], 10),
+            set([('uuid1', 'sha1')]))
+        self.assertEqual(
+            last.acquire_properties_leases([('uuid1', 'sha1')], 10), set())
+        self.assertEqual(
+            self.first.acquire_properties_leases([('uuid1', 'sha1')], 10),
+            set([('uuid1', 'sha1')]))
+        self.assertTrue(cache.acquire_raw_property_data_lease('sha1', 10))
+        self.assertFalse(last.acquire_raw_property_data_lease('sha1', 10))
+
+    def test_raw_property_data_is_promoted(self):
+        """Verify that raw property data found in a lower tier is promoted."""
+
+        tier = caches.LRUObjectCache()
+        tier.write_raw_property_data('sha1', 'data')
+        cache = caches.TieredObjectCache([self.first, tier])
+        self.assertEqual(cache.read_raw_property_data('sha1'), 'data')
+        self.assertEqual(self.first.read_raw_property_data('sha1'), 'data')
+        self.assertEqual(cache.read_raw_property_data('sha2'), None)
+
+
+class CacheKeySchemeTests(unittest.TestCase):
+
+    """Unit tests for the CacheKeyScheme class."""
+
+    def test_keys_are_versioned_and_namespaced(self):
+        """Verify that keys include the format version and namespace."""
+
+        keys = caches.CacheKeyScheme('store')
+        self.assertEqual(keys.properties_key('uuid', 'sha1'),
+                         'consonant:%d:store:p:uuid,sha1' % keys.version)
+        self.assertEqual(keys.raw_property_data_key('sha1'),
+                         'consonant:%d:store:r:sha1' % keys.version)
+
+    def test_namespaces_never_contain_invalid_key_characters(self):
+        """Verify that whitespace and colons are replaced in namespaces."""
+
+        keys = caches.CacheKeyScheme('my store:\n1')
+        self.assertEqual(keys.namespace, 'my_store__1')
+
+
+class PropertiesSerializerTests(unittest.TestCase):
+
+    """Unit tests for the PropertiesSerializer class."""
+
+    def setUp(self):
+        """Initialise sample properties."""
+
+        self.properties = {
+            'name': 'card',
+            'title': u'T\xeftle',
+            'count': 5,
+            'ratio': 0.5,
+            'done': False,
+            'tags': ['a', 'b'],
+            'lane': {'uuid': 'uuid1', 'service': None},
+            }
+
+    def test_properties_are_encoded_and_decoded_unchanged(self):
+        """Verify that properties are decoded exactly as they were."""
+
+        serializer = caches.PropertiesSerializer()
+        data = serializer.dumps(self.properties)
+        self.assertEqual(data[0], 'm')
+        self.assertEqual(serializer.loads(data), self.properties)
+
+    def test_large_properties_are_compressed(self):
+        """Verify that properties above the threshold are compressed."""
+
+        self.properties['description'] = 'lorem ipsum ' * 1000
+        serializer = caches.PropertiesSerializer(compress_threshold=1024)
+        data = serializer.dumps(self.properties)
+        self.assertEqual(data[0], 'z')
+        self.assertTrue(len(data) < 1024)
+        self.assertEqual(serializer.loads(data), self.properties)
+
+        serializer = caches.PropertiesSerializer(compress_threshold=None)
+        self.assertEqual(serializer.dumps(self.properties)[0], 'm')
+
+    def test_unsupported_properties_and_invalid_data_are_not_decoded(self):
+        """Verify that unsupported values and invalid data yield None."""
+
+        serializer = caches.PropertiesSerializer()
+        self.assertEqual(serializer.dumps({'x': object()}), None)
+        for data in ('', 'x', 'mgarbage', 'zgarbage', 'm'):
+            self.assertEqual(serializer.loads(data), None)
+
+
+class CreateObjectCacheTests(unittest.TestCase):
+
+    """Unit tests for the create_object_cache() function."""
+
+    def setUp(self):
+        """Create a temporary directory for cache files."""
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_no_cache_is_created_unless_requested(self):
+        """Verify that None is returned if no cache is requested."""
+
+        self.assertEqual(caches.create_object_cache(), None)
+
+    def test_single_caches_are_not_tiered(self):
+        """Verify that a single cache is returned as it is."""
+
+        cache = caches.create_object_cache(local_entries=5)
+        self.assertTrue(isinstance(cache, caches.LRUObjectCache))
+        self.assertEqual(cache.max_entries, 5)
+
+    def test_single_caches_are_tiered_for_statistics(self):
+        """Verify that a single cache is tiered if statistics are wanted."""
+
+        cache = caches.create_object_cache(local_entries=5, statistics=True)
+        self.assertTrue(isinstance(cache, caches.TieredObjectCache))
+        self.assertEqual(len(cache.statistics), 1)
+
+    def test_several_caches_are_tiered(self):
+        """Verify that several caches are combined, fastest first."""
+
+        cache = caches.create_object_cache(
+            local_entries=5,
+            filename=os.path.join(self.tmpdir, 'cache.sqlite'),
+            namespace='store')
+        cache.tiers[1].close()
+        self.assertTrue(isinstance(cache, caches.TieredObjectCache))
+        self.assertTrue(isinstance(cache.tiers[0], caches.LRUObjectCache))
+        self.assertTrue(isinstance(cache.tiers[1], caches.SQLiteObjectCache))
+        self.assertEqual(cache.tiers[1].keys.namespace, 'store')
+
+    def test_default_namespaces_are_repository_directory_names(self):
+        """Verify that the default namespace is the repository name."""
+
+        self.assertEqual(caches.default_namespace('/srv/stores/a.git'),
+                         'a.git')
+        self.assertEqual(caches.default_namespace('/srv/stores/b/'), 'b')
+        self.assertEqual(caches.default_namespace('/srv/stores/c/.git'), 'c')
@@ -0,0 +1,130 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Class to expand object references into the objects they point to."""
+
+
+from consonant.store import properties, references
+
+
+class ReferenceExpander(object):
+
+    """Expands object references into the objects they point to.
+
+    References are expanded level by level. All objects referenced on
+    one level are looked up with a single objects_by_uuid() call, and
+    objects that were looked up once are remembered for the lifetime
+    of the expander, so that every object is only loaded once.
+
+    Only references to objects in the same commit are expanded.
+    References pointing to a different ref or service are left
+    untouched, as are references to objects that do not exist and
+    references that would lead back to an object that is already
+    being expanded further up (cycles). At most max_fanout references
+    are expanded per property and at most max_depth levels deep.
+
+    """
+
+    def __init__(self, service, commit, max_depth=3, max_fanout=100):
+        self.service = service
+        self.commit = commit
+        self.max_depth = max_depth
+        self.max_fanout = max_fanout
+        self.objects = {}
+
+    def expand(self, objects, names=None, depth=1):
+        """Return dictionaries for objects with their references expanded.
+
+        Only references in properties whose names are in names are
+        expanded, unless names is None, in which case all reference
+        and reference list properties are expanded.
+
+        """
+
+        depth = max(0, min(depth, self.max_depth))
+
+        for obj in objects:
+            self.objects[obj.uuid] = obj
+
+        level = [self._node(obj, frozenset()) for obj in objects]
+        results = [data for data, _ in level]
+
+        for _ in xrange(depth):
+            slots = []
+            for data, ancestors in level:
+                slots.extend(self._slots(data, names, ancestors))
+            if not slots:
+                break
+
+            self._load(set(reference.uuid for _, _, reference, _ in slots))
+
+            level = []
+            for container, key, reference, ancestors in slots:
+                target = self.objects.get(reference.uuid, None)
+                if target is not None:
+                    data, target_ancestors = self._node(target, ancestors)
+                    container[key] = data
+                    level.append((data, target_ancestors))
+
+        return results
+
+    def _node(self, obj, ancestors):
+        props = {}
+        for name, prop in obj.properties.iteritems():
+            if isinstance(prop.value, list):
+                props[name] = list(prop.value)
+            else:
+                props[name] = prop.value
+        data = {'uuid': obj.uuid, 'class': obj.klass.name, 'properties': props}
+        return data, ancestors | frozenset([obj.uuid])
+
+    def _slots(self, data, names, ancestors):
+        slots = []
+        for name, value in sorted(data['properties'].iteritems()):
+            if names is not None and name not in names:
+                continue
+            if isinstance(value, list):
+                count = 0
+                for index, element in enumerate(value):
+                    reference = self._expandable(element, ancestors)
+                    if reference:
+                        if count >= self.max_fanout:
+                            break
+                        slots.append((value, index, reference, ancestors))
+                        count += 1
+            else:
+                reference = self._expandable(value, ancestors)
+                if reference:
+                    slots.append(
+                        (data['properties'], name, reference, ancestors))
+        return slots
+
+    def _expandable(self, value, ancestors):
+        if isinstance(value, properties.ReferenceProperty):
+            value = value.value
+        if not isinstance(value, references.Reference):
+            return None
+        if value.service or value.ref or value.uuid in ancestors:
+            return None
+        return value
+
+    def _load(self, uuids):
+        missing = [uuid for uuid in uuids if uuid not in self.objects]
+        if missing:
+            found = self.service.objects_by_uuid(self.commit, missing)
+            for uuid in missing:
+                self.objects[uuid] = found.get(uuid, None)
@@ -0,0 +1,189 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for the ReferenceExpander class."""
+
+
+import unittest
+
+from consonant.store import expanders, objects, properties, references
+
+
+class FakeService(object):
+
+    """A service that serves objects from a dictionary and counts lookups."""
+
+    def __init__(self, objs):
+        self.objs = dict((obj.uuid, obj) for obj in objs)
+        self.lookups = []
+
+    def objects_by_uuid(self, commit, uuids):
+        """Return a UUID to object dict for a number of objects."""
+
+        self.lookups.append(sorted(uuids))
+        return dict((uuid, self.objs[uuid])
+                    for uuid in uuids if uuid in self.objs)
+
+
+class ReferenceExpanderTests(unittest.TestCase):
+
+    """Unit tests for the ReferenceExpander class."""
+
+    def setUp(self):
+        """Initialise helper variables for the tests."""
+
+        self.lane_class = objects.ObjectClass('lane', [])
+        self.card_class = objects.ObjectClass('card', [])
+
+        self.cards = [
+            self._card('card-1', 'lane-1'),
+            self._card('card-2', 'lane-1'),
+            self._card('card-3', 'lane-1'),
+            ]
+        self.lane = self._lane('lane-1', ['card-1', 'card-2', 'card-3'])
+        self.service = FakeService(self.cards + [self.lane])
+
+    def _reference(self, uuid, service=None, ref=None):
+        return references.Reference(uuid, service, ref)
+
+    def _card(self, uuid, lane):
+        return objects.Object(
+            (uuid, 'card'), uuid, self.card_class, [
+                properties.TextProperty('title', uuid),
+                properties.ReferenceProperty(
+                    'lane', self._reference(lane)),
+                ])
+
+    def _lane(self, uuid, cards):
+        return objects.Object(
+            (uuid, 'lane'), uuid, self.lane_class, [
+                properties.TextProperty('title', uuid),
+                properties.ListProperty('cards', [
+                    properties.ReferenceProperty(
+                        'cards', self._reference(card))
+                    for card in cards]),
+                ])
+
+    def test_depth_zero_only_converts_objects_into_dicts(self):
+        """Verify that nothing is expanded with a depth of zero."""
+
+        expander = expanders.ReferenceExpander(self.service, None)
+        result = expander.expand([self.lane], depth=0)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['uuid'], 'lane-1')
+        self.assertEqual(result[0]['class'], 'lane')
+        self.assertEqual(result[0]['properties']['title'], 'lane-1')
+        self.assertEqual(self.service.lookups, [])
+
+    def test_reference_properties_are_expanded(self):
+        """Verify that a reference property is replaced by its object."""
+
+        expander = expanders.ReferenceExpander(self.service, None)
+        result = expander.expand([self.cards[0]], ['lane'])
+        lane = result[0]['properties']['lane']
+        self.assertEqual(lane['uuid'], 'lane-1')
+        self.assertEqual(lane['properties']['title'], 'lane-1')
+
+    def test_reference_list_properties_are_expanded(self):
+        """Verify that references in list properties are expanded."""
+
+        expander = expanders.ReferenceExpander(self.service, None)
+        result = expander.expand([self.lane], ['cards'])
+        cards = result[0]['properties']['cards']
+        self.assertEqual(
+            [card['uuid'] for card in cards], ['card-1', 'card-2', 'card-3'])
+
+    def test_objects_of_one_level_are_looked_up_together(self):
+        """Verify that all objects of one level are looked up at once."""
+
+        expander = expanders.ReferenceExpander(self.service, None)
+        expander.expand([self.lane], ['cards'])
+        self.assertEqual(
+            self.service.lookups, [['card-1', 'card-2', 'card-3']])
+
+    def test_objects_are_only_looked_up_once(self):
+        """Verify that objects are not looked up again by an expander."""
+
+        expander = expanders.ReferenceExpander(self.service, None)
+        expander.expand(self.cards[:2], ['lane'])
+        expander.expand(self.cards[2:], ['lane'])
+        self.assertEqual(self.service.lookups, [['lane-1']])
+
+    def test_only_the_requested_properties_are_expanded(self):
+        """Verify that properties not asked for are left untouched."""
+
+        expander = expanders.ReferenceExpander(self.service, None)
+        result = expander.expand([self.cards[0]], ['title'])
+        self.assertEqual(
+            result[0]['properties']['lane'], self._reference('lane-1'))
+
+    def test_cycles_are_not_expanded(self):
+        """Verify that references back to an expanded object are kept."""
+
+        expander = expanders.ReferenceExpander(self.service, None)
+        result = expander.expand([self.lane], ['cards', 'lane'], depth=3)
+        card = result[0]['properties']['cards'][0]
+        self.assertEqual(card['uuid'], 'card-1')
+        self.assertEqual(
+            card['properties']['lane'], self._reference('lane-1'))
+
+    def test_depth_is_limited_by_the_maximum_depth(self):
+        """Verify that references are not expanded beyond the max depth."""
+
+        expander = expanders.ReferenceExpander(
+            self.service, None, max_depth=1)
+        result = expander.expand([self.cards[0]], None, depth=5)
+        lane = result[0]['properties']['lane']
+        self.assertEqual(lane['uuid'], 'lane-1')
+        self.assertEqual(
+            lane['properties']['cards'][1].value, self._reference('card-2'))
+
+    def test_fanout_is_limited_by_the_maximum_fanout(self):
+        """Verify that no more than max_fanout references are expanded."""
+
+        expander = expanders.ReferenceExpander(
+            self.service, None, max_fanout=2)
+        result = expander.expand([self.lane], ['cards'])
+        cards = result[0]['properties']['cards']
+        self.assertEqual(cards[0]['uuid'], 'card-1')
+        self.assertEqual(cards[1]['uuid'], 'card-2')
+        self.assertEqual(cards[2].value, self._reference('card-3'))
+
+    def test_external_references_are_not_expanded(self):
+        """Verify that references to other services or refs are kept."""
+
+        external = self._reference('lane-1', service='other-service')
+        other_ref = self._reference('lane-1', ref='other-branch')
+        card = objects.Object(
+            ('card-4', 'card'), 'card-4', self.card_class, [
+                properties.ReferenceProperty('lane', external),
+                properties.ReferenceProperty('other-lane', other_ref),
+                ])
+        expander = expanders.ReferenceExpander(self.service, None)
+        result = expander.expand([card])
+        self.assertEqual(result[0]['properties']['lane'], external)
+        self.assertEqual(result[0]['properties']['other-lane'], other_ref)
+        self.assertEqual(self.service.lookups, [])
+
+    def test_references_to_missing_objects_are_kept(self):
+        """Verify that references to non-existent objects are kept."""
+
+        card = self._card('card-5', 'lane-2')
+        expander = expanders.ReferenceExpander(self.service, None)
+        result = expander.expand([card], ['lane'])
+        self.assertEqual(
+            result[0]['properties']['lane'], self._reference('lane-2'))
@@ -19,6 +19,14 @@
 
 
 import store
+import changes
+import exporters
+import generators
+import importers
 import loaders
 import transactions
+import trees
 import validate
+import warmers
+import watchers
+import writers
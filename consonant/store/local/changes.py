@@ -0,0 +1,111 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Classes to compute object-level changes between local store trees."""
+
+
+import pygit2
+import yaml
+
+
+class ObjectChange(yaml.YAMLObject):
+
+    """An object that was created, updated or deleted between two trees."""
+
+    yaml_tag = u'!ObjectChange'
+
+    def __init__(self, klass, uuid, old_oid, new_oid):
+        self.klass = klass
+        self.uuid = uuid
+        self.old_oid = old_oid
+        self.new_oid = new_oid
+
+    @property
+    def kind(self):
+        """Return whether the object was "created", "updated" or "deleted"."""
+
+        if self.old_oid is None:
+            return 'created'
+        elif self.new_oid is None:
+            return 'deleted'
+        else:
+            return 'updated'
+
+    def to_dict(self):
+        """Return a dictionary representation of the change."""
+
+        return {
+            'class': self.klass,
+            'uuid': self.uuid,
+            'change': self.kind,
+            }
+
+    @classmethod
+    def to_yaml(cls, dumper, change):
+        """Return a YAML representation of the given change."""
+
+        return dumper.represent_mapping(
+            u'tag:yaml.org,2002:map', change.to_dict())
+
+    @classmethod
+    def to_json(cls, change):
+        """Return a JSON representation of the given change."""
+
+        return change.to_dict()
+
+
+def object_changes(repo, old_tree, new_tree):
+    """Return the object changes between two store trees.
+
+    Class and object trees are compared by their OIDs only, so classes
+    that did not change are skipped without listing their objects and
+    no object properties are loaded. Either tree may be None, in which
+    case all objects of the other tree are reported as created or
+    deleted. The changes are returned sorted by class name and UUID.
+
+    """
+
+    old_classes = _class_entries(old_tree)
+    new_classes = _class_entries(new_tree)
+
+    changes = []
+    for name in sorted(set(old_classes) | set(new_classes)):
+        old_oid = old_classes.get(name, None)
+        new_oid = new_classes.get(name, None)
+        if old_oid != new_oid:
+            old_objects = _object_entries(repo, old_oid)
+            new_objects = _object_entries(repo, new_oid)
+            for uuid in sorted(set(old_objects) | set(new_objects)):
+                old_object_oid = old_objects.get(uuid, None)
+                new_object_oid = new_objects.get(uuid, None)
+                if old_object_oid != new_object_oid:
+                    changes.append(ObjectChange(
+                        name, uuid, old_object_oid, new_object_oid))
+    return changes
+
+
+def _class_entries(tree):
+    if tree is None:
+        return {}
+    return dict((entry.name, entry.oid) for entry in tree
+                if entry.filemode == pygit2.GIT_FILEMODE_TREE)
+
+
+def _object_entries(repo, class_oid):
+    if class_oid is None:
+        return {}
+    return dict((entry.name, entry.oid) for entry in repo[class_oid])
@@ -0,0 +1,161 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for computing object changes between store trees."""
+
+
+import os
+import pygit2
+import shutil
+import tempfile
+import unittest
+import yaml
+
+from consonant.store.local import changes
+
+
+class CountingRepository(object):
+
+    """A repository wrapper that records which objects are looked up."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.lookups = []
+
+    def __getitem__(self, oid):
+        self.lookups.append(oid)
+        return self.repo[oid]
+
+
+class ObjectChangeTests(unittest.TestCase):
+
+    """Unit tests for the ObjectChange class."""
+
+    def test_kind_depends_on_the_old_and_new_oid(self):
+        """Verify that the kind of a change depends on the old/new OIDs."""
+
+        self.assertEqual(
+            changes.ObjectChange('lane', 'uuid', None, 'new').kind,
+            'created')
+        self.assertEqual(
+            changes.ObjectChange('lane', 'uuid', 'old', 'new').kind,
+            'updated')
+        self.assertEqual(
+            changes.ObjectChange('lane', 'uuid', 'old', None).kind,
+            'deleted')
+
+    def test_changes_are_represented_without_oids(self):
+        """Verify that changes are represented by class, UUID and kind."""
+
+        change = changes.ObjectChange('lane', 'uuid', 'old', None)
+        expected = {'class': 'lane', 'uuid': 'uuid', 'change': 'deleted'}
+        self.assertEqual(change.to_dict(), expected)
+        self.assertEqual(changes.ObjectChange.to_json(change), expected)
+        self.assertEqual(yaml.load(yaml.dump(change)), expected)
+
+
+class ObjectChangesTests(unittest.TestCase):
+
+    """Unit tests for the object_changes() function."""
+
+    def setUp(self):
+        """Initialise an empty temporary repository."""
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(self._remove_tempdir)
+        self.repo = pygit2.init_repository(
+            os.path.join(self.tmpdir, 'repo'), bare=True)
+
+    def _remove_tempdir(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _tree(self, classes):
+        builder = self.repo.TreeBuilder()
+        builder.insert('consonant.yaml',
+                       self.repo.create_blob('name: test\n'),
+                       pygit2.GIT_FILEMODE_BLOB)
+        for class_name, objects in classes.iteritems():
+            class_builder = self.repo.TreeBuilder()
+            for uuid, title in objects.iteritems():
+                object_builder = self.repo.TreeBuilder()
+                object_builder.insert(
+                    'properties.yaml',
+                    self.repo.create_blob('title: %s\n' % title),
+                    pygit2.GIT_FILEMODE_BLOB)
+                class_builder.insert(uuid, object_builder.write(),
+                                     pygit2.GIT_FILEMODE_TREE)
+            builder.insert(class_name, class_builder.write(),
+                           pygit2.GIT_FILEMODE_TREE)
+        return self.repo[builder.write()]
+
+    def _summary(self, object_changes):
+        return [(c.klass, c.uuid, c.kind) for c in object_changes]
+
+    def test_identical_trees_have_no_changes(self):
+        """Verify that there are no changes between identical trees."""
+
+        tree = self._tree({'lane': {'a': 'one'}})
+        self.assertEqual(
+            changes.object_changes(self.repo, tree, tree), [])
+
+    def test_created_updated_and_deleted_objects_are_reported(self):
+        """Verify that created, updated and deleted objects are reported."""
+
+        old_tree = self._tree({
+            'card': {'c': 'three', 'd': 'four'},
+            'lane': {'a': 'one', 'b': 'two'},
+            })
+        new_tree = self._tree({
+            'card': {'d': 'four', 'e': 'five'},
+            'lane': {'a': 'one', 'b': 'TWO'},
+            'user': {'f': 'six'},
+            })
+
+        self.assertEqual(
+            self._summary(
+                changes.object_changes(self.repo, old_tree, new_tree)),
+            [('card', 'c', 'deleted'),
+             ('card', 'e', 'created'),
+             ('lane', 'b', 'updated'),
+             ('user', 'f', 'created')])
+
+    def test_all_objects_are_created_without_an_old_tree(self):
+        """Verify that all objects are created if there is no old tree."""
+
+        tree = self._tree({'lane': {'b': 'two', 'a': 'one'}})
+        self.assertEqual(
+            self._summary(changes.object_changes(self.repo, None, tree)),
+            [('lane', 'a', 'created'), ('lane', 'b', 'created')])
+
+    def test_all_objects_are_deleted_without_a_new_tree(self):
+        """Verify that all objects are deleted if there is no new tree."""
+
+        tree = self._tree({'lane': {'a': 'one'}})
+        self.assertEqual(
+            self._summary(changes.object_changes(self.repo, tree, None)),
+            [('lane', 'a', 'deleted')])
+
+    def test_unchanged_classes_are_not_listed(self):
+        """Verify that the objects of unchanged classes are not listed."""
+
+        old_tree = self._tree({'card': {'c': 'three'}, 'lane': {'a': 'one'}})
+        new_tree = self._tree({'card': {'c': 'three'}, 'lane': {'a': 'ONE'}})
+
+        repo = CountingRepository(self.repo)
+        changes.object_changes(repo, old_tree, new_tree)
+        self.assertEqual(
+            repo.lookups, [old_tree['lane'].oid, new_tree['lane'].oid])
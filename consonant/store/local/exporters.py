@@ -0,0 +1,150 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Classes to export objects from local stores in bulk."""
+
+
+import collections
+import json
+import pygit2
+import StringIO
+import tarfile
+import threading
+import yaml
+
+from multiprocessing.pool import ThreadPool
+
+
+try:
+    YAMLLoader = yaml.CSafeLoader
+except AttributeError:
+    YAMLLoader = yaml.SafeLoader
+
+
+class BulkExporter(object):
+
+    """Streams the objects of a commit as newline-delimited JSON.
+
+    Every object is written as one line in the format understood by
+    the BulkImporter, with the keys of all JSON objects sorted. Classes
+    are exported in the order of their names and objects in the order
+    of their UUIDs, so exporting the same commit twice produces exactly
+    the same output.
+
+    Objects are read in parallel by a pool of threads, each with its
+    own repository handle. At most window objects are read ahead of
+    the one being written, so memory use does not grow with the size
+    of the store.
+
+    If a raw stream is given, the data of all raw properties is written
+    to it as an uncompressed tar archive, with one <class>/<uuid>/<name>
+    member per raw property, and the records refer to these members.
+
+    """
+
+    def __init__(self, store, commit, classes=None, jobs=4, window=256):
+        self.store = store
+        self.repo = store.repo
+        self.commit = commit
+        self.classes = classes
+        self.jobs = max(1, jobs)
+        self.window = max(1, window)
+        self.count = 0
+        self.local = threading.local()
+
+    def export(self, stream, raw_stream=None):
+        """Write all objects of the commit to the stream and return them."""
+
+        commit_object = self.repo[self.commit.sha1]
+        self.mtime = commit_object.commit_time
+
+        tar = None
+        if raw_stream is not None:
+            tar = tarfile.open(fileobj=raw_stream, mode='w|')
+
+        pool = ThreadPool(self.jobs)
+        try:
+            pending = collections.deque()
+            for entry in self._object_entries(commit_object.tree):
+                pending.append(pool.apply_async(
+                    self._read_object, entry + (tar is not None,)))
+                if len(pending) >= self.window:
+                    self._write_record(stream, tar, pending.popleft().get())
+            while pending:
+                self._write_record(stream, tar, pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+
+        if tar is not None:
+            tar.close()
+
+        return self.count
+
+    def _object_entries(self, tree):
+        for class_entry in sorted(tree, key=lambda entry: entry.name):
+            if class_entry.filemode != pygit2.GIT_FILEMODE_TREE:
+                continue
+            if self.classes and class_entry.name not in self.classes:
+                continue
+            class_tree = self.repo[class_entry.oid]
+            for object_entry in sorted(class_tree, key=lambda e: e.name):
+                yield class_entry.name, object_entry.name, object_entry.oid
+
+    def _thread_repo(self):
+        # pygit2 repositories must not be shared between threads, so
+        # every worker thread opens the repository on its own
+        if not hasattr(self.local, 'repo'):
+            self.local.repo = pygit2.Repository(self.repo.path)
+        return self.local.repo
+
+    def _read_object(self, klass, uuid, object_oid, with_raw):
+        repo = self._thread_repo()
+        object_tree = repo[object_oid]
+
+        props = {}
+        if 'properties.yaml' in object_tree:
+            blob = repo[object_tree['properties.yaml'].oid]
+            props = yaml.load(blob.data, Loader=YAMLLoader) or {}
+
+        record = {'class': klass, 'uuid': uuid, 'properties': props}
+
+        raw = []
+        if with_raw and 'raw' in object_tree:
+            record['raw'] = {}
+            raw_tree = repo[object_tree['raw'].oid]
+            for raw_entry in sorted(raw_tree, key=lambda e: e.name):
+                path = '%s/%s/%s' % (klass, uuid, raw_entry.name)
+                record['raw'][raw_entry.name] = path
+                raw.append((path, raw_entry.oid))
+
+        return record, raw
+
+    def _write_record(self, stream, tar, result):
+        record, raw = result
+        stream.write(json.dumps(record, sort_keys=True, default=str))
+        stream.write('\n')
+
+        for path, oid in raw:
+            blob = self.repo[oid]
+            info = tarfile.TarInfo(path)
+            info.size = blob.size
+            info.mtime = self.mtime
+            info.mode = 0644
+            tar.addfile(info, StringIO.StringIO(blob.data))
+
+        self.count += 1
@@ -0,0 +1,333 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Classes to generate synthetic local stores for benchmarking."""
+
+
+import os
+import pygit2
+import random
+import uuid
+import yaml
+
+from consonant.store.local import trees
+
+
+try:
+    YAMLDumper = yaml.CSafeDumper
+except AttributeError:
+    YAMLDumper = yaml.SafeDumper
+
+
+property_types = ('boolean', 'int', 'float', 'text', 'timestamp',
+                  'reference', 'raw', 'text-list', 'reference-list')
+
+
+class StoreGenerator(object):
+
+    """Generates local stores of configurable size with random content.
+
+    The store has the given number of classes, each with the given
+    number of objects. Every class has the same mix of properties, given
+    as a dictionary mapping property types (see property_types) to the
+    number of properties of that type. References point to objects of
+    the next class, lists have list_length elements and raw properties
+    have raw_size bytes of data.
+
+    The first commit creates all objects. Each of the history - 1 later
+    commits updates the text properties of changes_per_commit random
+    objects. The same seed always generates the same store.
+
+    """
+
+    def __init__(self, name='org.example.benchmark',
+                 schema_name='org.example.benchmark.1', classes=3,
+                 objects=100, properties=None, list_length=5,
+                 raw_size=1024, history=1, changes_per_commit=10, seed=0):
+        self.parameters = {
+            'name': name, 'schema_name': schema_name, 'classes': classes,
+            'objects': objects, 'properties': properties,
+            'list_length': list_length, 'raw_size': raw_size,
+            'history': history, 'changes_per_commit': changes_per_commit,
+            'seed': seed,
+            }
+        self.name = name
+        self.schema_name = schema_name
+        self.class_names = ['class-%d' % (i + 1) for i in xrange(classes)]
+        self.objects = objects
+        self.properties = properties if properties is not None else {
+            'boolean': 1, 'int': 1, 'float': 1, 'text': 3, 'timestamp': 1,
+            'reference': 1, 'raw': 1, 'text-list': 1, 'reference-list': 1}
+        self.parameters['properties'] = self.properties
+        self.list_length = list_length
+        self.raw_size = raw_size
+        self.history = history
+        self.changes_per_commit = changes_per_commit
+        self.random = random.Random(seed)
+        self.uuids = {}
+        self.time = 1380539061
+
+        for prop_type in self.properties:
+            if prop_type not in property_types:
+                raise ValueError('Unknown property type: %s' % prop_type)
+
+    def property_names(self, prop_type):
+        """Return the names of all properties of a type."""
+
+        return ['%s-%d' % (prop_type, i + 1)
+                for i in xrange(self.properties.get(prop_type, 0))]
+
+    def schema(self):
+        """Return the schema of the store as a dictionary."""
+
+        classes = {}
+        for index, class_name in enumerate(self.class_names):
+            target = self.class_names[(index + 1) % len(self.class_names)]
+            props = {}
+            for prop_type in property_types:
+                for prop_name in self.property_names(prop_type):
+                    props[prop_name] = self._property_definition(
+                        prop_type, target)
+            classes[class_name] = {'properties': props}
+        return {'name': self.schema_name, 'classes': classes}
+
+    def _property_definition(self, prop_type, target):
+        if prop_type == 'reference':
+            return {'type': 'reference', 'class': target}
+        elif prop_type == 'text-list':
+            return {'type': 'list', 'elements': {'type': 'text'}}
+        elif prop_type == 'reference-list':
+            return {'type': 'list',
+                    'elements': {'type': 'reference', 'class': target}}
+        else:
+            return {'type': prop_type}
+
+    def write_schema(self, filename):
+        """Write the schema of the store to a YAML file."""
+
+        with open(filename, 'w') as f:
+            yaml.dump(self.schema(), f, Dumper=YAMLDumper,
+                      default_flow_style=False)
+
+    def write_register(self, config_dir, schema_filename):
+        """Write a register that maps the schema name to a schema file.
+
+        The register is written to consonant/register.yaml in the given
+        directory, which can be used as XDG_CONFIG_HOME.
+
+        """
+
+        directory = os.path.join(config_dir, 'consonant')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        register = {'schemas': {
+            self.schema_name: 'file://%s' % os.path.abspath(schema_filename)}}
+        with open(os.path.join(directory, 'register.yaml'), 'w') as f:
+            yaml.dump(register, f, Dumper=YAMLDumper,
+                      default_flow_style=False)
+
+    def generate_directory(self, directory):
+        """Generate the store with its schema and a register in a directory.
+
+        The store repository is generated in the store subdirectory, the
+        schema is written to schema.yaml, a register for it to config,
+        which can be used as XDG_CONFIG_HOME, and the parameters of the
+        generator to generator.yaml. Returns the path of the store.
+
+        """
+
+        schema_filename = os.path.join(directory, 'schema.yaml')
+        self.write_schema(schema_filename)
+        self.write_register(os.path.join(directory, 'config'),
+                            schema_filename)
+        with open(os.path.join(directory, 'generator.yaml'), 'w') as f:
+            yaml.dump(self.parameters, f, Dumper=YAMLDumper,
+                      default_flow_style=False)
+        path = os.path.join(directory, 'store')
+        self.generate(path)
+        return path
+
+    @classmethod
+    def from_directory(cls, directory):
+        """Return a generator with the parameters used for a directory.
+
+        The UUIDs of the generated objects are not restored.
+
+        """
+
+        with open(os.path.join(directory, 'generator.yaml')) as f:
+            return cls(**yaml.safe_load(f))
+
+    def generate(self, path, bare=False):
+        """Generate the store in a new repository and return the repository.
+
+        All commits are made on refs/heads/master.
+
+        """
+
+        repo = pygit2.init_repository(path, bare)
+
+        for class_name in self.class_names:
+            self.uuids[class_name] = sorted(
+                str(uuid.UUID(int=self.random.getrandbits(128)))
+                for _ in xrange(self.objects))
+
+        # create all objects in the first commit
+        builder = repo.TreeBuilder()
+        meta = yaml.dump({'name': self.name, 'schema': self.schema_name},
+                         Dumper=YAMLDumper, default_flow_style=False)
+        builder.insert('consonant.yaml', repo.create_blob(meta),
+                       pygit2.GIT_FILEMODE_BLOB)
+        for index, class_name in enumerate(self.class_names):
+            target = self.class_names[(index + 1) % len(self.class_names)]
+            class_builder = repo.TreeBuilder()
+            for object_uuid in self.uuids[class_name]:
+                class_builder.insert(
+                    object_uuid, self._write_object(repo, target),
+                    pygit2.GIT_FILEMODE_TREE)
+            builder.insert(class_name, class_builder.write(),
+                           pygit2.GIT_FILEMODE_TREE)
+        tree = repo[builder.write()]
+        commit_oid = self._commit(repo, tree, [], 'Generate store')
+
+        # update a few objects in every later commit
+        for number in xrange(1, self.history):
+            staged = trees.StagedTree(repo, tree)
+            for _ in xrange(self.changes_per_commit):
+                index = self.random.randrange(len(self.class_names))
+                class_name = self.class_names[index]
+                target = self.class_names[
+                    (index + 1) % len(self.class_names)]
+                object_uuid = self.random.choice(self.uuids[class_name])
+                staged.insert_object(
+                    class_name, object_uuid,
+                    self._write_object(repo, target))
+            tree = staged.write()
+            commit_oid = self._commit(
+                repo, tree, [commit_oid], 'Update objects %d' % number)
+
+        repo.create_reference('refs/heads/master', commit_oid, force=True)
+        return repo
+
+    def _commit(self, repo, tree, parents, message):
+        self.time += 60
+        signature = pygit2.Signature(
+            'Benchmark', 'benchmark@example.org', self.time, 0)
+        return repo.create_commit(
+            None, signature, signature, message, tree.oid, parents)
+
+    def _write_object(self, repo, target):
+        props = self.object_properties(target)
+        builder = repo.TreeBuilder()
+        yaml_data = yaml.dump(props, Dumper=YAMLDumper,
+                              default_flow_style=False)
+        builder.insert('properties.yaml', repo.create_blob(yaml_data),
+                       pygit2.GIT_FILEMODE_BLOB)
+
+        raw_names = self.property_names('raw')
+        if raw_names:
+            raw_builder = repo.TreeBuilder()
+            for name in raw_names:
+                raw_builder.insert(name, repo.create_blob(self._raw_data()),
+                                   pygit2.GIT_FILEMODE_BLOB)
+            builder.insert('raw', raw_builder.write(),
+                           pygit2.GIT_FILEMODE_TREE)
+        return builder.write()
+
+    def object_properties(self, target):
+        """Return random properties for an object referencing a class.
+
+        Property values are returned the way they are stored in the
+        properties.yaml files of the store.
+
+        """
+
+        rand = self.random
+        props = {}
+        for name in self.property_names('boolean'):
+            props[name] = rand.random() < 0.5
+        for name in self.property_names('int'):
+            props[name] = rand.randint(0, 1000000)
+        for name in self.property_names('float'):
+            props[name] = rand.random() * 1000.0
+        for name in self.property_names('text'):
+            props[name] = self._text()
+        for name in self.property_names('timestamp'):
+            props[name] = '%d +0000' % rand.randint(1000000000, 1400000000)
+        for name in self.property_names('reference'):
+            props[name] = {'uuid': rand.choice(self.uuids[target])}
+        for name in self.property_names('raw'):
+            props[name] = 'application/octet-stream'
+        for name in self.property_names('text-list'):
+            props[name] = [self._text() for _ in xrange(self.list_length)]
+        for name in self.property_names('reference-list'):
+            props[name] = [{'uuid': rand.choice(self.uuids[target])}
+                           for _ in xrange(self.list_length)]
+        return props
+
+    def _text(self):
+        words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+                 'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor')
+        return ' '.join(self.random.choice(words)
+                        for _ in xrange(self.random.randint(1, 12)))
+
+    def _raw_data(self):
+        if self.raw_size <= 0:
+            return ''
+        return ('%0*x' % (2 * self.raw_size,
+                          self.random.getrandbits(8 * self.raw_size))) \
+            .decode('hex')
+
+    def update_transaction(self, source, count):
+        """Return a transaction updating count objects of the store.
+
+        The transaction is returned as a multipart/mixed message based
+        on the source commit SHA1 and targeting master. The text
+        properties of randomly chosen objects of the first class are
+        updated. The store must have been generated first.
+
+        """
+
+        uuids = self.uuids[self.class_names[0]]
+        parts = [{'action': 'begin', 'source': source}]
+        for object_uuid in self.random.sample(uuids, min(count, len(uuids))):
+            parts.append({
+                'action': 'update',
+                'object': {'uuid': object_uuid},
+                'properties': dict((name, self._text()) for name
+                                   in self.property_names('text')),
+                })
+        self.time += 60
+        parts.append({
+            'action': 'commit',
+            'target': 'master',
+            'author': 'Benchmark <benchmark@example.org>',
+            'author-date': '%d +0000' % self.time,
+            'committer': 'Benchmark <benchmark@example.org>',
+            'committer-date': '%d +0000' % self.time,
+            'message': 'Update %d objects' % count,
+            })
+
+        lines = ['Content-Type: multipart/mixed; boundary=CONSONANT', '']
+        for part in parts:
+            lines.extend(['--CONSONANT',
+                          'Content-Type: application/x-yaml',
+                          '',
+                          yaml.dump(part, Dumper=YAMLDumper,
+                                    default_flow_style=False)])
+        lines.append('--CONSONANT--')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,341 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Classes to import objects into local stores in bulk."""
+
+
+import json
+import os
+import pygit2
+import tarfile
+import yaml
+
+from consonant.schema import definitions
+from consonant.store.local import trees
+from consonant.util import expressions
+from consonant.util.phase import Phase
+
+
+try:
+    YAMLDumper = yaml.CSafeDumper
+except AttributeError:
+    YAMLDumper = yaml.SafeDumper
+
+
+class RecordError(Exception):
+
+    """Base class for errors in records of a bulk import."""
+
+    def __init__(self, line):
+        self.line = line
+
+    def __str__(self):
+        return 'Line %d: %s' % (self.line, self._msg())
+
+    def _msg(self):  # pragma: no cover
+        raise NotImplementedError
+
+
+class RecordInvalidError(RecordError):
+
+    """Exception for when a record is not a valid JSON object."""
+
+    def __init__(self, line, msg):
+        RecordError.__init__(self, line)
+        self.msg = msg
+
+    def _msg(self):
+        return 'Record is invalid: %s' % self.msg
+
+
+class RecordClassUnknownError(RecordError):
+
+    """Exception for when a record refers to a class not in the schema."""
+
+    def __init__(self, line, klass):
+        RecordError.__init__(self, line)
+        self.klass = klass
+
+    def _msg(self):
+        return 'Record refers to a class unknown in the schema: %s' % \
+            self.klass
+
+
+class RecordUUIDInvalidError(RecordError):
+
+    """Exception for when a record has an invalid object UUID."""
+
+    def __init__(self, line, uuid):
+        RecordError.__init__(self, line)
+        self.uuid = uuid
+
+    def _msg(self):
+        return 'Record has an invalid object UUID: %s' % self.uuid
+
+
+class RecordUUIDExistsError(RecordError):
+
+    """Exception for when a record has the UUID of an existing object."""
+
+    def __init__(self, line, uuid):
+        RecordError.__init__(self, line)
+        self.uuid = uuid
+
+    def _msg(self):
+        return 'Record has the UUID of an existing object: %s' % self.uuid
+
+
+class RecordPropertyUnknownError(RecordError):
+
+    """Exception for when a record sets a property not in its class."""
+
+    def __init__(self, line, klass, property_name):
+        RecordError.__init__(self, line)
+        self.klass = klass
+        self.property_name = property_name
+
+    def _msg(self):
+        return 'Record sets a property unknown in class "%s": %s' % \
+            (self.klass, self.property_name)
+
+
+class RecordMandatoryPropertyNotSetError(RecordError):
+
+    """Exception for when a record does not set a mandatory property."""
+
+    def __init__(self, line, klass, property_name):
+        RecordError.__init__(self, line)
+        self.klass = klass
+        self.property_name = property_name
+
+    def _msg(self):
+        return 'Record does not set mandatory property of class "%s": %s' % \
+            (self.klass, self.property_name)
+
+
+class RecordRawDataInvalidError(RecordError):
+
+    """Exception for when raw data of a record is missing or not allowed."""
+
+    def __init__(self, line, property_name, msg):
+        RecordError.__init__(self, line)
+        self.property_name = property_name
+        self.msg = msg
+
+    def _msg(self):
+        return 'Raw data for property "%s" %s' % (self.property_name, self.msg)
+
+
+class DirectoryRawSource(object):
+
+    """Reads raw property data from files in a directory."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def read(self, name):
+        """Return the data of a file in the directory or None."""
+
+        filename = os.path.normpath(os.path.join(self.path, name))
+        if not filename.startswith(self.path + os.sep):
+            return None
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return f.read()
+
+
+class TarRawSource(object):
+
+    """Reads raw property data from members of a tar archive."""
+
+    def __init__(self, path):
+        self.tar = tarfile.open(path)
+        self.members = dict(
+            (os.path.normpath(member.name), member)
+            for member in self.tar.getmembers() if member.isfile())
+
+    def read(self, name):
+        """Return the data of a member of the archive or None."""
+
+        member = self.members.get(os.path.normpath(name), None)
+        if member is None:
+            return None
+        return self.tar.extractfile(member).read()
+
+
+class BulkImporter(object):
+
+    """Imports objects from a stream of records into one commit of a store.
+
+    Records are read one line at a time from newline-delimited JSON,
+    each line being an object like this:
+
+        {"class": "card", "uuid": "...", "properties": {...},
+         "raw": {"property": "path/in/raw/source"}}
+
+    The "uuid" and "raw" fields are optional. Property values use the
+    same representation as in the properties.yaml files of the store,
+    so raw properties are set to their content type, and the data of
+    each raw property is read from the given raw source.
+
+    Records are checked against the schema of the target ref as they
+    are read and the blobs and object trees are written immediately.
+    The class trees and the root tree are only written once all records
+    have been imported, and a single commit is created for them.
+
+    """
+
+    def __init__(self, store, target, raw_source=None):
+        self.store = store
+        self.repo = store.repo
+        self.target = target
+        self.raw_source = raw_source
+        self.count = 0
+
+    def prepare_import(self, stream, author, committer, message):
+        """Create and return a commit with all objects from the stream."""
+
+        # obtain the head of the target ref, the import is based on it
+        ref = self.store.ref(self.target)
+        self.ref_name = ref.name
+        self.source = ref.head
+        source_object = self.repo[self.source.sha1]
+
+        # load the schema of the commit
+        schema = self.store.schema(self.source)
+
+        # write objects for all records and stage them
+        staged = trees.StagedTree(self.repo, source_object.tree)
+        self.uuids = set()
+        with Phase() as phase:
+            for line, data in enumerate(stream, 1):
+                data = data.strip()
+                if data:
+                    self._import_line(phase, schema, staged, line, data)
+
+        # write the class trees and the resulting store tree
+        tree = staged.write()
+
+        # create a commit for the resulting tree
+        commit_oid = self.repo.create_commit(
+            None, author, committer, message, tree.oid, [source_object.oid])
+        return self.store.commit(commit_oid.hex)
+
+    def _import_line(self, phase, schema, staged, line, data):
+        try:
+            record = json.loads(data)
+        except ValueError, e:
+            phase.error(RecordInvalidError(line, str(e)))
+            return
+
+        if not isinstance(record, dict) or 'class' not in record:
+            phase.error(RecordInvalidError(line, 'no class specified'))
+            return
+
+        props = record.get('properties', {})
+        raw = record.get('raw', {})
+        if not isinstance(props, dict) or not isinstance(raw, dict):
+            phase.error(RecordInvalidError(
+                line, 'properties and raw data must be JSON objects'))
+            return
+
+        klass = record['class']
+        if klass not in schema.classes:
+            phase.error(RecordClassUnknownError(line, klass))
+            return
+
+        uuid = record.get('uuid', None)
+        if uuid is None:
+            uuid = self.store.generate_uuid(self.source, klass)
+        elif not isinstance(uuid, basestring) \
+                or not expressions.object_uuid.match(uuid):
+            phase.error(RecordUUIDInvalidError(line, uuid))
+            return
+        elif uuid in self.uuids or staged.object_oid(klass, uuid):
+            phase.error(RecordUUIDExistsError(line, uuid))
+            return
+
+        errors = len(phase.errors)
+        self._validate_record(phase, schema.classes[klass], line, props, raw)
+        if len(phase.errors) > errors:
+            return
+
+        raw_data = {}
+        for name, path in raw.iteritems():
+            data = None
+            if self.raw_source and isinstance(path, basestring):
+                data = self.raw_source.read(path)
+            if data is None:
+                phase.error(RecordRawDataInvalidError(
+                    line, name, 'not found: %s' % path))
+            else:
+                raw_data[name] = data
+        if len(phase.errors) > errors:
+            return
+
+        object_oid = self._write_object_tree(props, raw_data)
+        staged.insert_object(klass, uuid, object_oid)
+        self.uuids.add(uuid)
+        self.count += 1
+
+    def _validate_record(self, phase, class_def, line, props, raw):
+        for name in props.iterkeys():
+            if name not in class_def.properties:
+                phase.error(RecordPropertyUnknownError(
+                    line, class_def.name, name))
+
+        for name, prop_def in class_def.properties.iteritems():
+            if not prop_def.optional and name not in props:
+                phase.error(RecordMandatoryPropertyNotSetError(
+                    line, class_def.name, name))
+
+            if isinstance(prop_def, definitions.RawPropertyDefinition):
+                if name in props and name not in raw:
+                    phase.error(RecordRawDataInvalidError(
+                        line, name, 'is missing'))
+                elif name in raw and name not in props:
+                    phase.error(RecordRawDataInvalidError(
+                        line, name, 'has no content type'))
+            elif name in raw:
+                phase.error(RecordRawDataInvalidError(
+                    line, name, 'is set for a non-raw property'))
+
+        for name in raw.iterkeys():
+            if name not in class_def.properties:
+                phase.error(RecordPropertyUnknownError(
+                    line, class_def.name, name))
+
+    def _write_object_tree(self, props, raw_data):
+        # generate the properties.yaml blob
+        yaml_data = yaml.dump(props, Dumper=YAMLDumper,
+                              default_flow_style=False)
+        blob_oid = self.repo.create_blob(yaml_data)
+
+        builder = self.repo.TreeBuilder()
+        builder.insert('properties.yaml', blob_oid, pygit2.GIT_FILEMODE_BLOB)
+
+        # generate the raw tree with a blob for every raw property
+        if raw_data:
+            raw_builder = self.repo.TreeBuilder()
+            for name, data in raw_data.iteritems():
+                raw_oid = self.repo.create_blob(data)
+                raw_builder.insert(name, raw_oid, pygit2.GIT_FILEMODE_BLOB)
+            builder.insert(
+                'raw', raw_builder.write(), pygit2.GIT_FILEMODE_TREE)
+
+        return builder.write()
@@ -19,16 +19,34 @@
 
 
 import pygit2
+import threading
+import time
 import urllib2
 import yaml
 
 from consonant import schema
 from consonant.service import services
 from consonant.store import objects, properties, references
-from consonant.util import expressions
+from consonant.util import expressions, timing
 from consonant.util.phase import Phase
 
 
+_local = threading.local()
+
+
+def set_lease_waiting(allowed):
+    """Allow or forbid waiting for cache leases in the current thread.
+
+    Threads that must not block, e.g. the thread running the event loop
+    of a web service, should forbid waiting. Loaders running in them
+    load entries leased by someone else straight away, without writing
+    them to the cache, instead of waiting for them to show up in it.
+
+    """
+
+    _local.lease_waiting = allowed
+
+
 class LoaderError(Exception):
 
     """Exception for when a commit in a local store is invalid."""
@@ -371,6 +389,9 @@ class LoaderContext(Phase):
         self.uuid = None
         self.schema = None
         self.in_list_property = False
+        self.cached_properties = None
+        self.uncached_properties = None
+        self.leased_properties = None
 
     def set_commit(self, commit):
         """Set the commit that is currently being loaded from."""
@@ -398,21 +419,55 @@ class LoaderContext(Phase):
 
         self.schema = schema
 
+    def set_cached_properties(self, properties, leased=None):
+        """Set object properties prefetched from a cache or None.
+
+        The properties are a dictionary that maps UUID and SHA1 tuples
+        to object properties. Properties loaded while this is set are
+        collected in uncached_properties instead of being written to
+        the cache one by one. Leased is the set of UUID and SHA1 tuples
+        for which cache leases are held.
+
+        """
+
+        self.cached_properties = properties
+        self.uncached_properties = {} if properties is not None else None
+        self.leased_properties = leased
+
 
 class Loader(object):
 
     """A non-validating loder for local store repositories."""
 
-    def __init__(self, store):
+    # raw property data larger than this is not written to the cache, so
+    # that a few large files cannot push everything else out of it
+    max_cached_raw_data_size = 10 * 1024 * 1024
+
+    # cache leases expire after lease_ttl seconds; entries leased by
+    # someone else are waited for up to lease_wait seconds, polling the
+    # cache every lease_poll_interval seconds, before loading them anyway,
+    # unless waiting is forbidden in the current thread
+    lease_ttl = 5
+    lease_wait = 0.2
+    lease_poll_interval = 0.01
+
+    def __init__(self, store, repo=None):
         self.store = store
-        self.repo = store.repo
+        self.repo = repo or store.repo
         self.register = store.register
         self.cache = None
 
-    def set_cache(self, cache):
-        """Make the loader use a cache for loading objects."""
+    def set_cache(self, cache, max_raw_data_size=None):
+        """Make the loader use a cache for loading objects.
+
+        If max_raw_data_size is set, raw property data larger than that
+        number of bytes bypasses the cache.
+
+        """
 
         self.cache = cache
+        if max_raw_data_size is not None:
+            self.max_cached_raw_data_size = max_raw_data_size
 
     def name(self, commit):
         """Return the name the store has in the given commit."""
@@ -478,6 +533,13 @@ class Loader(object):
                         commit, uuid))
             return object
 
+    def objects_by_uuid(self, commit, uuids):
+        """Return a UUID to object dict for a number of objects in a commit."""
+
+        with LoaderContext(self) as context:
+            context.set_commit(commit)
+            return self.objects_by_uuid_in_tree(context, uuids)
+
     def raw_property_data(self, commit, object, property):
         """Return raw data for an object property in a given commit."""
 
@@ -502,8 +564,61 @@ class Loader(object):
         raw_entry = object_tree['raw']
         raw_tree = self.repo[raw_entry.oid]
         data_entry = raw_tree[property]
-        data_blob = self.repo[data_entry.oid]
-        return data_blob.data
+
+        # raw data is cached by blob SHA1, so identical data is only
+        # cached once, no matter which objects or commits it is used in
+        sha1 = data_entry.oid.hex
+        if not self.cache:
+            return self.blob_data(data_entry.oid)
+
+        with timing.measure('cache'):
+            data = self.cache.read_raw_property_data(sha1)
+        if data is not None:
+            return data
+
+        # only load the data into the cache if no one else is doing that
+        # already; otherwise wait for them briefly
+        with timing.measure('cache'):
+            leased = self.cache.acquire_raw_property_data_lease(
+                sha1, self.lease_ttl)
+        if not leased:
+            with timing.measure('cache'):
+                deadline = time.time() + self._lease_wait()
+                while data is None and time.time() < deadline:
+                    time.sleep(self.lease_poll_interval)
+                    data = self.cache.read_raw_property_data(sha1)
+            if data is None:
+                data = self.blob_data(data_entry.oid)
+            return data
+
+        try:
+            data = self.blob_data(data_entry.oid)
+            if len(data) <= self.max_cached_raw_data_size:
+                with timing.measure('cache'):
+                    self.cache.write_raw_property_data(sha1, data)
+            return data
+        finally:
+            with timing.measure('cache'):
+                self.cache.release_raw_property_data_lease(sha1)
+
+    def _lease_wait(self):
+        if getattr(_local, 'lease_waiting', True):
+            return self.lease_wait
+        else:
+            return 0
+
+    def blob_data(self, oid):
+        """Return the data of a blob in the store repository.
+
+        The read is recorded as a git object database read, with its
+        size, if a timer is active.
+
+        """
+
+        with timing.measure('odb') as measurement:
+            data = self.repo[oid].data
+            measurement.size = len(data)
+        return data
 
     def _metadata_in_tree(self, context):
         """Return the raw meta data in the given tree of the store."""
@@ -516,9 +631,10 @@ class Loader(object):
         if entry.filemode != pygit2.GIT_FILEMODE_BLOB:
             context.error(MetaDataNotAFileError(context), now=True)
 
-        blob = self.repo[entry.oid]
+        blob_data = self.blob_data(entry.oid)
         try:
-            data = yaml.load(blob.data)
+            with timing.measure('yaml'):
+                data = yaml.load(blob_data)
         except Exception, e:
             context.error(MetaDataInvalidError(context, e.message), now=True)
 
@@ -553,10 +669,11 @@ class Loader(object):
         elif not expressions.schema_name.match(data['schema']):
             raise SchemaNameInvalidError(context, data['schema'])
 
-        name = data['schema']
-        url = self.register.schema_url(name)
-        stream = urllib2.urlopen(url)
-        return schema.parsers.SchemaParser().parse(stream)
+        with timing.measure('schema'):
+            name = data['schema']
+            url = self.register.schema_url(name)
+            stream = urllib2.urlopen(url)
+            return schema.parsers.SchemaParser().parse(stream)
 
     def services_in_tree(self, context):
         """Return the service aliases used in the given tree of the store."""
@@ -626,6 +743,48 @@ class Loader(object):
                     return object
             return None
 
+    def objects_by_uuid_in_tree(self, context, uuids):
+        """Return a UUID to object dict for objects in a tree of the store.
+
+        The UUIDs are grouped by the class tree they are found in, so
+        that the schema is loaded only once and every class is only
+        looked at once, no matter how many objects are requested.
+        UUIDs that are not present in the tree are left out.
+
+        """
+
+        remaining = set(uuids)
+        if not remaining:
+            return {}
+
+        schema = self.schema_in_tree(context)
+        context.set_schema(schema)
+
+        objects = {}
+        for class_entry in context.tree:
+            if not remaining:
+                break
+            if class_entry.name == 'consonant.yaml':
+                continue
+            if class_entry.filemode != pygit2.GIT_FILEMODE_TREE:
+                continue
+
+            class_tree = self.repo[class_entry.oid]
+            found = [uuid for uuid in remaining if uuid in class_tree]
+            if found:
+                klass = self.class_in_tree(context, class_entry)
+                context.set_class(klass)
+                object_entries = [class_tree[uuid] for uuid in found]
+                self.prefetch_properties_data(context, object_entries)
+                try:
+                    for object_entry in object_entries:
+                        objects[object_entry.name] = \
+                            self.object_data_in_tree(context, object_entry)
+                finally:
+                    self.write_prefetched_properties_data(context)
+                remaining.difference_update(found)
+        return objects
+
     def class_object_in_tree(self, context):
         """Return the object of the given class and tree from the store."""
 
@@ -653,9 +812,14 @@ class Loader(object):
 
         class_tree_entry = context.tree[context.klass.name]
         class_tree = self.repo[class_tree_entry.oid]
+        object_entries = list(class_tree)
+        self.prefetch_properties_data(context, object_entries)
         objects = set()
-        for object_entry in class_tree:
-            objects.add(self.object_data_in_tree(context, object_entry))
+        try:
+            for object_entry in object_entries:
+                objects.add(self.object_data_in_tree(context, object_entry))
+        finally:
+            self.write_prefetched_properties_data(context)
         return objects
 
     def object_data_in_tree(self, context, object_entry):
@@ -709,29 +873,102 @@ class Loader(object):
                 context.error(ObjectPropertiesEntryInvalidError(
                     context, object_entry.name))
             else:
-                properties_sha1 = properties_entry.oid.hex
-                if self.cache:
-                    properties_data = self.cache.read_properties(
-                        object_entry.name, properties_sha1)
+                key = (object_entry.name, properties_entry.oid.hex)
+                if context.cached_properties is not None:
+                    properties_data = context.cached_properties.get(key, None)
+                elif self.cache:
+                    with timing.measure('cache'):
+                        properties_data = self.cache.read_properties(*key)
+                cached = properties_data is not None
                 if properties_data is None:
                     properties_data = self.properties_in_blob_entry(
                         context, object_entry, properties_entry)
                 if not isinstance(properties_data, dict):
                     context.error(ObjectPropertiesNotADictError(
                         context, object_entry))
-                else:
-                    if self.cache:
-                        self.cache.write_properties(
-                            object_entry.name, properties_sha1,
-                            properties_data)
+                elif self.cache and not cached:
+                    # write properties back to the cache, in one go with
+                    # other objects if they were prefetched together
+                    if context.uncached_properties is not None:
+                        context.uncached_properties[key] = properties_data
+                    else:
+                        with timing.measure('cache'):
+                            self.cache.write_properties(
+                                key[0], key[1], properties_data)
         return {} if not properties_data else properties_data
 
+    def prefetch_properties_data(self, context, object_entries):
+        """Look up the properties of several objects in the cache at once.
+
+        The properties found are remembered in the context, so that
+        no further cache lookups are needed while loading the objects.
+        Properties that are not found are written back to the cache
+        by write_prefetched_properties_data().
+
+        Leases are acquired for the properties that are not found, so
+        that only one worker loads them into the cache. Properties
+        leased by someone else are waited for briefly, unless that is
+        forbidden in the current thread (see set_lease_waiting()),
+        before they are loaded without writing them to the cache. The
+        leases are released by write_prefetched_properties_data(), which
+        must therefore be called even if loading the objects fails.
+
+        """
+
+        if not self.cache:
+            return
+
+        keys = []
+        for object_entry in object_entries:
+            if object_entry.filemode == pygit2.GIT_FILEMODE_TREE:
+                object_tree = self.repo[object_entry.oid]
+                if 'properties.yaml' in object_tree:
+                    keys.append((object_entry.name,
+                                 object_tree['properties.yaml'].oid.hex))
+        with timing.measure('cache'):
+            cached = self.cache.read_properties_multi(keys)
+            missing = [key for key in keys if key not in cached]
+            leased = self.cache.acquire_properties_leases(
+                missing, self.lease_ttl)
+            context.set_cached_properties(cached, leased)
+
+            waiting = [key for key in missing if key not in leased]
+            deadline = time.time() + self._lease_wait()
+            while waiting and time.time() < deadline:
+                time.sleep(self.lease_poll_interval)
+                found = self.cache.read_properties_multi(waiting)
+                cached.update(found)
+                waiting = [key for key in waiting if key not in found]
+
+    def write_prefetched_properties_data(self, context):
+        """Write properties that were not found when prefetching to the cache.
+
+        This needs to be called once the objects passed to
+        prefetch_properties_data() have been loaded or failed to load.
+        It releases the leases acquired for them in any case.
+
+        """
+
+        with timing.measure('cache'):
+            try:
+                if self.cache and context.uncached_properties:
+                    self.cache.write_properties_multi(dict(
+                        (key, properties) for key, properties
+                        in context.uncached_properties.iteritems()
+                        if key in context.leased_properties))
+            finally:
+                if self.cache and context.leased_properties:
+                    self.cache.release_properties_leases(
+                        context.leased_properties)
+                context.set_cached_properties(None)
+
     def properties_in_blob_entry(self, context, object_entry, props_entry):
         """Return an object properties dictionary in a blob of the store."""
 
-        blob = self.repo[props_entry.oid]
+        blob_data = self.blob_data(props_entry.oid)
         try:
-            return yaml.load(blob.data)
+            with timing.measure('yaml'):
+                return yaml.load(blob_data)
         except Exception, e:
             context.error(ObjectPropertiesInvalidError(
                 context, object_entry.name, e.message))
@@ -19,31 +19,55 @@
 
 
 import pygit2
+import threading
+import time
 import uuid
 
 from consonant import util
 from consonant.service import services
 from consonant.store import git
-from consonant.store.local import transactions, loaders, validate
+from consonant.store.local import exporters, importers, loaders
+from consonant.store.local import transactions, validate, warmers, watchers
+from consonant.store.local import writers
 from consonant.transaction import validation
-from consonant.util import timestamps
+from consonant.util import timestamps, timing
 
 
 class LocalStore(services.Service):
 
     """Store implementation for local services."""
 
+    # number of times to replay a transaction onto the head of its
+    # target ref if the ref keeps moving on while doing so
+    max_rebase_attempts = 10
+
+    # a ref locked by someone else, e.g. a push or another server
+    # process, is retried after ref_lock_delay seconds, doubling the
+    # delay up to ref_lock_max_delay, until max_rebase_attempts
+    ref_lock_delay = 0.005
+    ref_lock_max_delay = 0.1
+
     def __init__(self, url, register):
         services.Service.__init__(self)
         self.register = register
         self.repo = pygit2.Repository(url)
         self.cache = None
         self.loader = loaders.Loader(self)
+        self.watcher = watchers.RefWatcher(self)
+        self.thread = threading.current_thread()
+        self.local = threading.local()
+        self.coalescer = util.coalescing.Coalescer()
+        self.ref_update_conflicts = 0
+
+    def set_cache(self, cache, max_raw_data_size=None):
+        """Make the store use a cache for loading objects.
 
-    def set_cache(self, cache):
-        """Make the store use a cache for loading objects."""
+        If max_raw_data_size is set, raw property data larger than that
+        number of bytes bypasses the cache.
 
-        self.loader.set_cache(cache)
+        """
+
+        self.loader.set_cache(cache, max_raw_data_size)
 
     def generate_uuid(self, commit, klass):
         """Generate and return a random ID for a new object."""
@@ -64,10 +88,27 @@ class LocalStore(services.Service):
                 refs[ref.name] = git.Ref('branch', ref.name, head)
         return refs
 
+    def ref_heads(self):
+        """Return a dict that maps all Git refs to their head commit SHA1s.
+
+        Unlike refs(), this does not load and parse the head commits
+        and is therefore cheap enough to be called frequently.
+
+        """
+
+        heads = {}
+        for ref in self._list_refs():
+            heads[ref.name] = ref.resolve().target.hex
+        return heads
+
     def ref(self, name):
         """Return the Ref object for a specific Git ref in the store."""
 
-        refs = self.refs()
+        with timing.measure('ref'):
+            refs = self.refs()
+        return self._find_ref(refs, name)
+
+    def _find_ref(self, refs, name):
         if name in refs:
             return refs[name]
         else:
@@ -82,69 +123,158 @@ class LocalStore(services.Service):
     def commit(self, sha1):
         """Return the Commit object for a specific commit in the store."""
 
-        try:
-            commit = self.repo[sha1]
-        except:
-            raise services.CommitNotFoundError(sha1)
-        return self._parse_commit(commit)
+        with timing.measure('ref'):
+            try:
+                commit = self.repo[sha1]
+            except:
+                raise services.CommitNotFoundError(sha1)
+            return self._parse_commit(commit)
 
     def name(self, commit):
         """Return the name the store has in the given commit."""
 
-        return self.loader.name(commit)
+        return self._load('name', commit, ())
 
     def schema(self, commit):
         """Return the schema name the store uses in the given commit."""
 
-        return self.loader.schema(commit)
+        return self._load('schema', commit, ())
 
     def services(self, commit):
         """Return the service aliases used in the store at the given commit."""
 
-        return self.loader.services(commit)
+        return self._load('services', commit, ())
 
     def classes(self, commit):
         """Return the classes present in the given commit of the store."""
 
-        return self.loader.classes(commit)
+        return self._load('classes', commit, ())
 
     def klass(self, commit, name):
         """Return the class for the given name and commit of the store."""
 
-        return self.loader.klass(commit, name)
+        return self._load('klass', commit, (name,), name)
 
     def objects(self, commit, klass=None):
         """Return the objects present in the given commit of the store."""
 
-        return self.loader.objects(commit, klass)
+        return self._load(
+            'objects', commit, (klass.name if klass else None,), klass)
 
     def object(self, commit, uuid, klass=None):
         """Return the object with the given UUID from a commit of the store."""
 
-        return self.loader.object(commit, uuid, klass)
+        return self._load(
+            'object', commit, (uuid, klass.name if klass else None),
+            uuid, klass)
+
+    def objects_by_uuid(self, commit, uuids):
+        """Return a UUID to object dict for a number of objects in a commit.
+
+        UUIDs of objects that are not present in the commit are left out
+        of the returned dictionary.
+
+        """
+
+        return self._load(
+            'objects_by_uuid', commit, (frozenset(uuids),), uuids)
 
     def raw_property_data(self, commit, object, property):
         """Return raw data for an object property in a given commit."""
 
-        return self.loader.raw_property_data(commit, object, property)
+        return self._load(
+            'raw_property_data', commit,
+            (object.klass.name, object.uuid, property), object, property)
+
+    def _load(self, operation, commit, key, *args):
+        """Run a loader operation, sharing the result with identical calls.
+
+        Identical calls made by other threads while the operation is
+        running wait for it and return its result instead of loading
+        the same data again. Calls are identified by the operation,
+        the commit SHA1 and the key. Return the result of the operation.
+
+        """
+
+        return self.coalescer.call(
+            (operation, commit.sha1) + key, self._run_loader, operation,
+            commit, *args)
+
+    def _run_loader(self, operation, commit, *args):
+        return getattr(self._thread_loader(), operation)(commit, *args)
+
+    def _thread_loader(self):
+        """Return a loader that is safe to use in the current thread."""
+
+        # pygit2 repositories must not be shared between threads, so
+        # loading in other threads uses repository handles of their own
+        if threading.current_thread() is self.thread:
+            return self.loader
+        if not hasattr(self.local, 'loader'):
+            self.local.loader = loaders.Loader(
+                self, pygit2.Repository(self.repo.path))
+        self.local.loader.set_cache(
+            self.loader.cache, self.loader.max_cached_raw_data_size)
+        return self.local.loader
 
     def resolve_reference(self, reference, commit=None):
         """Resolve an object reference into an object and return it."""
 
-        # throw an error if the reference is to another store
-        if reference.service:
-            raise services.ExternalReferenceError(self, reference)
+        return self.resolve_references([reference], commit)[0]
 
-        if reference.ref:
-            try:
-                ref = self.ref(reference.ref)
-                commit = ref.head
-            except services.RefNotFoundError:
-                commit = self.commit(reference.ref)
-        else:
-            if not commit:
-                commit = self.ref('master').head
-        return self.object(commit, reference.uuid)
+    def resolve_references(self, references, commit=None):
+        """Resolve object references into objects and return them as a list.
+
+        References are grouped by their ref field. Every ref (or commit)
+        is only resolved once and all UUIDs referring to the same commit
+        are looked up together.
+
+        """
+
+        # throw an error if any of the references is to another store
+        for reference in references:
+            if reference.service:
+                raise services.ExternalReferenceError(self, reference)
+
+        # group the references by the commits they need to be resolved in
+        groups = {}
+        for reference in references:
+            groups.setdefault(reference.ref, set()).add(reference.uuid)
+
+        # resolve every ref once, loading the list of refs only if needed
+        commits = {}
+        refs = None
+        for name in groups.iterkeys():
+            if name:
+                if refs is None:
+                    refs = self.refs()
+                commits[name] = self._resolve_ref_or_commit(refs, name)
+            else:
+                if not commit:
+                    commit = self.ref('master').head
+                commits[name] = commit
+
+        # look up the objects of each group in one pass
+        objects = {}
+        for name, uuids in groups.iteritems():
+            objects[name] = self.objects_by_uuid(commits[name], uuids)
+
+        result = []
+        for reference in references:
+            group = objects[reference.ref]
+            if reference.uuid not in group:
+                raise services.ObjectNotFoundError(
+                    commits[reference.ref], reference.uuid)
+            result.append(group[reference.uuid])
+        return result
+
+    def _resolve_ref_or_commit(self, refs, name):
+        if name in refs:
+            return refs[name].head
+        for ref in refs.itervalues():
+            if name in ref.aliases:
+                return ref.head
+        return self.commit(name)
 
     def _list_refs(self):
         head = self.repo.lookup_reference('HEAD')
@@ -176,32 +306,222 @@ class LocalStore(services.Service):
         validator.add_hook(validate.LocalCommitValidator())
         for hook in hooks:
             validator.add_hook(hook)
-        return self._commit_transaction(transaction, commit, validator)
+        return self._commit_transaction(
+            transaction, commit, validator, hooks)
+
+    def apply_transactions(self, transactions, hooks=[]):
+        """Validate and apply several transactions in the order given.
+
+        The transactions are grouped by their target refs and every ref
+        is updated only once, with the transactions that succeeded
+        chained on top of each other. Targets naming the same ref, e.g.
+        "master" and "refs/heads/master", are written together. A
+        transaction that fails, e.g. because its target ref does not
+        exist, does not affect the others. Return a list of
+        writers.TransactionResult objects, one for every transaction.
+
+        """
+
+        refs = None
+        names = {}
+        ref_writers = {}
+        results = []
+        for transaction in transactions:
+            target = transaction.commit().target
+            try:
+                if target not in names:
+                    if refs is None:
+                        with timing.measure('ref'):
+                            refs = self.refs()
+                    names[target] = self._find_ref(refs, target).name
+            except services.RefNotFoundError, e:
+                result = writers.TransactionResult(transaction)
+                result.error = e
+                results.append(result)
+                continue
+
+            name = names[target]
+            if name not in ref_writers:
+                ref_writers[name] = writers.RefWriter(self, name, hooks)
+            results.append(ref_writers[name].queue_transaction(transaction))
+        for writer in ref_writers.itervalues():
+            writer.flush()
+        return results
+
+    def import_objects(self, target, stream, author, committer, message,
+                       raw_source=None, hooks=[]):
+        """Import objects from NDJSON records into a ref. Return the commit.
+
+        All objects are added in a single commit on top of the head of
+        the target ref, which is validated like the commits created for
+        transactions before the ref is updated.
+
+        """
+
+        importer = importers.BulkImporter(self, target, raw_source)
+        commit = importer.prepare_import(stream, author, committer, message)
+        validator = validation.CommitValidator()
+        validator.add_hook(validate.LocalCommitValidator())
+        for hook in hooks:
+            validator.add_hook(hook)
+        if validator.validate(self, commit):
+            # update the ref unless it has moved on since the import began
+            self._update_ref(
+                importer.ref_name, commit, importer.source.sha1, 'import')
+
+            # let everyone watching the store know about the new head
+            self.watcher.check()
+        return commit
+
+    def export_objects(self, commit, stream, raw_stream=None, classes=None,
+                       jobs=4):
+        """Write the objects of a commit to a stream as NDJSON records.
+
+        Raw property data is written to raw_stream as a tar archive if
+        it is given. If classes is set, only objects of these classes
+        are exported. Return the number of objects exported.
+
+        """
+
+        exporter = exporters.BulkExporter(self, commit, classes, jobs)
+        return exporter.export(stream, raw_stream)
+
+    def warm_cache(self, commits, raw_data=False, jobs=4):
+        """Load commits of the store in order to fill its caches.
+
+        The metadata, schema, classes and objects of the commits are
+        loaded through the object cache of the store, using jobs
+        threads. If raw_data is set, raw property data is loaded as
+        well. Return a CacheWarmResult with the numbers of commits,
+        classes, objects and raw values loaded.
+
+        """
+
+        warmer = warmers.CacheWarmer(self, commits, raw_data, jobs)
+        return warmer.warm()
 
     def _prepare_transaction(self, transaction):
         """Create a new commit from a transaction and return it."""
 
-        preparer = transactions.TransactionPreparer(self, transaction)
-        return preparer.prepare_transaction()
+        with timing.measure('prepare'):
+            preparer = transactions.TransactionPreparer(self, transaction)
+            return preparer.prepare_transaction()
+
+    def _commit_transaction(self, transaction, commit, validator, hooks=[]):
+        """Validate a transaction and merge it into its target ref.
+
+        If the target ref has moved on since the source commit of the
+        transaction, the changes of the transaction are replayed onto
+        the new head of the ref, unless they conflict with the changes
+        made to the ref in the meantime. This is retried if the ref
+        keeps moving while replaying the changes. Return the commit the
+        ref was updated to.
 
-    def _commit_transaction(self, transaction, commit, validator):
-        """Validate a transaction and merge it into its target ref."""
+        """
 
         # first, validate the commit
-        if validator.validate(self, commit):
-            # obtain the head commit SHA1 (and short SHA1) of the target ref
-            ref = self.ref(transaction.commit().target)
-            sha1s = (ref.head.sha1, ref.head.sha1[:8])
-
-            # check if the target ref hasn't moved on since
-            # we started the transaction
-            if transaction.begin().source in sha1s:
-                # it hasn't changed, attempt to just update the ref from the
-                # source commit to the transaction commit; if this fails,
-                # we'll just throw an exception and give up
-                util.gitcli.subcommand(
-                    self.repo,
-                    ['update-ref', transaction.commit().target,
-                     commit.sha1, transaction.begin().source])
+        with timing.measure('validation'):
+            valid = validator.validate(self, commit)
+        if not valid:
+            return None
+
+        ref = self.ref(transaction.commit().target)
+        rebaser = transactions.TransactionRebaser(self, transaction, commit)
+
+        attempts = 0
+        head = ref.head
+        rebased = False
+        while True:
+            # replay the transaction onto the head if the target ref
+            # has moved on since we started the transaction
+            if not rebased:
+                new_commit = self._rebase_transaction(rebaser, head, hooks)
+                if new_commit is None:
+                    return None
+                rebased = True
+
+            # attempt to update the ref from the head we are based on to
+            # the new commit; if the ref is locked, wait for a moment,
+            # and if it moved on again in the meantime, replay the
+            # transaction again, until we give up
+            try:
+                self._update_ref(
+                    ref.name, new_commit, head.sha1, 'transaction')
+            except util.gitrefs.RefLockedError:
+                attempts += 1
+                if attempts >= self.max_rebase_attempts:
+                    raise
+                self._wait_for_ref_lock(attempts)
+                new_head = self.ref(ref.name).head
+                if new_head.sha1 != head.sha1:
+                    head = new_head
+                    rebased = False
+            except util.gitrefs.RefMovedError:
+                attempts += 1
+                new_head = self.ref(ref.name).head
+                if new_head.sha1 == head.sha1 or \
+                        attempts >= self.max_rebase_attempts:
+                    raise
+                head = new_head
+                rebased = False
             else:
-                raise NotImplementedError
+                break
+
+        # let everyone watching the store know about the new head
+        self.watcher.check()
+
+        return new_commit
+
+    def _update_ref(self, name, commit, old_sha1, reason):
+        """Point a ref to a commit if it still points to old_sha1.
+
+        The ref is updated in-process rather than by running git
+        update-ref, with the same locking and a reflog entry made
+        in the name of the committer of the commit. Updates failing
+        because the ref has moved on or is locked by someone else are
+        counted in ref_update_conflicts.
+
+        """
+
+        try:
+            util.gitrefs.update_ref(
+                self.repo, name, commit.sha1, old_sha1,
+                '%s: %s' % (reason, commit.message_subject()),
+                self.repo[commit.sha1].committer)
+        except (util.gitrefs.RefMovedError, util.gitrefs.RefLockedError):
+            self.ref_update_conflicts += 1
+            raise
+
+    def _wait_for_ref_lock(self, attempts):
+        """Wait before retrying to update a ref that was locked."""
+
+        time.sleep(min(self.ref_lock_delay * 2 ** (attempts - 1),
+                       self.ref_lock_max_delay))
+
+    def _rebase_transaction(self, rebaser, head, hooks=[]):
+        """Return a validated transaction commit based on the given head.
+
+        The transaction commit is returned as is if it is based on the
+        head already. Otherwise its changes are replayed onto the head.
+        The head and the transaction commit have both been validated
+        before, so only the objects changed by the transaction are
+        validated again, along with any extra validation hooks. None is
+        returned if a validation hook rejects the result.
+
+        """
+
+        if head.sha1 == rebaser.source.sha1:
+            return rebaser.commit
+
+        commit = rebaser.rebase_transaction(head)
+
+        validator = validation.CommitValidator()
+        validator.add_hook(validate.LocalObjectValidator(rebaser.changes))
+        for hook in hooks:
+            validator.add_hook(hook)
+        with timing.measure('validation'):
+            valid = validator.validate(self, commit)
+        if valid:
+            return commit
+        else:
+            return None
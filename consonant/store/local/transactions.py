@@ -24,8 +24,9 @@ import yaml
 
 from consonant import store
 from consonant.schema import definitions
-from consonant.store.local import loaders
+from consonant.store.local import changes, loaders, trees
 from consonant.transaction import validation
+from consonant.util import gitobjects
 from consonant.util.phase import Phase
 
 
@@ -48,9 +49,22 @@ class TransactionPreparer(object):
         self.transaction = transaction
 
     def prepare_transaction(self):
-        """Create and return a commit with all changes from the transaction."""
+        """Create and return a commit with all changes from the transaction.
+
+        Changes made by the actions are staged in memory and only the
+        class trees that were touched and the root tree are written to
+        the repository, once all actions have been applied.
+
+        """
 
         self.action_objects = {}
+        self.object_classes = None
+
+        # index actions by their IDs for resolving action references
+        self.actions_by_id = {}
+        for action in self.transaction.actions:
+            if action.id is not None:
+                self.actions_by_id.setdefault(action.id, action)
 
         # obtain the tree of the source commit the transaction is based on
         source = self.store.commit(self.transaction.begin().source)
@@ -60,8 +74,12 @@ class TransactionPreparer(object):
         # load the schema of the commit
         schema = self.store.schema(source)
 
-        # apply all actions of the transaction
-        tree_after = self._apply_actions(source, schema, source_tree)
+        # apply all actions of the transaction to a staged tree
+        self.staged = trees.StagedTree(self.store.repo, source_tree)
+        self._apply_actions(source, schema)
+
+        # write the changed class trees and the resulting store tree
+        tree_after = self.staged.write()
 
         # create a commit for the resulting tree
         commit_object = self.store.repo.create_commit(
@@ -75,21 +93,20 @@ class TransactionPreparer(object):
         # return a commit object for the transaction commit
         return self.store.commit(commit_object.hex)
 
-    def _apply_actions(self, commit, schema, tree):
+    def _apply_actions(self, commit, schema):
         for action in self.transaction.actions[1:-1]:
-            obj, tree = self._apply_action(action, commit, schema, tree)
+            obj = self._apply_action(action, commit, schema)
             self.action_objects[action] = obj
-        return tree
 
-    def _apply_action(self, action, commit, schema, tree):
+    def _apply_action(self, action, commit, schema):
         class_name = action.__class__.__name__
         normalised_name = class_name.replace('Action', '')
         normalised_name = re.sub(r'([A-Z])', r'_\1', normalised_name)[1:]
         normalised_name = normalised_name.lower()
         apply_func = '_apply_%s_action' % normalised_name
-        return getattr(self, apply_func)(action, commit, schema, tree)
+        return getattr(self, apply_func)(action, commit, schema)
 
-    def _apply_create_action(self, action, commit, schema, tree):
+    def _apply_create_action(self, action, commit, schema):
         # make sure the class of the new object is known in the schema
         self._validate_object_class(action, action.klass, schema)
 
@@ -112,38 +129,11 @@ class TransactionPreparer(object):
         object_tree = self._create_object_tree(
             schema, action.klass, uuid, action.properties)
 
-        # build new class tree with the object added
-        try:
-            class_entry = tree[action.klass]
-            class_tree = self.store.repo[class_entry.oid]
-            builder = self.store.repo.TreeBuilder(class_tree)
-        except KeyError:
-            # this is the first object of this class in the commit, create
-            # a new tree from scratch
-            builder = self.store.repo.TreeBuilder()
-        builder.insert(uuid, object_tree.oid, pygit2.GIT_FILEMODE_TREE)
-        new_class_oid = builder.write()
-
-        # build and return a new overall store tree
-        builder = self.store.repo.TreeBuilder(tree)
-        builder.insert(action.klass, new_class_oid, pygit2.GIT_FILEMODE_TREE)
-        new_tree_oid = builder.write()
-        new_tree = self.store.repo[new_tree_oid]
+        # stage the new object and load it from its object tree
+        self.staged.insert_object(action.klass, uuid, object_tree.oid)
+        return self._load_staged_object(commit, schema, action.klass, uuid)
 
-        # load the updated class from the new tree
-        context = loaders.LoaderContext(self.store)
-        context.set_tree(new_tree)
-        new_class_entry = new_tree[action.klass]
-        klass = self.loader.class_in_tree(context, new_class_entry)
-
-        # load the new object from the new tree
-        context.set_class(klass)
-        context.set_uuid(uuid)
-        obj = self.loader.object_in_tree(context)
-
-        return obj, new_tree
-
-    def _apply_update_action(self, action, commit, schema, tree):
+    def _apply_update_action(self, action, commit, schema):
         # load the object from the commit or from a previous action
         obj = self._validate_and_resolve_target_object(schema, action, commit)
 
@@ -162,41 +152,19 @@ class TransactionPreparer(object):
             self._validate_action_object_references(
                 phase, action, schema, obj.klass.name, action.properties)
 
-        # obtain the class and object tree from the store
-        old_class_entry = tree[obj.klass.name]
-        old_class_tree = self.store.repo[old_class_entry.oid]
-        old_object_entry = old_class_tree[obj.uuid]
-        old_object_tree = self.store.repo[old_object_entry.oid]
+        # obtain the current object tree from the staged tree
+        old_object_tree = self.staged.object_tree(obj.klass.name, obj.uuid)
 
         # build a new object tree
         object_tree = self._update_object_tree(
             schema, obj, action.properties, old_object_tree)
 
-        # build a new class tree with the object changed
-        builder = self.store.repo.TreeBuilder(old_class_tree)
-        builder.insert(obj.uuid, object_tree.oid, pygit2.GIT_FILEMODE_TREE)
-        new_class_oid = builder.write()
-
-        # build and return a new overall store tree
-        builder = self.store.repo.TreeBuilder(tree)
-        builder.insert(obj.klass.name, new_class_oid, pygit2.GIT_FILEMODE_TREE)
-        new_tree_oid = builder.write()
-        new_tree = self.store.repo[new_tree_oid]
-
-        # load the updated class from the new tree
-        context = loaders.LoaderContext(self.store)
-        context.set_tree(new_tree)
-        new_class_entry = new_tree[obj.klass.name]
-        updated_class = self.loader.class_in_tree(context, new_class_entry)
+        # stage the changed object and load it from its object tree
+        self.staged.insert_object(obj.klass.name, obj.uuid, object_tree.oid)
+        return self._load_staged_object(
+            commit, schema, obj.klass.name, obj.uuid)
 
-        # load the updated object from the updated class
-        context.set_class(updated_class)
-        context.set_uuid(obj.uuid)
-        updated_obj = self.loader.object_in_tree(context)
-
-        return updated_obj, new_tree
-
-    def _apply_update_raw_property_action(self, action, commit, schema, tree):
+    def _apply_update_raw_property_action(self, action, commit, schema):
         # load the object from the commit or from a previous action
         obj = self._validate_and_resolve_target_object(schema, action, commit)
 
@@ -210,39 +178,18 @@ class TransactionPreparer(object):
                 phase, action, schema, obj.klass.name, [action.property])
 
         # build a new object tree
-        old_object_entry = tree[obj.klass.name]
-        old_object_tree = self.store.repo[old_object_entry.oid]
+        old_object_tree = self.staged.object_tree(obj.klass.name, obj.uuid)
         object_tree = self._update_raw_property(
-            schema, obj, action.property, action.content_type, action.data,
+            schema, obj, action.property, action.content_type,
+            action.data_stream(),
             old_object_tree)
 
-        # build a new class tree with the object changed
-        class_entry = tree[obj.klass.name]
-        class_tree = self.store.repo[class_entry.oid]
-        builder = self.store.repo.TreeBuilder(class_tree)
-        builder.insert(obj.uuid, object_tree.oid, pygit2.GIT_FILEMODE_TREE)
-        new_class_oid = builder.write()
-
-        # build and return a new overall store tree
-        builder = self.store.repo.TreeBuilder(tree)
-        builder.insert(obj.klass.name, new_class_oid, pygit2.GIT_FILEMODE_TREE)
-        new_tree_oid = builder.write()
-        new_tree = self.store.repo[new_tree_oid]
-
-        # load the updated class from the new tree
-        context = loaders.LoaderContext(self.store)
-        context.set_tree(new_tree)
-        new_class_entry = new_tree[obj.klass.name]
-        updated_class = self.loader.class_in_tree(context, new_class_entry)
-
-        # load the updated object from the updated class
-        context.set_class(updated_class)
-        context.set_uuid(obj.uuid)
-        updated_obj = self.loader.object_in_tree(context)
+        # stage the changed object and load it from its object tree
+        self.staged.insert_object(obj.klass.name, obj.uuid, object_tree.oid)
+        return self._load_staged_object(
+            commit, schema, obj.klass.name, obj.uuid)
 
-        return updated_obj, new_tree
-
-    def _apply_unset_raw_property_action(self, action, commit, schema, tree):
+    def _apply_unset_raw_property_action(self, action, commit, schema):
         # load the object from the commit or from a previous action
         obj = self._validate_and_resolve_target_object(schema, action, commit)
 
@@ -256,54 +203,32 @@ class TransactionPreparer(object):
                 phase, action, schema, obj.klass.name, [action.property])
 
         # build a new object tree
-        old_object_entry = tree[obj.klass.name]
-        old_object_tree = self.store.repo[old_object_entry.oid]
+        old_object_tree = self.staged.object_tree(obj.klass.name, obj.uuid)
         object_tree = self._unset_raw_property(
             schema, obj, action.property, old_object_tree)
 
-        # build a new class tree with the object changed
-        class_entry = tree[obj.klass.name]
-        class_tree = self.store.repo[class_entry.oid]
-        builder = self.store.repo.TreeBuilder(class_tree)
-        builder.insert(obj.uuid, object_tree.oid, pygit2.GIT_FILEMODE_TREE)
-        new_class_oid = builder.write()
-
-        # build and return a new overall store tree
-        builder = self.store.repo.TreeBuilder(tree)
-        builder.insert(obj.klass.name, new_class_oid, pygit2.GIT_FILEMODE_TREE)
-        new_tree_oid = builder.write()
-        new_tree = self.store.repo[new_tree_oid]
-
-        # load the updated class from the new tree
-        context = loaders.LoaderContext(self.store)
-        context.set_tree(new_tree)
-        new_class_entry = new_tree[obj.klass.name]
-        updated_class = self.loader.class_in_tree(context, new_class_entry)
-
-        # load the updated object from the updated class
-        context.set_class(updated_class)
-        context.set_uuid(obj.uuid)
-        updated_obj = self.loader.object_in_tree(context)
-
-        return updated_obj, new_tree
+        # stage the changed object and load it from its object tree
+        self.staged.insert_object(obj.klass.name, obj.uuid, object_tree.oid)
+        return self._load_staged_object(
+            commit, schema, obj.klass.name, obj.uuid)
 
-    def _apply_delete_action(self, action, commit, schema, tree):
+    def _apply_delete_action(self, action, commit, schema):
         # load the object from the commit or from a previous action
         obj = self._validate_and_resolve_target_object(schema, action, commit)
 
-        # build a new class tree without the object
-        class_entry = tree[obj.klass.name]
-        class_tree = self.store.repo[class_entry.oid]
-        builder = self.store.repo.TreeBuilder(class_tree)
-        builder.remove(obj.uuid)
-        new_class_oid = builder.write()
+        # stage the removal of the object
+        self.staged.remove_object(obj.klass.name, obj.uuid)
+        return None
 
-        # build and return a new overall store tree
-        builder = self.store.repo.TreeBuilder(tree)
-        builder.insert(obj.klass.name, new_class_oid, pygit2.GIT_FILEMODE_TREE)
-        new_tree_oid = builder.write()
-        new_tree = self.store.repo[new_tree_oid]
-        return None, new_tree
+    def _load_staged_object(self, commit, schema, klass, uuid):
+        # load an object directly from its staged object tree, reusing
+        # the schema of the source commit instead of loading it again
+        context = loaders.LoaderContext(self.store)
+        context.set_commit(commit)
+        context.set_schema(schema)
+        context.set_class(store.objects.ObjectClass(klass, []))
+        entry = self.staged.object_entry(klass, uuid)
+        return self.loader.object_data_in_tree(context, entry)
 
     def _validate_object_class(self, action, klass, schema):
         if klass not in schema.classes:
@@ -343,21 +268,44 @@ class TransactionPreparer(object):
             obj = self.action_objects[target_action]
             return obj
         else:
-            objects = self.store.objects(commit)
-            for class_objects in objects.itervalues():
-                for obj in class_objects:
-                    if obj.uuid == action.uuid:
-                        return obj
+            # look up the class of the object and load only the object
+            # itself, taking changes of previous actions into account
+            klass = self._object_classes().get(action.uuid, None)
+            if klass is not None:
+                self._validate_expected_object_tree(schema, action, klass)
+                if self.staged.object_oid(klass, action.uuid) is not None:
+                    return self._load_staged_object(
+                        commit, schema, klass, action.uuid)
             raise validation.ActionReferencesANonExistentObjectError(
                 action, schema, action.uuid)
 
+    def _validate_expected_object_tree(self, schema, action, klass):
+        # compare the tree the object has in the source commit with
+        # the tree the action expects it to have, if it expects any
+        if action.expected_tree is not None:
+            tree = self.staged.class_tree(klass)[action.uuid].oid.hex
+            if tree != action.expected_tree.lower():
+                raise validation.ActionObjectTreeMismatchError(
+                    action, schema, action.uuid, action.expected_tree, tree)
+
+    def _object_classes(self):
+        # build a UUID to class name index from the names of the entries
+        # in the class trees of the source tree, without loading objects
+        if self.object_classes is None:
+            self.object_classes = {}
+            for class_entry in self.staged.tree:
+                if class_entry.filemode != pygit2.GIT_FILEMODE_TREE:
+                    continue
+                class_tree = self.store.repo[class_entry.oid]
+                for object_entry in class_tree:
+                    self.object_classes[object_entry.name] = class_entry.name
+        return self.object_classes
+
     def _validate_and_resolve_target_action(self, schema, action):
-        actions = \
-            [a for a in self.transaction.actions if a.id == action.action_id]
-        if not actions:
+        target_action = self.actions_by_id.get(action.action_id, None)
+        if target_action is None:
             raise validation.ActionReferencesANonExistentActionError(
                 action, schema, action.action_id)
-        target_action = actions[0]
         if target_action not in self.action_objects:
             raise validation.ActionReferencesALaterActionError(
                 action, schema, action.action_id)
@@ -395,7 +343,8 @@ class TransactionPreparer(object):
         return self.store.repo[tree_oid]
 
     def _update_raw_property(
-            self, schema, obj, prop_name, content_type, data, old_object_tree):
+            self, schema, obj, prop_name, content_type, stream,
+            old_object_tree):
         # generate YAML data to write into <class>/<uuid>/properties.yaml
         props_data = self._merge_property_values(
             schema, obj, obj.properties, {})
@@ -408,7 +357,8 @@ class TransactionPreparer(object):
         # generate the new object tree
         builder = self.store.repo.TreeBuilder()
         builder.insert('properties.yaml', blob_oid, pygit2.GIT_FILEMODE_BLOB)
-        raw_tree = self._update_raw_tree(obj, prop_name, data, old_object_tree)
+        raw_tree = self._update_raw_tree(
+            obj, prop_name, stream, old_object_tree)
         builder.insert('raw', raw_tree.oid, pygit2.GIT_FILEMODE_TREE)
         tree_oid = builder.write()
         return self.store.repo[tree_oid]
@@ -452,7 +402,7 @@ class TransactionPreparer(object):
                     schema, obj.klass.name, prop)
         return data
 
-    def _update_raw_tree(self, obj, prop_name, data, old_object_tree):
+    def _update_raw_tree(self, obj, prop_name, stream, old_object_tree):
         # create a fresh builder or one based on the current raw
         # properties tree
         if 'raw' in old_object_tree:
@@ -464,9 +414,11 @@ class TransactionPreparer(object):
             raw_tree = None
 
         # create a new blob with the new raw property data or delete it
-        # if the property was unset (data == None)
-        if data is not None:
-            blob_oid = self.store.repo.create_blob(data)
+        # if the property was unset (stream == None); the data is written
+        # in chunks so that it never needs to be held in memory
+        if stream is not None:
+            blob_sha1 = gitobjects.write_blob(self.store.repo, stream)
+            blob_oid = pygit2.Oid(hex=blob_sha1)
             builder.insert(prop_name, blob_oid, pygit2.GIT_FILEMODE_BLOB)
         else:
             if raw_tree and prop_name in raw_tree:
@@ -516,14 +468,13 @@ class TransactionPreparer(object):
         # only validate references to objects in other actions, any normal
         # UUID references will be taken care of by the commit validators
         if isinstance(value, dict) and 'action' in value:
-            # collect actions matching the target action ID
-            actions = [a for a in self.transaction.actions
-                       if a.id == value['action']]
-            if not actions:
+            # look up the action matching the target action ID
+            target_action = self.actions_by_id.get(value['action'], None)
+            if target_action is None:
                 # the target action does not exist actions
                 phase.error(validation.ReferencePropertyActionNonExistentError(
                     action, schema, prop_def.name, value['action']))
-            elif not actions[0] in self.action_objects:
+            elif target_action not in self.action_objects:
                 # the target action only comes later in the transaction
                 phase.error(
                     validation.ReferencePropertyReferencesALaterActionError(
@@ -553,9 +504,7 @@ class TransactionPreparer(object):
         if isinstance(value, store.properties.Property):
             value = value.value
         if isinstance(value, dict) and 'action' in value:
-            actions = [a for a in self.transaction.actions
-                       if a.id == value['action']]
-            target_action = actions[0]
+            target_action = self.actions_by_id[value['action']]
             new_value = dict(value)
             new_value['uuid'] = \
                 self.action_objects[target_action].uuid
@@ -563,3 +512,128 @@ class TransactionPreparer(object):
             return new_value
         else:
             return value
+
+
+class TransactionRebaser(object):
+
+    """Replays the changes of a transaction commit onto a newer ref head.
+
+    When the target ref of a transaction has moved on since the source
+    commit of the transaction, the objects created, updated or deleted
+    in the transaction commit are replayed onto the new head of the
+    ref, as long as the commits added to the ref in the meantime touch
+    neither the same objects nor objects whose tree the transaction
+    expects. Objects deleted on one side that are referenced by objects
+    created or updated on the other side conflict as well, as replaying
+    the transaction would leave these references dangling. Changes to
+    anything but objects, e.g. the store name, the schema or the
+    services, always conflict with the transaction.
+
+    """
+
+    def __init__(self, store, transaction, commit):
+        self.store = store
+        self.transaction = transaction
+        self.commit = commit
+        self.source = store.commit(transaction.begin().source)
+        self.changes = None
+
+    def rebase_transaction(self, head):
+        """Create and return a commit replaying the transaction onto head."""
+
+        repo = self.store.repo
+        source_object = repo[self.source.sha1]
+        head_object = repo[head.sha1]
+
+        # compute the object changes of the transaction only once, no
+        # matter how often it has to be rebased
+        if self.changes is None:
+            self.changes = changes.object_changes(
+                repo, source_object.tree, repo[self.commit.sha1].tree)
+
+        # detect conflicts with the changes made to the target ref
+        self._validate_no_conflicts(source_object, head_object, head)
+
+        # apply the changes of the transaction to the tree of the head
+        staged = trees.StagedTree(repo, head_object.tree)
+        for change in self.changes:
+            if change.new_oid is None:
+                staged.remove_object(change.klass, change.uuid)
+            else:
+                staged.insert_object(change.klass, change.uuid, change.new_oid)
+        tree_after = staged.write()
+
+        # create a commit on top of the head with the transaction metadata
+        commit_object = repo.create_commit(
+            None,
+            self.transaction.commit().author_signature(),
+            self.transaction.commit().committer_signature(),
+            self.transaction.commit().message,
+            tree_after.oid,
+            [head_object.oid])
+        return self.store.commit(commit_object.hex)
+
+    def _validate_no_conflicts(self, source_object, head_object, head):
+        target = self.transaction.commit().target
+
+        # anything but objects must not have changed since the source
+        if self._non_class_entries(source_object.tree) != \
+                self._non_class_entries(head_object.tree):
+            raise validation.TransactionConflictError(
+                target, source_object.hex, head_object.hex, [])
+
+        head_changes = changes.object_changes(
+            self.store.repo, source_object.tree, head_object.tree)
+        changed_uuids = set(change.uuid for change in head_changes)
+
+        # objects changed by the transaction and in the target ref conflict,
+        # as do objects changed in the target ref whose tree the transaction
+        # expects, even if the transaction leaves them untouched
+        conflicts = set(change.uuid for change in self.changes
+                        if change.uuid in changed_uuids)
+        for action in self.transaction.actions[1:-1]:
+            if getattr(action, 'expected_tree', None) is not None:
+                if action.uuid in changed_uuids:
+                    conflicts.add(action.uuid)
+
+        # objects deleted on one side must not be referenced by objects
+        # created or updated on the other side; objects are only loaded
+        # to look at their references if the other side deletes any
+        deleted = set(change.uuid for change in self.changes
+                      if change.new_oid is None)
+        head_deleted = set(change.uuid for change in head_changes
+                           if change.new_oid is None)
+        if head_deleted:
+            conflicts.update(head_deleted & self._referenced_uuids(
+                self.commit, self.changes))
+        if deleted:
+            conflicts.update(deleted & self._referenced_uuids(
+                head, head_changes))
+
+        if conflicts:
+            raise validation.TransactionConflictError(
+                target, source_object.hex, head_object.hex, conflicts)
+
+    def _referenced_uuids(self, commit, object_changes):
+        uuids = [change.uuid for change in object_changes
+                 if change.new_oid is not None]
+        if not uuids:
+            return set()
+
+        referenced = set()
+        objects = self.store.objects_by_uuid(commit, uuids)
+        for obj in objects.itervalues():
+            for prop in obj.properties.itervalues():
+                if isinstance(prop.value, list):
+                    values = [element.value for element in prop.value]
+                else:
+                    values = [prop.value]
+                for value in values:
+                    if isinstance(value, store.references.Reference) and \
+                            not value.service and not value.ref:
+                        referenced.add(value.uuid)
+        return referenced
+
+    def _non_class_entries(self, tree):
+        return dict((entry.name, entry.oid) for entry in tree
+                    if entry.filemode != pygit2.GIT_FILEMODE_TREE)
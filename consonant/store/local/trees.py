@@ -0,0 +1,121 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Classes to stage changes to the trees of local stores in memory."""
+
+
+import pygit2
+
+
+class TreeEntry(object):
+
+    """A stand-in for pygit2.TreeEntry for entries that are only staged."""
+
+    def __init__(self, name, oid, filemode):
+        self.name = name
+        self.oid = oid
+        self.filemode = filemode
+
+
+class StagedTree(object):
+
+    """An in-memory overlay of object changes on top of a store tree.
+
+    Objects that are added, replaced or removed are recorded per class
+    without writing any class or root trees. Lookups are served from
+    the overlay first and fall back to the base tree. The changed class
+    trees and a new root tree are only written once, when write() is
+    called.
+
+    """
+
+    def __init__(self, repo, tree):
+        self.repo = repo
+        self.tree = tree
+        self.changes = {}
+        self.class_trees = {}
+
+    def class_tree(self, klass):
+        """Return the tree of a class in the base tree or None."""
+
+        if klass not in self.class_trees:
+            if klass in self.tree:
+                self.class_trees[klass] = self.repo[self.tree[klass].oid]
+            else:
+                self.class_trees[klass] = None
+        return self.class_trees[klass]
+
+    def object_oid(self, klass, uuid):
+        """Return the OID of an object's tree or None if it doesn't exist."""
+
+        class_changes = self.changes.get(klass, {})
+        if uuid in class_changes:
+            return class_changes[uuid]
+
+        class_tree = self.class_tree(klass)
+        if class_tree is not None and uuid in class_tree:
+            return class_tree[uuid].oid
+        return None
+
+    def object_tree(self, klass, uuid):
+        """Return the tree of an object or None if it doesn't exist."""
+
+        oid = self.object_oid(klass, uuid)
+        return self.repo[oid] if oid is not None else None
+
+    def object_entry(self, klass, uuid):
+        """Return a tree entry for an object or None if it doesn't exist."""
+
+        oid = self.object_oid(klass, uuid)
+        if oid is not None:
+            return TreeEntry(uuid, oid, pygit2.GIT_FILEMODE_TREE)
+        return None
+
+    def insert_object(self, klass, uuid, oid):
+        """Add or replace the tree of an object in a class."""
+
+        self.changes.setdefault(klass, {})[uuid] = oid
+
+    def remove_object(self, klass, uuid):
+        """Remove an object from a class."""
+
+        self.changes.setdefault(klass, {})[uuid] = None
+
+    def write(self):
+        """Write all changed class trees and the root tree and return it."""
+
+        if not self.changes:
+            return self.tree
+
+        root_builder = self.repo.TreeBuilder(self.tree)
+        for klass, class_changes in sorted(self.changes.iteritems()):
+            class_tree = self.class_tree(klass)
+            if class_tree is not None:
+                builder = self.repo.TreeBuilder(class_tree)
+            else:
+                builder = self.repo.TreeBuilder()
+
+            for uuid, oid in class_changes.iteritems():
+                if oid is not None:
+                    builder.insert(uuid, oid, pygit2.GIT_FILEMODE_TREE)
+                elif class_tree is not None and uuid in class_tree:
+                    builder.remove(uuid)
+
+            class_oid = builder.write()
+            root_builder.insert(klass, class_oid, pygit2.GIT_FILEMODE_TREE)
+
+        return self.repo[root_builder.write()]
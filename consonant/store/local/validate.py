@@ -67,3 +67,35 @@ class LocalCommitValidator(transaction.validation.ValidationHook):
         # aliases in the store
 
         return True
+
+
+class LocalObjectValidator(transaction.validation.ValidationHook):
+
+    """A validation hook that only validates some objects of a commit.
+
+    The LocalObjectValidator is used to revalidate commits that were
+    created by replaying already validated changes onto an already
+    validated commit, which leaves the store name, schema, services and
+    all other objects unchanged. Only the objects that were created or
+    updated by the replayed changes are loaded and validated again.
+    References to objects deleted by the replayed changes need no
+    checking, as the TransactionRebaser refuses to replay changes that
+    reference objects deleted in the commit they are replayed onto, or
+    that delete objects referenced in it.
+
+    """
+
+    def __init__(self, changes):
+        self.changes = changes
+
+    def validate(self, service, commit):
+        """Validate the contents of a commit and return true if it is valid."""
+
+        # load and verify the created and updated objects only; deleted
+        # objects need no validation
+        uuids = [change.uuid for change in self.changes
+                 if change.new_oid is not None]
+        loader = Loader(service)
+        loader.objects_by_uuid(commit, uuids)
+
+        return True
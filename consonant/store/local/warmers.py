@@ -0,0 +1,98 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Classes to fill the caches of local stores ahead of requests."""
+
+
+from multiprocessing.pool import ThreadPool
+
+from consonant.store import properties
+
+
+class CacheWarmResult(object):
+
+    """The numbers of classes, objects and raw values loaded by a warmer."""
+
+    def __init__(self):
+        self.commits = 0
+        self.classes = 0
+        self.objects = 0
+        self.raw_values = 0
+
+
+class CacheWarmer(object):
+
+    """Loads commits of a local store to fill the caches it uses.
+
+    Everything is loaded through loaders sharing the object cache set on
+    the store, so the cache is filled with the properties of all objects
+    and, if raw_data is set, with their raw property data. The metadata,
+    schema and classes of every commit are loaded first, in the thread
+    calling warm(). The objects of all classes are then loaded in
+    parallel by a pool of threads. Every thread uses a loader and
+    repository handle of its own, so warm() may itself be called from a
+    thread other than the one the store was created in.
+
+    """
+
+    def __init__(self, store, commits, raw_data=False, jobs=4):
+        self.store = store
+        self.commits = commits
+        self.raw_data = raw_data
+        self.jobs = max(1, jobs)
+
+    def warm(self):
+        """Load all commits and return a CacheWarmResult."""
+
+        result = CacheWarmResult()
+
+        jobs = []
+        loader = self.store._thread_loader()
+        for commit in self.commits:
+            loader.name(commit)
+            loader.schema(commit)
+            loader.services(commit)
+            for klass in loader.classes(commit).itervalues():
+                jobs.append((commit, klass))
+            result.commits += 1
+
+        pool = ThreadPool(self.jobs)
+        try:
+            counts = pool.map(self._warm_class, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        for objects, raw_values in counts:
+            result.classes += 1
+            result.objects += objects
+            result.raw_values += raw_values
+        return result
+
+    def _warm_class(self, job):
+        commit, klass = job
+        loader = self.store._thread_loader()
+        objects = loader.objects(commit, klass)
+
+        raw_values = 0
+        if self.raw_data and loader.cache:
+            for obj in objects:
+                for prop in obj.properties.itervalues():
+                    if isinstance(prop, properties.RawProperty):
+                        loader.raw_property_data(commit, obj, prop.name)
+                        raw_values += 1
+        return len(objects), raw_values
@@ -0,0 +1,158 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Classes to watch the refs of local stores for changes."""
+
+
+from consonant.store.local import changes
+
+
+class RefChange(object):
+
+    """A change of the head commit of a ref in a local store."""
+
+    def __init__(self, store, name, old_sha1, new_sha1):
+        self.store = store
+        self.name = name
+        self.old_sha1 = old_sha1
+        self.new_sha1 = new_sha1
+        self._object_changes = None
+
+    def object_changes(self):
+        """Return the object changes between the old and the new head.
+
+        The changes are computed on first use and shared between all
+        listeners the change is dispatched to.
+
+        """
+
+        if self._object_changes is None:
+            repo = self.store.repo
+            old_tree = repo[self.old_sha1].tree if self.old_sha1 else None
+            new_tree = repo[self.new_sha1].tree if self.new_sha1 else None
+            self._object_changes = changes.object_changes(
+                repo, old_tree, new_tree)
+        return self._object_changes
+
+
+class RefWatcher(object):
+
+    """Watches the refs of a local store and notifies listeners of changes.
+
+    A store only needs a single watcher, no matter how many consumers
+    are interested in ref updates. Listeners are callables that are
+    invoked with a RefChange whenever the head of a ref is found to be
+    different from what it was the last time the watcher checked.
+
+    Ref heads are compared by their SHA1s only, which makes checking
+    cheap enough to do periodically in order to pick up pushes to the
+    store repository in addition to transactions applied to the store.
+
+    Changes are always dispatched in the order they were found in. While
+    the watcher is held, notifications are queued and only dispatched
+    once it is released again.
+
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.heads = store.ref_heads()
+        self.listeners = []
+        self.pending = []
+        self.holds = 0
+
+    def add_listener(self, listener):
+        """Register a callable to be notified about ref changes."""
+
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Unregister a callable from ref change notifications."""
+
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def check(self):
+        """Look for changed ref heads, notify listeners and return changes."""
+
+        ref_changes = self.poll()
+        self.notify(ref_changes)
+        return ref_changes
+
+    def poll(self):
+        """Look for changed ref heads and return changes.
+
+        Unlike check(), this does not notify listeners, which allows to
+        prepare for the changes, e.g. by filling caches, before calling
+        notify() with them.
+
+        """
+
+        old_heads, self.heads = self.heads, self.store.ref_heads()
+
+        ref_changes = []
+        for name in sorted(set(old_heads) | set(self.heads)):
+            old_sha1 = old_heads.get(name, None)
+            new_sha1 = self.heads.get(name, None)
+            if old_sha1 != new_sha1:
+                ref_changes.append(
+                    RefChange(self.store, name, old_sha1, new_sha1))
+        return ref_changes
+
+    def notify(self, ref_changes):
+        """Notify listeners about changes returned by poll().
+
+        If the watcher is held, the changes are queued behind those
+        already pending and dispatched when the watcher is released.
+
+        """
+
+        self.pending.extend(ref_changes)
+        if not self.holds:
+            self._dispatch()
+
+    def hold(self):
+        """Queue notifications until release() is called.
+
+        This allows to poll() for changes and delay notifying listeners
+        about them without later changes, e.g. found by a check() after
+        applying a transaction, overtaking them. Calls to hold() nest.
+
+        """
+
+        self.holds += 1
+
+    def release(self):
+        """Undo a hold() and dispatch queued notifications in order."""
+
+        self.holds -= 1
+        if not self.holds:
+            self._dispatch()
+
+    def _dispatch(self):
+        # hold the watcher while dispatching, so that changes found by
+        # listeners checking for changes themselves are queued behind
+        # the ones that are still being dispatched
+        self.holds += 1
+        try:
+            while self.pending:
+                change = self.pending.pop(0)
+                for listener in list(self.listeners):
+                    listener(change)
+        finally:
+            self.holds -= 1
@@ -0,0 +1,187 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for watching the refs of local stores."""
+
+
+import unittest
+
+from consonant.store.local import watchers
+
+
+class FakeCommit(object):
+
+    """A commit with an empty tree."""
+
+    tree = []
+
+
+class FakeRepository(object):
+
+    """A repository that counts how often commits are looked up."""
+
+    def __init__(self):
+        self.lookups = 0
+
+    def __getitem__(self, sha1):
+        self.lookups += 1
+        return FakeCommit()
+
+
+class FakeStore(object):
+
+    """A store whose ref heads can be changed at will."""
+
+    def __init__(self, heads):
+        self.heads = dict(heads)
+        self.repo = FakeRepository()
+
+    def ref_heads(self):
+        """Return a copy of the current ref heads."""
+
+        return dict(self.heads)
+
+
+class RefChangeTests(unittest.TestCase):
+
+    """Unit tests for the RefChange class."""
+
+    def test_object_changes_are_computed_once(self):
+        """Verify that object changes are computed on first use only."""
+
+        store = FakeStore({})
+        change = watchers.RefChange(store, 'refs/heads/master', 'a', 'b')
+        self.assertEqual(change.object_changes(), [])
+        self.assertEqual(change.object_changes(), [])
+        self.assertEqual(store.repo.lookups, 2)
+
+    def test_missing_heads_are_not_looked_up(self):
+        """Verify that created or deleted refs only look up one head."""
+
+        store = FakeStore({})
+        watchers.RefChange(store, 'a', None, 'b').object_changes()
+        watchers.RefChange(store, 'a', 'b', None).object_changes()
+        self.assertEqual(store.repo.lookups, 2)
+
+
+class RefWatcherTests(unittest.TestCase):
+
+    """Unit tests for the RefWatcher class."""
+
+    def setUp(self):
+        """Initialise a watcher for a store with two refs."""
+
+        self.store = FakeStore({
+            'refs/heads/master': 'a',
+            'refs/heads/other': 'b',
+            })
+        self.watcher = watchers.RefWatcher(self.store)
+        self.notified = []
+        self.watcher.add_listener(self._listener)
+
+    def _listener(self, change):
+        self.notified.append((change.name, change.old_sha1, change.new_sha1))
+
+    def _summary(self, ref_changes):
+        return [(c.name, c.old_sha1, c.new_sha1) for c in ref_changes]
+
+    def test_poll_returns_nothing_if_no_ref_changed(self):
+        """Verify that poll() returns no changes if no ref has changed."""
+
+        self.assertEqual(self.watcher.poll(), [])
+
+    def test_poll_returns_changed_refs_sorted_by_name(self):
+        """Verify that poll() returns created, updated and deleted refs."""
+
+        self.store.heads['refs/heads/other'] = 'c'
+        self.store.heads['refs/heads/new'] = 'd'
+        del self.store.heads['refs/heads/master']
+
+        self.assertEqual(
+            self._summary(self.watcher.poll()),
+            [('refs/heads/master', 'a', None),
+             ('refs/heads/new', None, 'd'),
+             ('refs/heads/other', 'b', 'c')])
+        self.assertEqual(self.watcher.poll(), [])
+        self.assertEqual(self.notified, [])
+
+    def test_check_notifies_listeners(self):
+        """Verify that check() notifies listeners and returns changes."""
+
+        self.store.heads['refs/heads/master'] = 'c'
+        ref_changes = self.watcher.check()
+        self.assertEqual(
+            self._summary(ref_changes), [('refs/heads/master', 'a', 'c')])
+        self.assertEqual(self.notified, [('refs/heads/master', 'a', 'c')])
+
+        self.watcher.check()
+        self.assertEqual(len(self.notified), 1)
+
+    def test_removed_listeners_are_not_notified(self):
+        """Verify that listeners are no longer notified once removed."""
+
+        self.watcher.remove_listener(self._listener)
+        self.watcher.remove_listener(self._listener)
+        self.store.heads['refs/heads/master'] = 'c'
+        self.watcher.check()
+        self.assertEqual(self.notified, [])
+
+    def test_notifications_are_queued_while_held(self):
+        """Verify that a held watcher queues notifications in order."""
+
+        self.watcher.hold()
+        self.store.heads['refs/heads/master'] = 'c'
+        self.watcher.notify(self.watcher.poll())
+        self.store.heads['refs/heads/master'] = 'd'
+        self.watcher.check()
+        self.assertEqual(self.notified, [])
+
+        self.watcher.release()
+        self.assertEqual(self.notified, [
+            ('refs/heads/master', 'a', 'c'),
+            ('refs/heads/master', 'c', 'd'),
+            ])
+
+    def test_holds_nest(self):
+        """Verify that notifications wait for the outermost release()."""
+
+        self.watcher.hold()
+        self.watcher.hold()
+        self.store.heads['refs/heads/master'] = 'c'
+        self.watcher.check()
+        self.watcher.release()
+        self.assertEqual(self.notified, [])
+        self.watcher.release()
+        self.assertEqual(self.notified, [('refs/heads/master', 'a', 'c')])
+
+    def test_changes_caused_by_listeners_are_notified_in_order(self):
+        """Verify that listeners checking for changes see them in order."""
+
+        def listener(change):
+            if change.new_sha1 == 'c':
+                self.store.heads['refs/heads/master'] = 'd'
+                self.watcher.check()
+
+        self.watcher.listeners.insert(0, listener)
+        self.store.heads['refs/heads/master'] = 'c'
+        self.store.heads['refs/heads/other'] = 'e'
+        self.watcher.check()
+        self.assertEqual(self.notified, [
+            ('refs/heads/master', 'a', 'c'),
+            ('refs/heads/other', 'b', 'e'),
+            ('refs/heads/master', 'c', 'd'),
+            ])
@@ -0,0 +1,181 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Classes to write queued transactions to the refs of local stores."""
+
+
+import collections
+
+from consonant import util
+from consonant.store.local import transactions, validate
+from consonant.transaction import validation
+from consonant.util import timing
+
+
+class TransactionResult(object):
+
+    """The result of writing a queued transaction.
+
+    Until the transaction is written, both the commit and the error are
+    None. Afterwards, the commit is the commit the transaction resulted
+    in and the error is the exception that made the transaction fail.
+    If neither is set, the transaction was rejected by a validation
+    hook.
+
+    """
+
+    def __init__(self, transaction):
+        self.transaction = transaction
+        self.commit = None
+        self.error = None
+
+
+class RefWriter(object):
+
+    """Writes queued transactions to a ref in the order they were queued.
+
+    Every transaction is prepared on its source commit and validated
+    once. The transactions are then chained onto the head of the ref
+    one after another, replaying the changes of a transaction if its
+    source commit is not the current tip of the chain and validating
+    them again. A transaction that fails or conflicts with earlier ones
+    is left out without affecting the others. The ref is updated only
+    once for all transactions written together.
+
+    """
+
+    def __init__(self, store, name, hooks=[]):
+        self.store = store
+        self.name = name
+        self.hooks = hooks
+        self.queue = collections.deque()
+
+    def queue_transaction(self, transaction):
+        """Queue a transaction and return a result to be filled in later."""
+
+        result = TransactionResult(transaction)
+        self.queue.append(result)
+        return result
+
+    def flush(self):
+        """Write all queued transactions and return their results."""
+
+        batch = list(self.queue)
+        self.queue.clear()
+
+        # prepare and validate every transaction on its source commit
+        rebasers = {}
+        for result in batch:
+            try:
+                rebaser = self._prepare_transaction(result.transaction)
+                if rebaser is not None:
+                    rebasers[result] = rebaser
+            except Exception, e:
+                result.error = e
+
+        # errors writing to the ref, e.g. because it does not exist,
+        # only fail the transactions of this writer
+        try:
+            updated = self._write_transactions(batch, rebasers)
+        except Exception, e:
+            for result in rebasers:
+                result.commit = None
+                result.error = e
+            return batch
+
+        # let everyone watching the store know about the new head
+        if updated:
+            self.store.watcher.check()
+
+        return batch
+
+    def _write_transactions(self, batch, rebasers):
+        attempts = 0
+        ref = self.store.ref(self.name)
+        head = ref.head
+        tip = None
+        while True:
+            if tip is None:
+                tip = self._chain_transactions(batch, rebasers, head)
+                if tip.sha1 == head.sha1:
+                    return False
+
+            # attempt to update the ref once for all transactions; if it
+            # is locked, wait for a moment, and if it was moved on by
+            # someone else in the meantime, chain the transactions onto
+            # the new head, before trying again
+            try:
+                self.store._update_ref(
+                    ref.name, tip, head.sha1, 'transactions')
+            except util.gitrefs.RefLockedError, e:
+                attempts += 1
+                if attempts >= self.store.max_rebase_attempts:
+                    self._fail_written(batch, e)
+                    return False
+                self.store._wait_for_ref_lock(attempts)
+                new_head = self.store.ref(ref.name).head
+                if new_head.sha1 != head.sha1:
+                    head = new_head
+                    tip = None
+            except util.gitrefs.RefMovedError, e:
+                attempts += 1
+                new_head = self.store.ref(ref.name).head
+                if new_head.sha1 == head.sha1 or \
+                        attempts >= self.store.max_rebase_attempts:
+                    self._fail_written(batch, e)
+                    return False
+                head = new_head
+                tip = None
+            else:
+                return True
+
+    def _fail_written(self, batch, error):
+        for result in batch:
+            if result.commit is not None:
+                result.commit = None
+                result.error = error
+
+    def _prepare_transaction(self, transaction):
+        commit = self.store._prepare_transaction(transaction)
+        validator = validation.CommitValidator()
+        validator.add_hook(validate.LocalCommitValidator())
+        for hook in self.hooks:
+            validator.add_hook(hook)
+        with timing.measure('validation'):
+            valid = validator.validate(self.store, commit)
+        if valid:
+            return transactions.TransactionRebaser(
+                self.store, transaction, commit)
+        else:
+            return None
+
+    def _chain_transactions(self, batch, rebasers, head):
+        tip = head
+        for result in batch:
+            if result in rebasers:
+                result.commit = None
+                result.error = None
+                try:
+                    commit = self.store._rebase_transaction(
+                        rebasers[result], tip, self.hooks)
+                except Exception, e:
+                    result.error = e
+                else:
+                    if commit is not None:
+                        result.commit = commit
+                        tip = commit
+        return tip
@@ -20,6 +20,8 @@
 
 import pygit2
 
+from StringIO import StringIO
+
 from consonant.util import expressions, timestamps
 
 
@@ -116,10 +118,11 @@ class DeleteAction(Action):
 
     """Class to represent delete actions in transactions."""
 
-    def __init__(self, id, uuid, action_id):
+    def __init__(self, id, uuid, action_id, expected_tree=None):
         Action.__init__(self, id)
         self.uuid = uuid
         self.action_id = action_id
+        self.expected_tree = expected_tree
 
     def __eq__(self, other):
         if not isinstance(other, DeleteAction):
@@ -127,18 +130,20 @@ class DeleteAction(Action):
         else:
             return self.id == other.id \
                 and self.uuid == other.uuid \
-                and self.action_id == other.action_id
+                and self.action_id == other.action_id \
+                and self.expected_tree == other.expected_tree
 
 
 class UpdateAction(Action):
 
     """Class to represent update actions in transactions."""
 
-    def __init__(self, id, uuid, action_id, properties):
+    def __init__(self, id, uuid, action_id, properties, expected_tree=None):
         Action.__init__(self, id)
         self.uuid = uuid
         self.action_id = action_id
         self.properties = dict((p.name, p) for p in properties)
+        self.expected_tree = expected_tree
 
     def __eq__(self, other):
         if not isinstance(other, UpdateAction):
@@ -147,20 +152,42 @@ class UpdateAction(Action):
             return self.id == other.id \
                 and self.uuid == other.uuid \
                 and self.action_id == other.action_id \
-                and self.properties == other.properties
+                and self.properties == other.properties \
+                and self.expected_tree == other.expected_tree
 
 
 class UpdateRawPropertyAction(Action):
 
-    """Class to represent update-raw-property actions in transactions."""
+    """Class to represent update-raw-property actions in transactions.
 
-    def __init__(self, id, uuid, action_id, property, content_type, data):
+    The raw property data is either a string or a file-like object, e.g.
+    a temporary file the data was spooled to while parsing.
+
+    """
+
+    def __init__(self, id, uuid, action_id, property, content_type, data,
+                 expected_tree=None):
         Action.__init__(self, id)
         self.uuid = uuid
         self.action_id = action_id
         self.property = property
         self.content_type = content_type
         self.data = data
+        self.expected_tree = expected_tree
+
+    def data_stream(self):
+        """Return a file-like object to read the raw property data from."""
+
+        if isinstance(self.data, basestring):
+            return StringIO(self.data)
+        else:
+            self.data.seek(0)
+            return self.data
+
+    def read_data(self):
+        """Return the raw property data as a string."""
+
+        return self.data_stream().read()
 
     def __eq__(self, other):
         if not isinstance(other, UpdateRawPropertyAction):
@@ -171,18 +198,20 @@ class UpdateRawPropertyAction(Action):
                 and self.action_id == other.action_id \
                 and self.property == other.property \
                 and self.content_type == other.content_type \
-                and self.data == other.data
+                and self.expected_tree == other.expected_tree \
+                and self.read_data() == other.read_data()
 
 
 class UnsetRawPropertyAction(Action):
 
     """Class to represent unset-raw-property actions in transactions."""
 
-    def __init__(self, id, uuid, action_id, property):
+    def __init__(self, id, uuid, action_id, property, expected_tree=None):
         Action.__init__(self, id)
         self.uuid = uuid
         self.action_id = action_id
         self.property = property
+        self.expected_tree = expected_tree
 
     def __eq__(self, other):
         if not isinstance(other, UnsetRawPropertyAction):
@@ -191,4 +220,5 @@ class UnsetRawPropertyAction(Action):
             return self.id == other.id \
                 and self.uuid == other.uuid \
                 and self.action_id == other.action_id \
-                and self.property == other.property
+                and self.property == other.property \
+                and self.expected_tree == other.expected_tree
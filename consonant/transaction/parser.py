@@ -18,13 +18,15 @@
 """Classes for parsing transactions and representing parse errors."""
 
 
-import email
 import json
 import yaml
 
+from StringIO import StringIO
+
 from consonant.store import properties
 from consonant.transaction import actions, transaction
 from consonant.util import expressions
+from consonant.util.multipart import MultipartReader
 from consonant.util.phase import Phase
 
 
@@ -364,6 +366,15 @@ class ActionObjectAmbiguousError(ActionError):
                'at the same time: %s' % self.part.get_payload().strip()
 
 
+class ActionObjectTreeInvalidError(ActionError):
+
+    """Error for when an action expects an invalid object tree."""
+
+    def __str__(self):
+        return 'Action expects an invalid object tree or one for an ' \
+               'object without a UUID: %s' % self.part.get_payload().strip()
+
+
 class ActionPropertyNotAStringError(ActionError):
 
     """Error for when a raw property action defines a non-string property."""
@@ -419,48 +430,66 @@ class ActionRawPropertyContentTypeUndefinedError(ActionError):
 
 class TransactionParser(object):
 
-    """Parser for multipart/mixed transaction."""
+    """Parser for multipart/mixed transaction.
+
+    Transactions are read incrementally from strings or file-like
+    objects. Every action is parsed and validated as soon as it has
+    been read, so that invalid transactions are rejected without
+    reading the rest of the input. The payloads of raw property data
+    parts larger than spool_size bytes are spooled to temporary files
+    and UpdateRawPropertyAction objects refer to these files instead
+    of holding the data in memory.
+
+    """
+
+    def __init__(self, spool_size=1024*1024):
+        self.spool_size = spool_size
 
     def parse(self, data):
         """Parse a transaction and return a Transaction object."""
 
-        # phase 1: read transaction from stream, if necessary
+        # phase 1: start reading the transaction from a string or stream
         with ParserPhase() as phase:
             try:
-                if not isinstance(data, basestring):
-                    data = data.read()
+                if isinstance(data, basestring):
+                    data = StringIO(data)
+                reader = MultipartReader(data, self.spool_size)
             except Exception, e:
                 phase.error(e)
 
-        # phase 2: load the multipart/mixed data
+        # phase 2: make sure the transaction is multipart/mixed data
         with ParserPhase() as phase:
-            message = email.message_from_string(data)
-            if not message.is_multipart():
+            if not reader.is_multipart() or reader.peek_part() is None:
                 phase.error(TransactionNotMultipartMixedError(phase))
 
         # phase 3: parse and validate actions
         with ParserPhase() as phase:
-            parts = message.get_payload()
-            _actions = self._parse_actions(phase, parts)
+            _actions = self._parse_actions(phase, reader)
             self._validate_action_ids(phase, _actions)
             return transaction.Transaction(_actions)
 
     def _parse_actions(self, phase, parts):
-        begin = self._parse_begin_action(phase, parts[0])
-
-        if not phase.errors:
-            commit = self._parse_commit_action(phase, parts[-1])
+        first = parts.next_part()
+        begin = self._parse_begin_action(phase, first)
+        if phase.errors:
+            raise phase
 
+        # parse actions as they arrive, the last part is the commit action
         _actions = []
         _actions.append(begin)
-        index = 1
-        while index < len(parts)-1:
-            old_index = index
+        last = first
+        while parts.peek_part() is not None:
+            part = parts.next_part()
+            if parts.peek_part() is None:
+                last = part
+                break
             with ParserPhase() as _phase:
-                action, index = self._parse_other_action(
-                    _phase, index, parts[index], parts)
+                action = self._parse_other_action(_phase, part, parts)
             _actions.append(action)
-            assert index > old_index
+
+        commit = self._parse_commit_action(phase, last)
+        if phase.errors:
+            raise phase
         _actions.append(commit)
         return _actions
 
@@ -552,7 +581,7 @@ class TransactionParser(object):
                 data['committer-date'],
                 data['message'])
 
-    def _parse_other_action(self, phase, index, part, parts):
+    def _parse_other_action(self, phase, part, parts):
         self._check_for_content_type(
             phase, part, 'application/x-yaml', 'application/json')
 
@@ -571,9 +600,9 @@ class TransactionParser(object):
                     phase, part, data['action']))
 
         if not phase.errors:
-            return getattr(self, parse_func)(phase, index, part, parts, data)
+            return getattr(self, parse_func)(phase, part, parts, data)
 
-    def _parse_create_action(self, phase, index, part, parts, data):
+    def _parse_create_action(self, phase, part, parts, data):
         if 'class' not in data:
             phase.error(ActionClassUndefinedError(phase, part))
 
@@ -589,56 +618,39 @@ class TransactionParser(object):
         if not phase.errors:
             klass = data['class']
             props = [properties.Property(k, v) for k, v in props.iteritems()]
-            action = actions.CreateAction(data.get('id', None), klass, props)
-            return action, index + 1
+            return actions.CreateAction(data.get('id', None), klass, props)
 
-    def _parse_update_action(self, phase, index, part, parts, data):
+    def _parse_update_action(self, phase, part, parts, data):
         if 'object' not in data:
             phase.error(ActionObjectUndefinedError(phase, part))
         else:
-            obj = data['object']
-            if not isinstance(obj, dict):
-                phase.error(ActionObjectInvalidError(phase, part))
-            else:
-                if 'action' not in obj and 'uuid' not in obj:
-                    phase.error(ActionObjectInvalidError(phase, part))
-                elif 'action' in obj and 'uuid' in obj:
-                    phase.error(ActionObjectAmbiguousError(phase, part))
+            obj = self._load_object_or_action_reference(phase, part, data)
 
             props = data.get('properties', {})
             if not isinstance(props, dict):
                 phase.error(ActionPropertiesNotADictError(phase, part, props))
 
         if not phase.errors:
-            uuid = data['object'].get('uuid', None)
-            action_id = data['object'].get('action', None)
+            uuid = obj.get('uuid', None)
+            action_id = obj.get('action', None)
             props = [properties.Property(k, v) for k, v in props.iteritems()]
-            action = actions.UpdateAction(
-                data.get('id', None), uuid, action_id, props)
-            return action, index + 1
+            return actions.UpdateAction(
+                data.get('id', None), uuid, action_id, props,
+                obj.get('tree', None))
 
-    def _parse_delete_action(self, phase, index, part, parts, data):
+    def _parse_delete_action(self, phase, part, parts, data):
         if 'object' not in data:
             phase.error(ActionObjectUndefinedError(phase, part))
         else:
-            obj = data['object']
-            if not isinstance(obj, dict):
-                phase.error(ActionObjectInvalidError(phase, part))
-            else:
-                if 'action' not in obj and 'uuid' not in obj:
-                    phase.error(ActionObjectInvalidError(phase, part))
-                elif 'action' in obj and 'uuid' in obj:
-                    phase.error(ActionObjectAmbiguousError(phase, part))
+            obj = self._load_object_or_action_reference(phase, part, data)
 
         if not phase.errors:
-            uuid = data['object'].get('uuid', None)
-            action_id = data['object'].get('action', None)
-            action = actions.DeleteAction(
-                data.get('id', None), uuid, action_id)
-            return action, index + 1
-
-    def _parse_unset_raw_property_action(
-            self, phase, index, part, parts, data):
+            uuid = obj.get('uuid', None)
+            action_id = obj.get('action', None)
+            return actions.DeleteAction(
+                data.get('id', None), uuid, action_id, obj.get('tree', None))
+
+    def _parse_unset_raw_property_action(self, phase, part, parts, data):
         if 'object' not in data:
             phase.error(ActionObjectUndefinedError(phase, part))
         else:
@@ -648,23 +660,23 @@ class TransactionParser(object):
         if not phase.errors:
             uuid = obj.get('uuid', None)
             action_id = obj.get('action', None)
-            action = actions.UnsetRawPropertyAction(
-                data.get('id', None), uuid, action_id, prop)
-            return action, index + 1
+            return actions.UnsetRawPropertyAction(
+                data.get('id', None), uuid, action_id, prop,
+                obj.get('tree', None))
 
-    def _parse_update_raw_property_action(
-            self, phase, index, part, parts, data):
+    def _parse_update_raw_property_action(self, phase, part, parts, data):
         if 'object' not in data:
             phase.error(ActionObjectUndefinedError(phase, part))
         else:
             obj = self._load_object_or_action_reference(phase, part, data)
             prop = self._load_raw_property_name(phase, part, data)
 
-        if index >= len(parts)-2:
+        # the raw data part must not be the last part (the commit action)
+        if parts.peek_part(1) is None:
             phase.error(ActionRawPropertyDataMissingError(phase, part))
 
         if not phase.errors:
-            raw_data_part = parts[index + 1]
+            raw_data_part = parts.next_part()
 
             if 'Content-Type' not in raw_data_part:
                 phase.error(ActionRawPropertyContentTypeUndefinedError(
@@ -674,11 +686,10 @@ class TransactionParser(object):
             uuid = obj.get('uuid', None)
             action_id = obj.get('action', None)
             content_type = raw_data_part['Content-Type']
-            raw_data = raw_data_part.get_payload()
-            action = actions.UpdateRawPropertyAction(
+            raw_data = raw_data_part.get_payload_file()
+            return actions.UpdateRawPropertyAction(
                 data.get('id', None), uuid, action_id, prop,
-                content_type, raw_data)
-            return action, index + 2
+                content_type, raw_data, obj.get('tree', None))
 
     def _check_for_content_type(self, phase, part, *types):
         if 'Content-Type' not in part:
@@ -709,6 +720,14 @@ class TransactionParser(object):
                 phase.error(ActionObjectInvalidError(phase, part))
             elif 'action' in obj and 'uuid' in obj:
                 phase.error(ActionObjectAmbiguousError(phase, part))
+
+            # objects referred to via their UUID may define the tree
+            # the object is expected to have in the source commit
+            if 'tree' in obj:
+                if 'uuid' not in obj \
+                        or not isinstance(obj['tree'], basestring) \
+                        or not expressions.tree_sha1.match(obj['tree']):
+                    phase.error(ActionObjectTreeInvalidError(phase, part))
         return obj
 
     def _load_raw_property_name(self, phase, part, data):
@@ -1272,6 +1272,135 @@ message: hello
             'Samuel Bartlett <samuel@yourproject.org>', '1379947345 +0100',
             'hello'))
 
+    def test_parsing_fails_if_an_update_action_expects_an_invalid_tree(self):
+        """Verify parsing fails if an update action expects an invalid tree."""
+
+        self.assertRaisesRegexp(
+            parser.ParserPhaseError,
+            '^'
+            'ActionObjectTreeInvalidError: '
+            'Action expects an invalid object tree or one for an object '
+            'without a UUID: '
+            'action: update\n'
+            'object:\n'
+            '  uuid: 505aca2c-9892-4da6-943d-f3e869f6fbee\n'
+            '  tree: 8c1abcdc\n'
+            'properties:\n'
+            '  title: Some title'
+            '$',
+            self.parser.parse,
+            '''\
+Content-Type: multipart/mixed; boundary=CONSONANT
+
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: begin
+source: 8c1abcdc914e174d040e151015aecc89445fa110
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: update
+object:
+  uuid: 505aca2c-9892-4da6-943d-f3e869f6fbee
+  tree: 8c1abcdc
+properties:
+  title: Some title
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: commit
+target: refs/heads/master
+author: Samuel Bartlett <samuel@yourproject.org>
+author-date: 1379947345 +0100
+committer: Samuel Bartlett <samuel@yourproject.org>
+committer-date: 1379947345 +0100
+message: hello
+            ''')
+
+        self.assertRaisesRegexp(
+            parser.ParserPhaseError,
+            '^'
+            'ActionObjectTreeInvalidError: '
+            'Action expects an invalid object tree or one for an object '
+            'without a UUID: '
+            'action: update\n'
+            'object:\n'
+            '  action: 1\n'
+            '  tree: 8c1abcdc914e174d040e151015aecc89445fa110\n'
+            'properties:\n'
+            '  title: Some title'
+            '$',
+            self.parser.parse,
+            '''\
+Content-Type: multipart/mixed; boundary=CONSONANT
+
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: begin
+source: 8c1abcdc914e174d040e151015aecc89445fa110
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: update
+object:
+  action: 1
+  tree: 8c1abcdc914e174d040e151015aecc89445fa110
+properties:
+  title: Some title
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: commit
+target: refs/heads/master
+author: Samuel Bartlett <samuel@yourproject.org>
+author-date: 1379947345 +0100
+committer: Samuel Bartlett <samuel@yourproject.org>
+committer-date: 1379947345 +0100
+message: hello
+            ''')
+
+    def test_parsing_an_update_action_with_an_expected_tree_works(self):
+        """Verify parsing an update action with an expected tree works."""
+
+        t = self.parser.parse('''\
+Content-Type: multipart/mixed; boundary=CONSONANT
+
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: begin
+source: 8c1abcdc914e174d040e151015aecc89445fa110
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: update
+object:
+  uuid: 505aca2c-9892-4da6-943d-f3e869f6fbee
+  tree: 3a1d2ca5a6e9f0b8bfcb4c4d5e0fbd4f4ff7d1c2
+properties:
+  title: xyz
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: commit
+target: refs/heads/master
+author: Samuel Bartlett <samuel@yourproject.org>
+author-date: 1379947345 +0100
+committer: Samuel Bartlett <samuel@yourproject.org>
+committer-date: 1379947345 +0100
+message: hello
+            ''')
+
+        self.assertEqual(t.actions[1], actions.UpdateAction(
+            None, '505aca2c-9892-4da6-943d-f3e869f6fbee', None,
+            [properties.Property('title', 'xyz')],
+            '3a1d2ca5a6e9f0b8bfcb4c4d5e0fbd4f4ff7d1c2'))
+        self.assertFalse(t.actions[1] == actions.UpdateAction(
+            None, '505aca2c-9892-4da6-943d-f3e869f6fbee', None,
+            [properties.Property('title', 'xyz')]))
+
     def test_parsing_fails_if_a_delete_action_defines_no_object(self):
         """Verify parsing fails if a delete action defines no object."""
 
@@ -1463,6 +1592,40 @@ message: hello
             'Samuel Bartlett <samuel@yourproject.org>', '1379947345 +0100',
             'hello'))
 
+    def test_parsing_a_delete_action_with_an_expected_tree_works(self):
+        """Verify parsing a delete action with an expected tree works."""
+
+        t = self.parser.parse('''\
+Content-Type: multipart/mixed; boundary=CONSONANT
+
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: begin
+source: 8c1abcdc914e174d040e151015aecc89445fa110
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: delete
+object:
+  uuid: 505aca2c-9892-4da6-943d-f3e869f6fbee
+  tree: 3a1d2ca5a6e9f0b8bfcb4c4d5e0fbd4f4ff7d1c2
+--CONSONANT
+Content-Type: application/x-yaml
+
+action: commit
+target: refs/heads/master
+author: Samuel Bartlett <samuel@yourproject.org>
+author-date: 1379947345 +0100
+committer: Samuel Bartlett <samuel@yourproject.org>
+committer-date: 1379947345 +0100
+message: hello
+            ''')
+
+        self.assertEqual(t.actions[1], actions.DeleteAction(
+            None, '505aca2c-9892-4da6-943d-f3e869f6fbee', None,
+            '3a1d2ca5a6e9f0b8bfcb4c4d5e0fbd4f4ff7d1c2'))
+
     def test_parsing_fails_if_an_unset_raw_prop_defines_no_object(self):
         """Verify parsing fails if a unset raw action defines no object."""
 
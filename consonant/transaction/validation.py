@@ -98,6 +98,22 @@ class ActionReferencesALaterActionError(ActionValidationError):
         return 'Action refers to a later action: %s' % self.action_id
 
 
+class ActionObjectTreeMismatchError(ActionValidationError):
+
+    """Exception for when an object's tree is not the one an action expects."""
+
+    def __init__(self, action, schema, uuid, expected_tree, tree):
+        ActionValidationError.__init__(self, action, schema)
+        self.uuid = uuid
+        self.expected_tree = expected_tree
+        self.tree = tree
+
+    def __str__(self):
+        return 'Action expects object %s to have the tree %s ' \
+               'but it has the tree %s' % \
+               (self.uuid, self.expected_tree, self.tree)
+
+
 class ReferencePropertyActionNonExistentError(ActionValidationError):
 
     """Exception for when a non-exist action object reference is used."""
@@ -170,6 +186,34 @@ class ActionIllegalNonRawPropertyChangeError(ActionValidationError):
                (self.prop_name, self.klass, self.action.id)
 
 
+class TransactionConflictError(ValidationError):
+
+    """Exception for when a transaction conflicts with a newer ref head.
+
+    This exception is raised if the target ref of a transaction has
+    moved on since its source commit and the commits added to the ref
+    in the meantime touch objects changed by the transaction, objects
+    whose tree the transaction expects or anything but objects, or if
+    one side deletes objects that are referenced by the other side.
+
+    """
+
+    def __init__(self, target, source, head, uuids):
+        self.target = target
+        self.source = source
+        self.head = head
+        self.uuids = uuids
+
+    def __str__(self):
+        if self.uuids:
+            changes = 'objects %s' % ', '.join(sorted(self.uuids))
+        else:
+            changes = 'the store metadata'
+        return 'Transaction based on %s conflicts with changes to %s ' \
+               'in "%s" up to %s' % \
+               (self.source, changes, self.target, self.head)
+
+
 class ValidationHook(object):
 
     """A hook to register with CommitValidator for extra validation."""
@@ -18,8 +18,15 @@
 """Miscellaneous utility classes."""
 
 
+import coalescing
 import converters
 import expressions
 import gitcli
+import gitobjects
+import gitrefs
+import metrics
+import multipart
 import phase
+import profiling
 import timestamps
+import timing
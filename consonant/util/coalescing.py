@@ -0,0 +1,97 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Helper utilities to run identical concurrent calls only once."""
+
+
+import sys
+import threading
+
+
+class Call(object):
+
+    """A call in progress that other calls with the same key wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+
+class Coalescer(object):
+
+    """Runs identical concurrent calls only once and shares their result.
+
+    Calls are identified by a key. While a call for a key is running,
+    further calls with the same key from other threads wait for it to
+    finish and return its result or raise its exception, instead of
+    doing the same work again. Once the call has finished, the next
+    call with the key does the work again, so results are never reused
+    after the fact.
+
+    The number of calls that did the work is counted in executions,
+    the number of calls that waited for another call in waiters and
+    the largest number of calls that waited for a single call in
+    max_waiters.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executions = 0
+        self.waiters = 0
+        self.max_waiters = 0
+
+    @property
+    def in_flight(self):
+        """Return the number of calls currently running."""
+
+        return len(self.calls)
+
+    def call(self, key, func, *args):
+        """Return func(*args), sharing the result with identical calls."""
+
+        with self.lock:
+            call = self.calls.get(key, None)
+            if call is None:
+                call = self.calls[key] = Call()
+                self.executions += 1
+                running = False
+            else:
+                call.waiters += 1
+                self.waiters += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+                running = True
+
+        if running:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
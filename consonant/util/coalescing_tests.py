@@ -0,0 +1,103 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for helper utilities to run identical calls only once."""
+
+
+import threading
+import unittest
+
+from consonant.util import coalescing
+
+
+class CoalescerTests(unittest.TestCase):
+
+    """Unit tests for the Coalescer class."""
+
+    def setUp(self):
+        """Initialise a coalescer and a call that blocks until released."""
+
+        self.coalescer = coalescing.Coalescer()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.runs = []
+
+    def _blocking_call(self, value):
+        self.runs.append(value)
+        self.started.set()
+        self.release.wait()
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def _start_threads(self, key, value, count):
+        results = []
+
+        def run():
+            try:
+                results.append(self.coalescer.call(
+                    key, self._blocking_call, value))
+            except Exception, e:
+                results.append(e)
+
+        threads = [threading.Thread(target=run)]
+        threads[0].start()
+        self.started.wait()
+        for _ in xrange(count - 1):
+            threads.append(threading.Thread(target=run))
+            threads[-1].start()
+        while self.coalescer.waiters < count - 1:
+            threading.Event().wait(0.001)
+        return threads, results
+
+    def test_identical_concurrent_calls_run_once(self):
+        """Verify that concurrent calls with the same key share a result."""
+
+        threads, results = self._start_threads('key', 'result', 5)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.runs, ['result'])
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(self.coalescer.executions, 1)
+        self.assertEqual(self.coalescer.waiters, 4)
+        self.assertEqual(self.coalescer.max_waiters, 4)
+        self.assertEqual(self.coalescer.in_flight, 0)
+
+    def test_errors_are_raised_in_all_waiting_calls(self):
+        """Verify that an error of the running call is raised for all."""
+
+        error = ValueError('failed')
+        threads, results = self._start_threads('key', error, 3)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [error] * 3)
+        self.assertEqual(self.coalescer.in_flight, 0)
+
+    def test_calls_with_different_keys_or_later_calls_run_again(self):
+        """Verify that results are only shared between concurrent calls."""
+
+        self.release.set()
+        self.assertEqual(self.coalescer.call('a', self._blocking_call, 1), 1)
+        self.assertEqual(self.coalescer.call('a', self._blocking_call, 2), 2)
+        self.assertEqual(self.coalescer.call('b', self._blocking_call, 3), 3)
+        self.assertEqual(self.runs, [1, 2, 3])
+        self.assertEqual(self.coalescer.executions, 3)
+        self.assertEqual(self.coalescer.waiters, 0)
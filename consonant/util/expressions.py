@@ -29,6 +29,7 @@ class_name = re.compile('^[a-zA-Z][a-zA-Z0-9-]*[a-zA-Z0-9]$')
 object_uuid = re.compile('^([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9-]*[a-zA-Z0-9])$')
 property_name = re.compile('^[a-zA-Z][a-zA-Z0-9-]*[a-zA-Z0-9]$')
 commit_sha1 = re.compile('^([0-9abcdefABCDEF]{8}|[0-9abcdefABCDEF]{40})$')
+tree_sha1 = re.compile('^[0-9abcdefABCDEF]{40}$')
 commit_author = re.compile('^([^<>]+) ?<([^<>]+)>$')
 commit_committer = re.compile('^([^<>]+) ?<([^<>]+)>$')
 commit_date = re.compile('^[0-9]+ [\+-][0-9]{4}$')
@@ -0,0 +1,123 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Helper utilities to write Git objects from streams in chunks."""
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
+
+
+class BlobSizeMismatchError(Exception):
+
+    """Exception for when a stream is shorter or longer than announced."""
+
+    def __init__(self, expected, actual):
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return 'Expected %d bytes of blob data but got %d' % \
+            (self.expected, self.actual)
+
+
+def stream_size(stream):
+    """Return the number of bytes left in a seekable stream or None."""
+
+    try:
+        position = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(position)
+        return size - position
+    except (AttributeError, IOError):
+        return None
+
+
+def write_blob(repo, stream, size=None, chunk_size=64*1024):
+    """Write a blob from a stream as a loose object and return its SHA1.
+
+    The blob is hashed, compressed and written in chunks of chunk_size
+    bytes, so memory use does not depend on the size of the blob. Git
+    needs to know the size of a blob before its data can be hashed, so
+    if no size is given and the stream cannot be seeked, its contents
+    are copied to a temporary file first.
+
+    """
+
+    if size is None:
+        size = stream_size(stream)
+    if size is None:
+        spooled = tempfile.TemporaryFile()
+        shutil.copyfileobj(stream, spooled, chunk_size)
+        spooled.seek(0)
+        return write_blob(repo, spooled, None, chunk_size)
+
+    objects_dir = os.path.join(repo.path, 'objects')
+
+    sha1 = hashlib.sha1()
+    compressor = zlib.compressobj()
+    handle, tmpname = tempfile.mkstemp(prefix='tmp_obj_', dir=objects_dir)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            header = 'blob %d\0' % size
+            sha1.update(header)
+            f.write(compressor.compress(header))
+
+            written = 0
+            while True:
+                chunk = stream.read(min(chunk_size, size - written))
+                if not chunk:
+                    break
+                written += len(chunk)
+                sha1.update(chunk)
+                f.write(compressor.compress(chunk))
+                if written >= size:
+                    break
+            f.write(compressor.flush())
+
+            # count any data beyond the expected size for the error
+            chunk = stream.read(chunk_size)
+            while chunk:
+                written += len(chunk)
+                chunk = stream.read(chunk_size)
+            if written != size:
+                raise BlobSizeMismatchError(size, written)
+
+        # move the object into place unless it exists already
+        hexsha = sha1.hexdigest()
+        object_dir = os.path.join(objects_dir, hexsha[:2])
+        filename = os.path.join(object_dir, hexsha[2:])
+        if os.path.exists(filename):
+            os.remove(tmpname)
+        else:
+            if not os.path.isdir(object_dir):
+                try:
+                    os.mkdir(object_dir)
+                except OSError:
+                    if not os.path.isdir(object_dir):
+                        raise
+            os.chmod(tmpname, 0444)
+            os.rename(tmpname, filename)
+        return hexsha
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
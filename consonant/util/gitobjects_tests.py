@@ -0,0 +1,110 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for helper utilities to write Git objects from streams."""
+
+
+import os
+import pygit2
+import shutil
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+from consonant.util import gitcli, gitobjects
+
+
+class UnseekableStream(object):
+
+    """A stream that can only be read, not seeked."""
+
+    def __init__(self, data):
+        self.stream = StringIO(data)
+
+    def read(self, size=-1):
+        """Return a string with up to size bytes read from the stream."""
+
+        return self.stream.read(size)
+
+
+class WriteBlobTests(unittest.TestCase):
+
+    """Unit tests for the gitobjects.write_blob() function."""
+
+    def setUp(self):
+        """Initialise a temporary repository."""
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(self._remove_tempdir)
+
+        self.repo = pygit2.init_repository(
+            os.path.join(self.tmpdir, 'repo'), bare=True)
+
+    def _remove_tempdir(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_written_blobs_match_blobs_created_by_pygit2(self):
+        """Verify that blobs are identical to those created by pygit2."""
+
+        for data in ('', 'hello\n', 'x' * 100000):
+            sha1 = gitobjects.write_blob(
+                self.repo, StringIO(data), chunk_size=1000)
+            self.assertEqual(sha1, self.repo.create_blob(data).hex)
+            self.assertEqual(self.repo[sha1].data, data)
+
+    def test_written_blobs_are_valid_git_objects(self):
+        """Verify that Git can read and verify written blobs."""
+
+        sha1 = gitobjects.write_blob(self.repo, StringIO('hello world'))
+        output = gitcli.subcommand(self.repo, ['cat-file', 'blob', sha1])
+        self.assertEqual(output, 'hello world')
+        gitcli.subcommand(self.repo, ['fsck', '--strict'])
+
+    def test_writing_the_same_blob_twice_works(self):
+        """Verify that writing an existing blob again works."""
+
+        sha1 = gitobjects.write_blob(self.repo, StringIO('data'))
+        self.assertEqual(
+            gitobjects.write_blob(self.repo, StringIO('data')), sha1)
+
+    def test_blobs_can_be_written_from_unseekable_streams(self):
+        """Verify that blobs can be written from unseekable streams."""
+
+        sha1 = gitobjects.write_blob(self.repo, UnseekableStream('data'))
+        self.assertEqual(self.repo[sha1].data, 'data')
+
+    def test_writing_fails_if_the_stream_does_not_match_the_size(self):
+        """Verify that writing fails if the stream is shorter or longer."""
+
+        self.assertRaises(
+            gitobjects.BlobSizeMismatchError, gitobjects.write_blob,
+            self.repo, UnseekableStream('data'), 5)
+        self.assertRaises(
+            gitobjects.BlobSizeMismatchError, gitobjects.write_blob,
+            self.repo, UnseekableStream('data'), 3)
+        self.assertEqual(
+            [x for x in os.listdir(os.path.join(self.repo.path, 'objects'))
+             if x.startswith('tmp_obj_')], [])
+
+    def test_only_the_rest_of_a_seekable_stream_is_written(self):
+        """Verify that data before the current stream position is skipped."""
+
+        stream = StringIO('skip this:data')
+        stream.seek(10)
+        sha1 = gitobjects.write_blob(self.repo, stream)
+        self.assertEqual(self.repo[sha1].data, 'data')
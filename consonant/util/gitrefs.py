@@ -0,0 +1,257 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Helper utilities to update Git refs atomically without running git."""
+
+
+import errno
+import getpass
+import os
+import re
+import socket
+import time
+
+
+null_sha1 = '0' * 40
+
+invalid_ref_name = re.compile(
+    r'(^/|/$|//|\.\.|@\{|^@$|[\000-\040\177~^:?*\[\\]|(^|/)\.|'
+    r'\.lock(/|$)|\.$)')
+
+
+class RefUpdateError(Exception):
+
+    """Base class for errors occuring while updating a ref."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class RefNameInvalidError(RefUpdateError):
+
+    """Exception for when a ref name is not a valid Git ref name."""
+
+    def __str__(self):
+        return 'Invalid ref name: %s' % self.name
+
+
+class RefLockedError(RefUpdateError):
+
+    """Exception for when a ref remains locked by someone else."""
+
+    def __str__(self):
+        return 'Unable to lock ref, it is locked by someone else: %s' % \
+            self.name
+
+
+class RefMovedError(RefUpdateError):
+
+    """Exception for when a ref does not point to the expected commit."""
+
+    def __init__(self, name, expected, actual):
+        RefUpdateError.__init__(self, name)
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return 'Ref %s points to %s instead of %s' % \
+            (self.name, self.actual or 'nothing', self.expected or 'nothing')
+
+
+def read_ref(repo, name):
+    """Return the SHA1 a ref points to or None if it doesn't exist.
+
+    Symbolic refs are followed. Loose refs take precedence over refs
+    in the packed-refs file, like in Git.
+
+    """
+
+    for _ in xrange(5):
+        try:
+            with open(os.path.join(repo.path, name)) as f:
+                value = f.read().strip()
+        except IOError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
+                raise
+            return _read_packed_ref(repo, name)
+        if value.startswith('ref: '):
+            name = value[5:]
+        else:
+            return value
+    return None
+
+
+def resolve_ref_name(repo, name):
+    """Return the name of the ref a possibly symbolic ref points to."""
+
+    for _ in xrange(5):
+        try:
+            with open(os.path.join(repo.path, name)) as f:
+                value = f.read().strip()
+        except IOError:
+            return name
+        if value.startswith('ref: '):
+            name = value[5:]
+        else:
+            return name
+    return name
+
+
+def update_ref(repo, name, new_sha1, old_sha1=None, message='',
+               committer=None, lock_timeout=0.1):
+    """Update a ref to a new SHA1 if it still points to the old SHA1.
+
+    The update is made the way Git makes it: the ref is locked by
+    creating <ref>.lock exclusively, its current value is compared with
+    old_sha1, the new SHA1 is written to the lock file and the lock file
+    is renamed to the ref. If old_sha1 is None, the ref is updated no
+    matter what it points to; if it is the null SHA1, the ref must not
+    exist yet. Symbolic refs are followed.
+
+    If Git would log the update, a reflog entry with the message is
+    appended for the ref and, if HEAD points to it, for HEAD. The
+    committer is a pygit2.Signature or None, in which case the current
+    user and time are used.
+
+    Raises a RefLockedError if the ref stays locked for lock_timeout
+    seconds and a RefMovedError if it does not point to old_sha1.
+
+    """
+
+    name = resolve_ref_name(repo, name)
+    if invalid_ref_name.search(name) or \
+            not (name.startswith('refs/') or name == 'HEAD'):
+        raise RefNameInvalidError(name)
+
+    filename = os.path.join(repo.path, name)
+    lockname = filename + '.lock'
+    lock = _lock_ref(name, lockname, lock_timeout)
+    try:
+        current_sha1 = read_ref(repo, name)
+        if old_sha1 is not None:
+            expected = None if old_sha1 == null_sha1 else old_sha1
+            if current_sha1 != expected:
+                raise RefMovedError(name, expected, current_sha1)
+
+        os.write(lock, '%s\n' % new_sha1)
+        os.close(lock)
+        lock = None
+
+        if _should_log(repo, name):
+            entry = _reflog_entry(
+                current_sha1 or null_sha1, new_sha1, committer, message)
+            _append_reflog(repo, name, entry)
+            if name != 'HEAD' and resolve_ref_name(repo, 'HEAD') == name:
+                _append_reflog(repo, 'HEAD', entry)
+
+        os.rename(lockname, filename)
+    except:
+        if lock is not None:
+            os.close(lock)
+        if os.path.exists(lockname):
+            os.remove(lockname)
+        raise
+
+
+def _lock_ref(name, lockname, timeout):
+    directory = os.path.dirname(lockname)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    deadline = time.time() + timeout
+    delay = 0.001
+    while True:
+        try:
+            return os.open(lockname, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                           0666)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            if time.time() >= deadline:
+                raise RefLockedError(name)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+
+def _read_packed_ref(repo, name):
+    try:
+        with open(os.path.join(repo.path, 'packed-refs')) as f:
+            for line in f:
+                if line.startswith('#') or line.startswith('^'):
+                    continue
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == name:
+                    return fields[0]
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    return None
+
+
+def _should_log(repo, name):
+    if os.path.exists(os.path.join(repo.path, 'logs', name)):
+        return True
+
+    # like in Git, updates are logged by default unless the repository
+    # is a bare repository
+    if 'core.logAllRefUpdates' in repo.config:
+        value = str(repo.config['core.logAllRefUpdates']).lower()
+    else:
+        value = 'false' if repo.is_bare else 'true'
+    if value == 'always':
+        return True
+    elif value in ('true', 'yes', 'on', '1'):
+        return name == 'HEAD' or any(name.startswith(prefix) for prefix in (
+            'refs/heads/', 'refs/remotes/', 'refs/notes/'))
+    return False
+
+
+def _reflog_entry(old_sha1, new_sha1, committer, message):
+    if committer is not None:
+        identity = '%s <%s>' % (committer.name, committer.email)
+        seconds, offset = committer.time, committer.offset
+    else:
+        identity = '%s <%s@%s>' % (
+            getpass.getuser(), getpass.getuser(), socket.getfqdn())
+        seconds = int(time.time())
+        offset = -(time.altzone if time.localtime().tm_isdst
+                   else time.timezone) // 60
+    sign = '-' if offset < 0 else '+'
+    hours, minutes = divmod(abs(offset), 60)
+    entry = '%s %s %s %d %s%02d%02d' % (
+        old_sha1, new_sha1, identity, seconds, sign, hours, minutes)
+    message = ' '.join(message.split())
+    if message:
+        entry += '\t%s' % message
+    return entry + '\n'
+
+
+def _append_reflog(repo, name, entry):
+    filename = os.path.join(repo.path, 'logs', name)
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    with open(filename, 'a') as f:
+        f.write(entry)
@@ -0,0 +1,150 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for helper utilities to update Git refs atomically."""
+
+
+import os
+import pygit2
+import shutil
+import tempfile
+import unittest
+
+from consonant.util import gitcli, gitrefs
+
+
+class UpdateRefTests(unittest.TestCase):
+
+    """Unit tests for the gitrefs.update_ref() function."""
+
+    def setUp(self):
+        """Initialise a temporary repository with two commits."""
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(self._remove_tempdir)
+
+        self.repo = pygit2.init_repository(
+            os.path.join(self.tmpdir, 'repo'), bare=False)
+        self.sha1s = []
+        for message in ('first', 'second'):
+            gitcli.subcommand(
+                self.repo,
+                ['-c', 'user.name=Test', '-c', 'user.email=test@test',
+                 'commit', '--allow-empty', '-m', message],
+                cwd=self.repo.workdir)
+            self.sha1s.append(gitcli.subcommand(
+                self.repo, ['rev-parse', 'HEAD']).strip())
+        self.signature = pygit2.Signature(
+            'Samuel Bartlett', 'samuel@yourproject.org', 1380539061, 60)
+
+    def _remove_tempdir(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _rev_parse(self, name):
+        return gitcli.subcommand(self.repo, ['rev-parse', name]).strip()
+
+    def test_updated_refs_are_seen_by_git(self):
+        """Verify that Git sees refs created and updated by update_ref()."""
+
+        gitrefs.update_ref(
+            self.repo, 'refs/heads/other', self.sha1s[0], gitrefs.null_sha1)
+        self.assertEqual(self._rev_parse('refs/heads/other'), self.sha1s[0])
+
+        gitrefs.update_ref(
+            self.repo, 'refs/heads/other', self.sha1s[1], self.sha1s[0])
+        self.assertEqual(self._rev_parse('refs/heads/other'), self.sha1s[1])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.repo.path, 'refs/heads/other.lock')))
+
+    def test_updating_fails_if_the_ref_has_moved(self):
+        """Verify that updating fails if the ref has moved on."""
+
+        self.assertRaises(
+            gitrefs.RefMovedError, gitrefs.update_ref,
+            self.repo, 'refs/heads/master', self.sha1s[1], self.sha1s[0])
+        self.assertRaises(
+            gitrefs.RefMovedError, gitrefs.update_ref,
+            self.repo, 'refs/heads/master', self.sha1s[0], gitrefs.null_sha1)
+        self.assertEqual(self._rev_parse('refs/heads/master'), self.sha1s[1])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.repo.path, 'refs/heads/master.lock')))
+
+    def test_updating_fails_if_the_ref_is_locked(self):
+        """Verify that updating fails if the ref stays locked."""
+
+        lockname = os.path.join(self.repo.path, 'refs/heads/master.lock')
+        open(lockname, 'w').close()
+        self.assertRaises(
+            gitrefs.RefLockedError, gitrefs.update_ref,
+            self.repo, 'refs/heads/master', self.sha1s[0], self.sha1s[1],
+            lock_timeout=0.01)
+        self.assertTrue(os.path.exists(lockname))
+        self.assertEqual(self._rev_parse('refs/heads/master'), self.sha1s[1])
+
+    def test_updating_fails_for_invalid_ref_names(self):
+        """Verify that updating fails for invalid ref names."""
+
+        for name in ('master', 'refs/heads/../config', 'refs/heads/x.lock',
+                     'refs/heads/a b', 'refs/heads/.hidden', '/refs/heads/x'):
+            self.assertRaises(
+                gitrefs.RefNameInvalidError, gitrefs.update_ref,
+                self.repo, name, self.sha1s[0])
+
+    def test_packed_refs_are_compared_with_the_old_sha1(self):
+        """Verify that refs only present in packed-refs can be updated."""
+
+        gitcli.subcommand(self.repo, ['pack-refs', '--all'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.repo.path, 'refs/heads/master')))
+        self.assertEqual(
+            gitrefs.read_ref(self.repo, 'refs/heads/master'), self.sha1s[1])
+
+        gitrefs.update_ref(
+            self.repo, 'refs/heads/master', self.sha1s[0], self.sha1s[1])
+        self.assertEqual(self._rev_parse('refs/heads/master'), self.sha1s[0])
+
+    def test_updates_are_logged_for_the_ref_and_head(self):
+        """Verify that updates are logged for the ref and HEAD."""
+
+        gitrefs.update_ref(
+            self.repo, 'refs/heads/master', self.sha1s[0], self.sha1s[1],
+            'consonant: roll back', self.signature)
+
+        for name in ('refs/heads/master', 'HEAD'):
+            output = gitcli.subcommand(
+                self.repo, ['reflog', 'show', '--format=%H %gs', name])
+            self.assertEqual(
+                output.splitlines()[0],
+                '%s consonant: roll back' % self.sha1s[0])
+
+        with open(os.path.join(
+                self.repo.path, 'logs', 'refs', 'heads', 'master')) as f:
+            entry = f.readlines()[-1]
+        self.assertEqual(
+            entry,
+            '%s %s Samuel Bartlett <samuel@yourproject.org> '
+            '1380539061 +0100\tconsonant: roll back\n' %
+            (self.sha1s[1], self.sha1s[0]))
+
+    def test_symbolic_refs_are_followed(self):
+        """Verify that updating a symbolic ref updates the ref it points to."""
+
+        gitrefs.update_ref(self.repo, 'HEAD', self.sha1s[0], self.sha1s[1])
+        self.assertEqual(self._rev_parse('refs/heads/master'), self.sha1s[0])
+        self.assertEqual(
+            gitcli.subcommand(self.repo, ['symbolic-ref', 'HEAD']).strip(),
+            'refs/heads/master')
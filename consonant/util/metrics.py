@@ -0,0 +1,234 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Helper utilities to collect metrics in the Prometheus text format."""
+
+
+import bisect
+import threading
+
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    elif isinstance(value, float):
+        return repr(value)
+    else:
+        return str(value)
+
+
+class Metric(object):
+
+    """Base class for metrics with a name, a help text and label names.
+
+    Values are recorded per tuple of label values, in the same order
+    as the label names.
+
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """Return a list of (suffix, label values, extra labels, value)."""
+
+        return []
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+
+        lines = ['# HELP %s %s' % (self.name, self.help.replace('\n', ' ')),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, values, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (
+                self.name, suffix, _format_labels(self.labels, values, extra),
+                _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+
+    """A metric with values that only ever go up."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.values = {}
+
+    def inc(self, values=(), amount=1):
+        """Increase the value for a tuple of label values."""
+
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def samples(self):
+        """Return a list of (suffix, label values, extra labels, value)."""
+
+        with self.lock:
+            return [('', values, (), value)
+                    for values, value in sorted(self.values.iteritems())]
+
+
+class Gauge(Counter):
+
+    """A metric with values that go up and down."""
+
+    type = 'gauge'
+
+    def dec(self, values=(), amount=1):
+        """Decrease the value for a tuple of label values."""
+
+        self.inc(values, -amount)
+
+    def set(self, value, values=()):
+        """Set the value for a tuple of label values."""
+
+        with self.lock:
+            self.values[values] = value
+
+
+class Histogram(Metric):
+
+    """A metric counting observed values in cumulative buckets.
+
+    The buckets are given by their sorted upper bounds. The sum and
+    the count of all observed values are recorded as well.
+
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, values=()):
+        """Record an observed value for a tuple of label values."""
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(values, None)
+            if entry is None:
+                entry = self.values[values] = \
+                    [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        """Return a list of (suffix, label values, extra labels, value)."""
+
+        samples = []
+        with self.lock:
+            for values, (counts, total, count) in \
+                    sorted(self.values.iteritems()):
+                cumulative = 0
+                bounds = self.buckets + (float('inf'),)
+                for bound, bucket_count in zip(bounds, counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', values,
+                                    [('le', _format_value(float(bound)))],
+                                    cumulative))
+                samples.append(('_sum', values, (), total))
+                samples.append(('_count', values, (), count))
+        return samples
+
+
+class CallbackMetric(Metric):
+
+    """A metric with values collected by a function when rendering.
+
+    The function returns a list of (label values, value) tuples. This
+    allows to expose counts kept elsewhere, e.g. by caches, without
+    any cost while the metric is not rendered.
+
+    """
+
+    def __init__(self, name, help, labels, func, type='gauge'):
+        Metric.__init__(self, name, help, labels)
+        self.func = func
+        self.type = type
+
+    def samples(self):
+        """Return a list of (suffix, label values, extra labels, value)."""
+
+        return [('', tuple(values), (), value)
+                for values, value in self.func()
+                if value is not None]
+
+
+class Registry(object):
+
+    """A collection of metrics that can be rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """Add a metric to the registry and return it."""
+
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        """Create, register and return a Counter."""
+
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        """Create, register and return a Gauge."""
+
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=default_buckets):
+        """Create, register and return a Histogram."""
+
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, labels, func, type='gauge'):
+        """Create, register and return a CallbackMetric."""
+
+        return self.register(CallbackMetric(name, help, labels, func, type))
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+
+        return ''.join(metric.render() for metric in self.metrics)
@@ -0,0 +1,96 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for helper utilities to collect Prometheus metrics."""
+
+
+import unittest
+
+from consonant.util import metrics
+
+
+class RegistryTests(unittest.TestCase):
+
+    """Unit tests for the Registry class and the metrics it creates."""
+
+    def setUp(self):
+        """Initialise an empty registry."""
+
+        self.registry = metrics.Registry()
+
+    def test_counters_are_rendered_per_label_values(self):
+        """Verify that counters are rendered with their labels."""
+
+        counter = self.registry.counter(
+            'transactions_total', 'Transactions.', ('outcome',))
+        counter.inc(('committed',))
+        counter.inc(('committed',), 2)
+        counter.inc(('fail"ed',))
+        self.assertEqual(
+            self.registry.render(),
+            '# HELP transactions_total Transactions.\n'
+            '# TYPE transactions_total counter\n'
+            'transactions_total{outcome="committed"} 3\n'
+            'transactions_total{outcome="fail\\"ed"} 1\n')
+
+    def test_gauges_go_up_and_down(self):
+        """Verify that gauges can be increased, decreased and set."""
+
+        gauge = self.registry.gauge('in_flight', 'Requests.')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(gauge.values, {(): 1})
+        gauge.set(7)
+        self.assertTrue(self.registry.render().endswith('\nin_flight 7\n'))
+
+    def test_histograms_count_values_in_cumulative_buckets(self):
+        """Verify that histograms render cumulative buckets, sum and count."""
+
+        histogram = self.registry.histogram(
+            'latency_seconds', 'Latency.', ('route',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, ('objects',))
+        lines = self.registry.render().splitlines()[2:]
+        self.assertEqual(lines, [
+            'latency_seconds_bucket{route="objects",le="0.1"} 2',
+            'latency_seconds_bucket{route="objects",le="1.0"} 3',
+            'latency_seconds_bucket{route="objects",le="+Inf"} 4',
+            'latency_seconds_sum{route="objects"} 2.65',
+            'latency_seconds_count{route="objects"} 4',
+            ])
+
+    def test_callback_metrics_are_collected_when_rendering(self):
+        """Verify that callback metrics call their function when rendered."""
+
+        values = {'lru': 3}
+        self.registry.callback(
+            'cache_hits_total', 'Hits.', ('tier',),
+            lambda: [((tier,), hits) for tier, hits in values.iteritems()],
+            'counter')
+        values['lru'] = 4
+        self.assertTrue(self.registry.render().endswith(
+            '# TYPE cache_hits_total counter\n'
+            'cache_hits_total{tier="lru"} 4\n'))
+
+    def test_callback_values_of_none_are_skipped(self):
+        """Verify that values of None returned by callbacks are skipped."""
+
+        self.registry.callback(
+            'evictions_total', 'Evictions.', ('tier',),
+            lambda: [(('memcached',), None), (('lru',), 1)])
+        self.assertFalse('memcached' in self.registry.render())
@@ -0,0 +1,211 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Classes to read MIME multipart messages incrementally from streams."""
+
+
+import collections
+import email
+import re
+import tempfile
+
+
+header_line = re.compile(r'^(From |[\041-\071\073-\176]{1,}:|[\t ])')
+
+
+class Part(object):
+
+    """A part of a multipart message with its payload in a spooled file."""
+
+    def __init__(self, headers, payload):
+        self.headers = headers
+        self.payload = payload
+
+    def __contains__(self, name):
+        return name in self.headers
+
+    def __getitem__(self, name):
+        return self.headers[name]
+
+    def get_payload(self):
+        """Return the payload of the part as a string."""
+
+        self.payload.seek(0)
+        return self.payload.read()
+
+    def get_payload_file(self):
+        """Return the file holding the payload, rewound to its start."""
+
+        self.payload.seek(0)
+        return self.payload
+
+
+class MultipartReader(object):
+
+    """Reads the parts of a MIME multipart message from a stream.
+
+    The headers of the message are read when the reader is created.
+    Parts are only read when they are asked for, one at a time. The
+    payload of every part is written to a SpooledTemporaryFile that
+    is moved to disk once it grows beyond spool_size bytes, and the
+    stream is read in chunks of at most chunk_size bytes, so that
+    large payloads are never held in memory as a whole.
+
+    Like in the email module, the line break in front of a boundary
+    delimiter belongs to the delimiter, not to the preceding payload.
+
+    """
+
+    def __init__(self, stream, spool_size=1024*1024, chunk_size=64*1024):
+        self.stream = stream
+        self.spool_size = spool_size
+        self.chunk_size = chunk_size
+        self.pushback = None
+        self.parts = collections.deque()
+        self.started = False
+        self.finished = False
+
+        self.headers = self._read_headers()
+        self.boundary = None
+        if self.headers.get_content_maintype() == 'multipart':
+            self.boundary = self.headers.get_boundary()
+        if self.boundary is not None:
+            self.delimiter = '--' + self.boundary
+
+    def is_multipart(self):
+        """Return whether the message is a multipart message."""
+
+        return self.boundary is not None
+
+    def peek_part(self, offset=0):
+        """Return an upcoming part without consuming it or None."""
+
+        while len(self.parts) <= offset and not self.finished:
+            part = self._read_part()
+            if part is None:
+                self.finished = True
+            else:
+                self.parts.append(part)
+        return self.parts[offset] if len(self.parts) > offset else None
+
+    def next_part(self):
+        """Consume and return the next part or None if there are no more."""
+
+        part = self.peek_part()
+        if part is not None:
+            self.parts.popleft()
+        return part
+
+    def _readline(self):
+        if self.pushback is not None:
+            line, self.pushback = self.pushback, None
+            return line
+
+        line = self.stream.readline(self.chunk_size)
+
+        # never split a CRLF line break between two chunks
+        if line.endswith('\r'):
+            char = self.stream.read(1)
+            if char == '\n':
+                line += char
+            elif char:
+                self.pushback = char
+        return line
+
+    def _read_headers(self):
+        lines = []
+        while True:
+            line = self._readline()
+            while line and not line.endswith('\n') and self.pushback is None:
+                rest = self._readline()
+                if not rest:
+                    break
+                line += rest
+            if not line or not line.strip('\r\n'):
+                break
+            if not header_line.match(line):
+                # there are no more headers, the line belongs to the body
+                self.pushback = line + (self.pushback or '')
+                break
+            lines.append(line)
+        return email.message_from_string(''.join(lines))
+
+    def _delimiter(self, line):
+        if not line.startswith(self.delimiter):
+            return None
+        rest = line[len(self.delimiter):]
+        closing = rest.startswith('--')
+        if closing:
+            rest = rest[2:]
+        if rest.strip(' \t\r\n'):
+            return None
+        return 'close' if closing else 'part'
+
+    def _read_part(self):
+        if not self.is_multipart():
+            return None
+
+        if not self.started:
+            # skip the preamble up to the first delimiter
+            self.started = True
+            at_line_start = True
+            while True:
+                line = self._readline()
+                if not line:
+                    return None
+                if at_line_start:
+                    delimiter = self._delimiter(line)
+                    if delimiter == 'close':
+                        return None
+                    elif delimiter == 'part':
+                        break
+                at_line_start = line.endswith('\n')
+
+        headers = self._read_headers()
+        payload = tempfile.SpooledTemporaryFile(self.spool_size)
+        if self._read_payload(payload):
+            self.finished = True
+        payload.seek(0)
+        return Part(headers, payload)
+
+    def _read_payload(self, payload):
+        # the line break of the last line is held back until we know
+        # whether the next line is a delimiter
+        pending = ''
+        at_line_start = True
+        while True:
+            line = self._readline()
+            if not line:
+                payload.write(pending)
+                return True
+
+            if at_line_start:
+                delimiter = self._delimiter(line)
+                if delimiter is not None:
+                    return delimiter == 'close'
+
+            payload.write(pending)
+            if line.endswith('\r\n'):
+                payload.write(line[:-2])
+                pending = '\r\n'
+            elif line.endswith('\n'):
+                payload.write(line[:-1])
+                pending = '\n'
+            else:
+                payload.write(line)
+                pending = ''
+            at_line_start = line.endswith('\n')
@@ -0,0 +1,187 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for reading MIME multipart messages incrementally."""
+
+
+import unittest
+
+from StringIO import StringIO
+
+from consonant.util.multipart import MultipartReader
+
+
+class MultipartReaderTests(unittest.TestCase):
+
+    """Unit tests for the MultipartReader class."""
+
+    def _reader(self, data, **kwargs):
+        return MultipartReader(StringIO(data), **kwargs)
+
+    def _payloads(self, reader):
+        payloads = []
+        part = reader.next_part()
+        while part is not None:
+            payloads.append(part.get_payload())
+            part = reader.next_part()
+        return payloads
+
+    def test_messages_without_multipart_content_type_are_not_multipart(self):
+        """Verify that messages without multipart content are detected."""
+
+        reader = self._reader('Content-Type: text/plain\n\nhello\n')
+        self.assertFalse(reader.is_multipart())
+        self.assertEqual(reader.next_part(), None)
+
+        reader = self._reader('!!!!!!!!')
+        self.assertFalse(reader.is_multipart())
+        self.assertEqual(reader.next_part(), None)
+
+    def test_parts_are_read_with_their_headers_and_payloads(self):
+        """Verify that parts are read with their headers and payloads."""
+
+        reader = self._reader(
+            'Content-Type: multipart/mixed; boundary=B\n'
+            '\n'
+            '--B\n'
+            'Content-Type: application/x-yaml\n'
+            '\n'
+            'action: begin\n'
+            '--B\n'
+            '\n'
+            'no headers\n'
+            '--B--\n')
+        self.assertTrue(reader.is_multipart())
+
+        part = reader.next_part()
+        self.assertTrue('Content-Type' in part)
+        self.assertEqual(part['Content-Type'], 'application/x-yaml')
+        self.assertEqual(part.get_payload(), 'action: begin')
+
+        part = reader.next_part()
+        self.assertFalse('Content-Type' in part)
+        self.assertEqual(part.get_payload(), 'no headers')
+
+        self.assertEqual(reader.next_part(), None)
+
+    def test_preamble_and_epilogue_are_ignored(self):
+        """Verify that the preamble and epilogue of a message are ignored."""
+
+        reader = self._reader(
+            'Content-Type: multipart/mixed; boundary=B\n'
+            '\n'
+            'preamble\n'
+            '--B\n'
+            '\n'
+            'payload\n'
+            '--B--\n'
+            'epilogue\n')
+        self.assertEqual(self._payloads(reader), ['payload'])
+
+    def test_only_one_line_break_before_a_delimiter_is_dropped(self):
+        """Verify that only the line break before delimiters is dropped."""
+
+        reader = self._reader(
+            'Content-Type: multipart/mixed; boundary=B\r\n'
+            '\r\n'
+            '--B\r\n'
+            '\r\n'
+            'line 1\r\n'
+            'line 2\r\n'
+            '\r\n'
+            '--B\r\n'
+            '\r\n'
+            '--B-- \r\n')
+        self.assertEqual(self._payloads(reader), ['line 1\r\nline 2\r\n', ''])
+
+    def test_delimiters_are_only_recognised_at_the_start_of_lines(self):
+        """Verify that delimiters are only recognised at line starts."""
+
+        reader = self._reader(
+            'Content-Type: multipart/mixed; boundary=B\n'
+            '\n'
+            '--B\n'
+            '\n'
+            'x--B\n'
+            '--Bx\n'
+            '--B--\n')
+        self.assertEqual(self._payloads(reader), ['x--B\n--Bx'])
+
+    def test_long_lines_are_read_in_chunks(self):
+        """Verify that lines longer than the chunk size are read correctly."""
+
+        data = ('0123456789' * 100 + '\r\n') * 3
+        reader = self._reader(
+            'Content-Type: multipart/mixed; boundary=B\n'
+            '\n'
+            '--B\n'
+            '\n' +
+            data +
+            '--B--\n', chunk_size=7)
+        self.assertEqual(self._payloads(reader), [data[:-2]])
+
+    def test_large_payloads_are_spooled_to_disk(self):
+        """Verify that payloads larger than the spool size go to disk."""
+
+        reader = self._reader(
+            'Content-Type: multipart/mixed; boundary=B\n'
+            '\n'
+            '--B\n'
+            '\n'
+            'small\n'
+            '--B\n'
+            '\n' +
+            'x' * 1000 + '\n'
+            '--B--\n', spool_size=100)
+
+        small = reader.next_part()
+        large = reader.next_part()
+        self.assertFalse(small.payload._rolled)
+        self.assertTrue(large.payload._rolled)
+        self.assertEqual(large.get_payload_file().read(), 'x' * 1000)
+
+    def test_peeking_at_parts_does_not_consume_them(self):
+        """Verify that peeking at upcoming parts does not consume them."""
+
+        reader = self._reader(
+            'Content-Type: multipart/mixed; boundary=B\n'
+            '\n'
+            '--B\n'
+            '\n'
+            'one\n'
+            '--B\n'
+            '\n'
+            'two\n'
+            '--B--\n')
+        self.assertEqual(reader.peek_part(1).get_payload(), 'two')
+        self.assertEqual(reader.peek_part(2), None)
+        self.assertEqual(reader.peek_part().get_payload(), 'one')
+        self.assertEqual(self._payloads(reader), ['one', 'two'])
+
+    def test_messages_without_a_closing_delimiter_end_with_the_input(self):
+        """Verify that the last part ends with the input if not closed."""
+
+        reader = self._reader(
+            'Content-Type: multipart/mixed; boundary=B\n'
+            '\n'
+            '--B\n'
+            '\n'
+            'one\n'
+            '--B\n'
+            '\n'
+            'two')
+        self.assertEqual(self._payloads(reader), ['one', 'two'])
@@ -0,0 +1,143 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Helper utilities to find out where slow calls spend their time."""
+
+
+import collections
+import os
+import sys
+import thread
+import threading
+import time
+
+
+def frame_stack(frame):
+    """Return the functions on the stack of a frame, outermost first.
+
+    Functions are described as "name (file:line)", with the line the
+    function starts at, so that samples taken at different lines of a
+    function are counted together.
+
+    """
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (
+            code.co_name, os.path.basename(code.co_filename),
+            code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+def sample_stacks(ignore=()):
+    """Return the stacks of all threads but the ignored ones.
+
+    The stacks are returned in the folded format used by flame graph
+    tools: the name of the thread followed by the functions on its
+    stack, outermost first, separated by semicolons.
+
+    """
+
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    stacks = []
+    for ident, frame in sys._current_frames().iteritems():
+        if ident in ignore:
+            continue
+        name = names.get(ident, 'thread-%d' % ident)
+        stacks.append(';'.join([name] + frame_stack(frame)))
+    return stacks
+
+
+def write_folded(filename, samples):
+    """Write stack samples to a file in the folded flame graph format.
+
+    The samples are a dictionary mapping folded stacks to the number
+    of times they were seen. The file can be turned into a flame graph
+    with e.g. flamegraph.pl.
+
+    """
+
+    with open(filename, 'w') as f:
+        for stack, count in sorted(samples.iteritems()):
+            f.write('%s %d\n' % (stack.replace(' ', '_'), count))
+
+
+class StackSampler(object):
+
+    """Samples the stacks of all threads while watched calls are slow.
+
+    Calls are watched from when they start until they finish. While at
+    least one of them has been running for longer than the threshold,
+    the stacks of all threads are sampled every interval seconds and
+    added to the samples of every slow call. A single daemon thread
+    does the sampling. As long as no call is slow, it only wakes up to
+    check the start times of the watched calls, so watching calls costs
+    next to nothing. The thread exits when no calls are watched.
+
+    """
+
+    def __init__(self, threshold, interval=0.01):
+        self.threshold = threshold
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.watched = {}
+        self.thread = None
+
+    def watch(self, token):
+        """Start watching a call identified by a token."""
+
+        with self.lock:
+            self.watched[token] = (time.time(), collections.Counter())
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='consonant-stack-sampler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unwatch(self, token):
+        """Stop watching a call and return the stacks sampled for it.
+
+        Returns a dictionary mapping folded stacks to the number of
+        times they were sampled, which is empty unless the call was
+        slow.
+
+        """
+
+        with self.lock:
+            started, samples = self.watched.pop(
+                token, (None, collections.Counter()))
+        return samples
+
+    def _run(self):
+        ignore = set([thread.get_ident()])
+        while True:
+            time.sleep(self.interval)
+            deadline = time.time() - self.threshold
+            with self.lock:
+                if not self.watched:
+                    self.thread = None
+                    return
+                slow = [samples for started, samples
+                        in self.watched.itervalues() if started <= deadline]
+            if slow:
+                stacks = sample_stacks(ignore)
+                with self.lock:
+                    for samples in slow:
+                        samples.update(stacks)
@@ -0,0 +1,95 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for helper utilities to find out where time is spent."""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import thread
+import threading
+import time
+import unittest
+
+from consonant.util import profiling
+
+
+class StackTests(unittest.TestCase):
+
+    """Unit tests for sampling stacks and writing them to files."""
+
+    def test_stacks_list_the_outermost_function_first(self):
+        """Verify that frame stacks end with the current function."""
+
+        stack = profiling.frame_stack(sys._getframe())
+        self.assertTrue(stack[-1].startswith(
+            'test_stacks_list_the_outermost_function_first '
+            '(profiling_tests.py:'))
+        self.assertTrue(len(stack) > 1)
+
+    def test_ignored_threads_are_not_sampled(self):
+        """Verify that the stacks of ignored threads are left out."""
+
+        name = threading.current_thread().name
+        stacks = profiling.sample_stacks()
+        self.assertTrue(any(s.startswith(name + ';') for s in stacks))
+        stacks = profiling.sample_stacks([thread.get_ident()])
+        self.assertFalse(any(s.startswith(name + ';') for s in stacks))
+
+    def test_samples_are_written_in_the_folded_format(self):
+        """Verify that samples are written as stacks followed by counts."""
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'samples.folded')
+        profiling.write_folded(filename, {
+            'main;f (a.py:1);g (a.py:5)': 3,
+            'main;f (a.py:1)': 1,
+            })
+        with open(filename) as f:
+            self.assertEqual(f.read(),
+                             'main;f_(a.py:1) 1\n'
+                             'main;f_(a.py:1);g_(a.py:5) 3\n')
+
+
+class StackSamplerTests(unittest.TestCase):
+
+    """Unit tests for the StackSampler class."""
+
+    def test_only_slow_calls_are_sampled(self):
+        """Verify that stacks are only sampled for calls over the threshold."""
+
+        sampler = profiling.StackSampler(0.02, 0.005)
+        sampler.watch('fast')
+        sampler.watch('slow')
+        self.assertEqual(sampler.unwatch('fast'), {})
+        time.sleep(0.1)
+        sampling_thread = sampler.thread
+        samples = sampler.unwatch('slow')
+        sampling_thread.join()
+        self.assertEqual(sampler.thread, None)
+        self.assertTrue(sum(samples.itervalues()) > 0)
+        self.assertTrue(any('test_only_slow_calls_are_sampled' in stack
+                            for stack in samples))
+
+    def test_unwatching_unknown_calls_returns_no_samples(self):
+        """Verify that unwatching a call that was not watched works."""
+
+        sampler = profiling.StackSampler(0.02)
+        self.assertEqual(sampler.unwatch('unknown'), {})
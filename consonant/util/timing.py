@@ -0,0 +1,205 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Helper utilities to record where the time handling a request goes."""
+
+
+import collections
+import threading
+import time
+
+
+_local = threading.local()
+
+
+class Timing(object):
+
+    """The time spent in, the number of and bytes read by similar steps."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.count = 0
+        self.size = None
+
+
+class Timer(object):
+
+    """Records the time spent in the named steps of handling a request.
+
+    Steps with the same name, e.g. all YAML parsing, are added up.
+    Steps may be nested, so the times of different steps overlap.
+    Annotations, e.g. the commit a request was resolved to, can be
+    recorded along with the timings.
+
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.timings = collections.OrderedDict()
+        self.annotations = {}
+
+    def add(self, name, seconds, size=None):
+        """Add the time spent in a step and the bytes it read, if any."""
+
+        timing = self.timings.get(name, None)
+        if timing is None:
+            timing = self.timings[name] = Timing()
+        timing.seconds += seconds
+        timing.count += 1
+        if size is not None:
+            timing.size = (timing.size or 0) + size
+
+    def measure(self, name):
+        """Return a context manager that records the time of a step."""
+
+        return Measurement(self, name)
+
+    def merge(self, other):
+        """Add the timings recorded by another timer to this one."""
+
+        for name, other_timing in other.timings.iteritems():
+            timing = self.timings.get(name, None)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.seconds += other_timing.seconds
+            timing.count += other_timing.count
+            if other_timing.size is not None:
+                timing.size = (timing.size or 0) + other_timing.size
+
+    def elapsed(self):
+        """Return the number of seconds since the timer was created."""
+
+        return time.time() - self.started
+
+    def server_timing(self):
+        """Return the timings in the format of a Server-Timing header."""
+
+        metrics = []
+        for name, timing in self.timings.iteritems():
+            if timing.size is not None:
+                desc = '%d reads, %d bytes' % (timing.count, timing.size)
+            else:
+                desc = '%d calls' % timing.count
+            metrics.append('%s;dur=%.2f;desc="%s"' % (
+                name, 1000.0 * timing.seconds, desc))
+        metrics.append('total;dur=%.2f' % (1000.0 * self.elapsed()))
+        return ', '.join(metrics)
+
+    def to_dict(self):
+        """Return the timings as a dictionary, with durations in ms."""
+
+        result = {}
+        for name, timing in self.timings.iteritems():
+            result[name] = {'ms': round(1000.0 * timing.seconds, 3),
+                            'count': timing.count}
+            if timing.size is not None:
+                result[name]['bytes'] = timing.size
+        return result
+
+
+class Measurement(object):
+
+    """Context manager that adds the time spent in it to a timer."""
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.size = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.add(self.name, time.time() - self.start, self.size)
+
+
+class NullMeasurement(object):
+
+    """Context manager used instead of a Measurement if timing is off."""
+
+    size = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+null_measurement = NullMeasurement()
+
+
+def current():
+    """Return the timer active in the current thread or None."""
+
+    return getattr(_local, 'timer', None)
+
+
+def activate(timer):
+    """Make a timer or None the active timer of the current thread.
+
+    Returns the previously active timer, so that it can be restored.
+
+    """
+
+    previous = getattr(_local, 'timer', None)
+    _local.timer = timer
+    return previous
+
+
+def measure(name):
+    """Return a context manager that records the time of a step.
+
+    If no timer is active in the current thread, a context manager
+    that does nothing is returned, so that measuring steps costs next
+    to nothing while timing is off. The size attribute of the context
+    manager can be set to the number of bytes read by the step.
+
+    """
+
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return null_measurement
+    return Measurement(timer, name)
+
+
+def annotate(name, value):
+    """Record an annotation with the timer active in the current thread.
+
+    Nothing is recorded if no timer is active.
+
+    """
+
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.annotations[name] = value
+
+
+def call_timed(func, *args):
+    """Call func(*args) with a new timer active.
+
+    Returns a tuple of the result and the timer.
+
+    """
+
+    timer = Timer()
+    previous = activate(timer)
+    try:
+        return func(*args), timer
+    finally:
+        activate(previous)
@@ -0,0 +1,138 @@
+# Copyright (C) 2014 Codethink Limited.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+"""Unit tests for helper utilities to record request timings."""
+
+
+import threading
+import unittest
+
+from consonant.util import timing
+
+
+class TimerTests(unittest.TestCase):
+
+    """Unit tests for the Timer class."""
+
+    def test_steps_with_the_same_name_are_added_up(self):
+        """Verify that the times and sizes of similar steps are added up."""
+
+        timer = timing.Timer()
+        timer.add('yaml', 0.25)
+        timer.add('odb', 0.5, 100)
+        timer.add('yaml', 0.5)
+        timer.add('odb', 0.25, 20)
+        self.assertEqual(timer.to_dict(), {
+            'yaml': {'ms': 750.0, 'count': 2},
+            'odb': {'ms': 750.0, 'count': 2, 'bytes': 120},
+            })
+
+    def test_timers_can_be_merged(self):
+        """Verify that merging a timer adds its timings to another one."""
+
+        timer = timing.Timer()
+        timer.add('odb', 0.5, 100)
+        other = timing.Timer()
+        other.add('odb', 0.25, 20)
+        other.add('cache', 0.125)
+        timer.merge(other)
+        self.assertEqual(timer.to_dict(), {
+            'odb': {'ms': 750.0, 'count': 2, 'bytes': 120},
+            'cache': {'ms': 125.0, 'count': 1},
+            })
+
+    def test_server_timing_lists_steps_in_the_order_they_were_seen(self):
+        """Verify that the Server-Timing header lists all steps in order."""
+
+        timer = timing.Timer()
+        timer.add('ref', 0.001)
+        timer.add('odb', 0.002, 2048)
+        header = timer.server_timing()
+        self.assertTrue(header.startswith(
+            'ref;dur=1.00;desc="1 calls", '
+            'odb;dur=2.00;desc="1 reads, 2048 bytes", total;dur='))
+
+
+class MeasureTests(unittest.TestCase):
+
+    """Unit tests for the measure() and call_timed() functions."""
+
+    def test_measuring_does_nothing_without_an_active_timer(self):
+        """Verify that steps are not recorded if no timer is active."""
+
+        self.assertEqual(timing.current(), None)
+        with timing.measure('odb') as measurement:
+            measurement.size = 10
+        self.assertTrue(timing.measure('odb') is timing.null_measurement)
+
+    def test_steps_are_recorded_by_the_active_timer(self):
+        """Verify that measured steps are recorded by the active timer."""
+
+        timer = timing.Timer()
+        previous = timing.activate(timer)
+        try:
+            with timing.measure('odb') as measurement:
+                measurement.size = 10
+            with timing.measure('yaml'):
+                pass
+        finally:
+            timing.activate(previous)
+        self.assertEqual(timer.timings['odb'].count, 1)
+        self.assertEqual(timer.timings['odb'].size, 10)
+        self.assertEqual(timer.timings['yaml'].size, None)
+        self.assertEqual(timing.current(), previous)
+
+    def test_timers_are_local_to_threads(self):
+        """Verify that a timer active in one thread is not used in others."""
+
+        timer = timing.Timer()
+        previous = timing.activate(timer)
+        try:
+            thread = threading.Thread(target=self._measure_step)
+            thread.start()
+            thread.join()
+        finally:
+            timing.activate(previous)
+        self.assertEqual(timer.timings, {})
+
+    def _measure_step(self):
+        with timing.measure('odb'):
+            pass
+
+    def test_annotations_are_recorded_by_the_active_timer(self):
+        """Verify that annotations are only recorded if a timer is active."""
+
+        timing.annotate('commit', 'abc')
+        timer = timing.Timer()
+        previous = timing.activate(timer)
+        try:
+            timing.annotate('commit', 'def')
+        finally:
+            timing.activate(previous)
+        self.assertEqual(timer.annotations, {'commit': 'def'})
+
+    def test_call_timed_returns_the_result_and_a_timer(self):
+        """Verify that call_timed() returns the result and its timings."""
+
+        result, timer = timing.call_timed(self._step, 42)
+        self.assertEqual(result, 42)
+        self.assertEqual(timer.timings['odb'].count, 1)
+        self.assertEqual(timing.current(), None)
+
+    def _step(self, value):
+        with timing.measure('odb'):
+            return value
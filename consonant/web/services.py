@@ -19,15 +19,107 @@
 
 
 import copy
+import cProfile
 import json
+import os
+import time
 import yaml
 
-from twisted.internet import reactor
-from twisted.web.server import Site
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import failure, log
+from twisted.web.server import NOT_DONE_YET, Request, Site
 from twisted.web.resource import Resource
 
 import consonant
 
+from consonant.util import profiling, timing
+
+
+class TimedRequest(Request):
+
+    """A request that records where the time handling it goes.
+
+    If the site has server_timing or timing_log set, a timer is made
+    active while the request is processed and stored in the timer
+    attribute, otherwise the timer is None. With server_timing, the
+    timings are returned in a Server-Timing header, with timing_log,
+    they are logged as a JSON line once the request is finished.
+
+    If the site has metrics, the request is counted as in flight until
+    it is finished or the connection is lost. Its latency is recorded
+    along with the page class that rendered it as the route.
+
+    If the site has a slow_request_threshold in seconds, requests
+    taking longer than that are logged along with their route, the
+    commit they were resolved to and their timings. Pages serving
+    long-lived requests, like event streams, are excluded by setting
+    their long_lived attribute. If the site has a profiler, it may
+    profile the request.
+
+    """
+
+    timer = None
+    route = None
+    profile = None
+    long_lived = False
+
+    def process(self):
+        """Process the request with a timer active if timing is on."""
+
+        site = self.channel.site
+        if getattr(site, 'server_timing', False) \
+                or getattr(site, 'timing_log', False) \
+                or getattr(site, 'slow_request_threshold', None):
+            self.timer = timing.Timer()
+        if getattr(site, 'metrics', None) is not None:
+            site.metrics.request_started(self)
+        if getattr(site, 'profiler', None) is not None:
+            site.profiler.request_started(self)
+        previous = timing.activate(self.timer)
+        if self.profile is not None:
+            self.profile.enable()
+        try:
+            Request.process(self)
+        finally:
+            if self.profile is not None:
+                self.profile.disable()
+            timing.activate(previous)
+
+    def render(self, resource):
+        """Render the request with the resource it was routed to."""
+
+        self.route = resource.__class__.__name__
+        self.long_lived = getattr(resource, 'long_lived', False)
+        if self.long_lived and getattr(self.site, 'profiler', None):
+            self.site.profiler.request_ignored(self)
+        Request.render(self, resource)
+
+    def finish(self):
+        """Finish the request and log its timings if requested."""
+
+        Request.finish(self)
+        if self.timer is None:
+            return
+
+        elapsed = self.timer.elapsed()
+        threshold = getattr(self.site, 'slow_request_threshold', None)
+        slow = threshold and elapsed >= threshold and not self.long_lived
+        if slow or getattr(self.site, 'timing_log', False):
+            entry = {
+                'method': self.method,
+                'path': self.uri,
+                'status': self.code,
+                'ms': round(1000.0 * elapsed, 3),
+                'timings': self.timer.to_dict(),
+                }
+            if slow:
+                entry.update({
+                    'slow': True,
+                    'route': self.route,
+                    'commit': self.timer.annotations.get('commit', None),
+                    })
+            log.msg(json.dumps(entry, sort_keys=True))
+
 
 class PageContext(object):
 
@@ -40,6 +132,10 @@ class PageContext(object):
         self.klass = None
         self.object = None
         self.property = None
+        self.transaction_queue = None
+        self.coalescer = None
+        self.metrics = None
+        self.profiler = None
 
     def extend(self, **kwargs):
         """Return a copy of the context, with additional members set."""
@@ -53,9 +149,12 @@ class PageContext(object):
         """Return the commit to use for accessing the store."""
 
         if self.commit:
-            return self.commit
+            commit = self.commit
         else:
-            return self.store.ref(self.ref).head
+            with timing.measure('ref'):
+                commit = self.store.ref(self.ref).head
+        timing.annotate('commit', commit.sha1)
+        return commit
 
 
 class Page(Resource):
@@ -74,6 +173,17 @@ class Page(Resource):
     def respond(self, request, data, content_type=None):
         """Convert data to return an appropriate response to a request."""
 
+        timer = getattr(request, 'timer', None)
+        if timer is None:
+            return self._respond(request, data, content_type)
+
+        with timer.measure('serialize'):
+            response = self._respond(request, data, content_type)
+        if getattr(request.site, 'server_timing', False):
+            request.setHeader('Server-Timing', timer.server_timing())
+        return response
+
+    def _respond(self, request, data, content_type):
         # allow cross-domain requests to this web service
         request.setHeader('Access-Control-Allow-Origin', '*')
 
@@ -109,6 +219,28 @@ class Page(Resource):
                 request.setResponseCode(406)
                 return ''
 
+    def expand_references(self, request, objects):
+        """Expand object references as requested via ?expand and ?depth.
+
+        ?expand takes a comma-separated list of property names or * to
+        expand all reference and reference list properties, ?depth the
+        number of levels to expand (1 by default). Returns a list of
+        object dictionaries or None if no expansion was requested.
+
+        Raises a ValueError if the depth is not a number.
+
+        """
+
+        names = request.args.get('expand', [None])[0]
+        if not names:
+            return None
+        names = None if names == '*' else set(names.split(','))
+        depth = int(request.args.get('depth', ['1'])[0])
+
+        expander = consonant.store.expanders.ReferenceExpander(
+            self.context.store, self.context.resolve_commit())
+        return expander.expand(objects, names, depth)
+
 
 class RefPage(Page):
 
@@ -133,6 +265,136 @@ class RefPage(Page):
         self.putChild('refs', RefsPage(self.context))
         self.putChild('commits', CommitsPage(self.context))
         self.putChild('transactions', TransactionsPage(self.context))
+        self.putChild('events', RefEventsPage(self.context))
+        self.putChild('batch', BatchPage(self.context))
+
+
+class RefEventsPage(Page):
+
+    """Renders /events and /refs/:ref/events.
+
+    Clients accepting text/event-stream receive a Server-Sent Events
+    stream with an event for the current head of the ref followed by
+    an event for every later change of the head. All other clients are
+    served through long-polling: if the head differs from the SHA1
+    passed in via ?since=SHA1, the current head is returned straight
+    away, otherwise the response is delayed until the head changes or
+    ?timeout=SECONDS have passed. The SHA1 may be abbreviated to no
+    less than min_since_length characters; shorter or empty values are
+    treated as if ?since was not passed at all.
+
+    With ?changes=1, events include the objects that were created,
+    updated or deleted by the change.
+
+    """
+
+    isLeaf = True
+    long_lived = True
+
+    keepalive_interval = 15
+    default_timeout = 30
+    max_timeout = 300
+    min_since_length = 7
+
+    def render_GET(self, request):
+        """Return a response for a /refs/:ref/events request."""
+
+        ref = self.context.store.ref(self.context.ref)
+        summary = request.args.get('changes', ['0'])[0] in ('1', 'true')
+
+        if 'text/event-stream' in (request.getHeader('Accept') or ''):
+            return self._render_stream(request, ref, summary)
+        else:
+            return self._render_poll(request, ref, summary)
+
+    def _render_stream(self, request, ref, summary):
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+
+        # unless the client is resuming from the current head, tell it
+        # where the ref is right now
+        if request.getHeader('Last-Event-ID') != ref.head.sha1:
+            request.write(self._format_event(
+                self._event(ref.name, None, ref.head.sha1)))
+
+        def listener(change):
+            if change.name == ref.name:
+                request.write(self._format_event(
+                    self._change_event(change, summary)))
+
+        keepalive = task.LoopingCall(request.write, ':\n\n')
+        keepalive.start(self.keepalive_interval, now=False)
+
+        def finished(_):
+            keepalive.stop()
+            self.context.store.watcher.remove_listener(listener)
+
+        self.context.store.watcher.add_listener(listener)
+        request.notifyFinish().addBoth(finished)
+        return NOT_DONE_YET
+
+    def _render_poll(self, request, ref, summary):
+        since = request.args.get('since', [''])[0].lower()
+        if len(since) < self.min_since_length or \
+                not ref.head.sha1.startswith(since):
+            return self.respond(
+                request, self._event(ref.name, None, ref.head.sha1))
+
+        try:
+            timeout = float(request.args.get(
+                'timeout', [self.default_timeout])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return ''
+        timeout = max(0, min(timeout, self.max_timeout))
+
+        state = {'done': False}
+
+        def reply(event):
+            if not state['done']:
+                state['done'] = True
+                self.context.store.watcher.remove_listener(listener)
+                if timer.active():
+                    timer.cancel()
+                request.write(self.respond(request, event))
+                request.finish()
+
+        def listener(change):
+            if change.name == ref.name:
+                reply(self._change_event(change, summary))
+
+        def expired():
+            reply(self._event(ref.name, ref.head.sha1, ref.head.sha1))
+
+        def finished(_):
+            state['done'] = True
+            self.context.store.watcher.remove_listener(listener)
+            if timer.active():
+                timer.cancel()
+
+        timer = reactor.callLater(timeout, expired)
+        self.context.store.watcher.add_listener(listener)
+        request.notifyFinish().addErrback(finished)
+        return NOT_DONE_YET
+
+    def _event(self, name, old_sha1, new_sha1, object_changes=None):
+        event = {'ref': name, 'previous': old_sha1, 'head': new_sha1}
+        if object_changes is not None:
+            event['changes'] = object_changes
+        return event
+
+    def _change_event(self, change, summary):
+        object_changes = None
+        if summary and change.old_sha1 and change.new_sha1:
+            object_changes = change.object_changes()
+        return self._event(
+            change.name, change.old_sha1, change.new_sha1, object_changes)
+
+    def _format_event(self, event):
+        data = json.dumps(
+            event, cls=consonant.util.converters.JSONObjectEncoder)
+        return 'id: %s\nevent: ref\ndata: %s\n\n' % (event['head'], data)
 
 
 class NamePage(Page):
@@ -211,10 +473,63 @@ class ObjectsPage(Page):
     """Renders /objects, /classes/:class/objects, /ref/:ref/objects etc."""
 
     def render_GET(self, request):
-        """Return a response for an /objects request."""
+        """Return a response for an /objects request.
+
+        If the context has a request coalescer, the objects are loaded
+        in a thread, shared with identical requests arriving meanwhile.
+        The time spent loading them is recorded in the thread and added
+        to the timer of every request sharing the result.
+
+        """
 
         commit = self.context.resolve_commit()
-        objects = self.context.store.objects(commit, self.context.klass)
+        klass = self.context.klass
+
+        # profiled requests load the objects in the reactor thread,
+        # where the profiler is enabled while processing them
+        if self.context.coalescer is None \
+                or getattr(request, 'profile', None) is not None:
+            objects = self.context.store.objects(commit, klass)
+            return self._objects_response(request, objects)
+
+        def loaded(result):
+            objects, load_timer = result
+            if request.timer is not None:
+                request.timer.merge(load_timer)
+            request.write(self._objects_response(request, objects))
+            request.finish()
+
+        key = ('objects', commit.sha1, klass.name if klass else None)
+        deferred = self.context.coalescer.call(
+            key, timing.call_timed, self.context.store.objects, commit, klass)
+        deferred.addCallbacks(loaded, request.processingFailed)
+        return NOT_DONE_YET
+
+    def _objects_response(self, request, objects):
+        # expand references in all objects together so that objects
+        # referenced from several places are only looked up once
+        if isinstance(objects, dict):
+            names = sorted(objects.iterkeys())
+            flat = [obj for name in names for obj in objects[name]]
+        else:
+            flat = objects
+        try:
+            expanded = self.expand_references(request, flat)
+        except ValueError:
+            request.setResponseCode(400)
+            return ''
+
+        if expanded is not None:
+            if isinstance(objects, dict):
+                result, index = {}, 0
+                for name in names:
+                    count = len(objects[name])
+                    result[name] = expanded[index:index + count]
+                    index += count
+                objects = result
+            else:
+                objects = expanded
+
         return self.respond(request, objects)
 
     def getChild(self, name, request):
@@ -232,7 +547,16 @@ class ObjectPage(Page):
     def render_GET(self, request):
         """Return a response for an /object/:uuid request."""
 
-        return self.respond(request, self.context.object)
+        try:
+            expanded = self.expand_references(request, [self.context.object])
+        except ValueError:
+            request.setResponseCode(400)
+            return ''
+
+        if expanded is not None:
+            return self.respond(request, expanded[0])
+        else:
+            return self.respond(request, self.context.object)
 
     def put_children(self):
         """Define subpages for /objects/:uuid."""
@@ -337,11 +661,180 @@ class CommitPage(Page):
         self.putChild('objects', ObjectsPage(self.context))
         self.putChild('refs', RefsPage(self.context.extend(commit=None)))
         self.putChild('commits', CommitsPage(self.context.extend(commit=None)))
+        self.putChild('batch', BatchPage(self.context))
+
+
+class BatchPage(Page):
+
+    """Renders /batch, /refs/:ref/batch and /commits/:sha1/batch.
+
+    Accepts a JSON or YAML document with a list of read operations,
+    runs all of them against a single commit and returns their results
+    in one response. The document looks like this:
+
+        commit: <sha1>          # optional, defaults to the URL's commit
+        operations:
+          - {op: object, uuid: <uuid>}
+          - {op: properties, uuid: <uuid>}
+          - {op: class, name: <class>}
+          - {op: classes}
+          - {op: name}
+          - {op: schema}
+          - {op: services}
+
+    Instead of a commit, a ref can be specified with "ref: <ref>".
+    Unknown commits and refs are answered with 404 Not Found.
+
+    """
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        """Run a batch of read operations and return their results."""
+
+        content_type = request.getHeader('Content-Type')
+        if content_type not in ('application/json', 'application/x-yaml'):
+            request.setResponseCode(406)
+            return ''
+
+        try:
+            body = request.content.read()
+            if content_type == 'application/json':
+                data = json.loads(body)
+            else:
+                data = yaml.safe_load(body)
+        except (ValueError, yaml.YAMLError):
+            request.setResponseCode(400)
+            return ''
+
+        if not isinstance(data, dict) or \
+                not isinstance(data.get('operations', None), list):
+            request.setResponseCode(400)
+            return ''
+
+        commit_sha1 = data.get('commit', None)
+        ref_name = data.get('ref', None)
+        if not isinstance(commit_sha1, (basestring, type(None))) or \
+                not isinstance(ref_name, (basestring, type(None))):
+            request.setResponseCode(400)
+            return ''
+
+        try:
+            if commit_sha1:
+                commit = self.context.store.commit(
+                    commit_sha1.encode('utf-8'))
+            elif ref_name:
+                commit = self.context.store.ref(ref_name.encode('utf-8')).head
+            else:
+                commit = self.context.resolve_commit()
+        except (consonant.service.services.CommitNotFoundError,
+                consonant.service.services.RefNotFoundError):
+            request.setResponseCode(404)
+            return ''
+
+        batch = BatchRequest(self.context.store, commit)
+        results = batch.run(data['operations'])
+        return self.respond(
+            request, {'commit': commit.sha1, 'results': results})
+
+
+class BatchRequest(object):
+
+    """Runs the read operations of a /batch request against one commit.
+
+    All objects referred to by the operations are looked up together
+    before any operation is run, and the results of other lookups are
+    shared between operations, so that every piece of information is
+    only loaded once per batch.
+
+    """
+
+    def __init__(self, store, commit):
+        self.store = store
+        self.commit = commit
+        self.objects = {}
+        self.lookups = {}
+
+    def run(self, operations):
+        """Run a list of operations and return a list of their results."""
+
+        uuids = set(op['uuid'] for op in operations
+                    if isinstance(op, dict) and
+                    isinstance(op.get('uuid', None), basestring))
+        if uuids:
+            self.objects = self.store.objects_by_uuid(self.commit, uuids)
+        return [self.run_operation(op) for op in operations]
+
+    def run_operation(self, op):
+        """Run a single operation and return its result."""
+
+        if not isinstance(op, dict) or 'op' not in op:
+            return self._error(400, 'Operation is not a dict with an "op"')
+
+        func = getattr(self, '_op_%s' % str(op['op']), None)
+        if func is None:
+            return self._error(400, 'Unsupported operation: %s' % op['op'])
+
+        try:
+            return {'status': 200, 'body': func(op)}
+        except KeyError, e:
+            return self._error(400, 'Operation lacks a parameter: %s' % e)
+        except (consonant.service.services.ClassNotFoundError,
+                consonant.service.services.ObjectNotFoundError), e:
+            return self._error(404, str(e))
+
+    def _error(self, status, message):
+        return {'status': status, 'error': message}
+
+    def _lookup(self, key, func, *args):
+        if key not in self.lookups:
+            self.lookups[key] = func(self.commit, *args)
+        return self.lookups[key]
+
+    def _object(self, uuid):
+        if uuid not in self.objects:
+            raise consonant.service.services.ObjectNotFoundError(
+                self.commit, uuid)
+        return self.objects[uuid]
+
+    def _op_object(self, op):
+        return self._object(op['uuid'])
+
+    def _op_properties(self, op):
+        return dict((n, p.value) for n, p in self._object(op['uuid']))
+
+    def _op_classes(self, op):
+        return self._lookup('classes', self.store.classes)
+
+    def _op_class(self, op):
+        classes = self._lookup('classes', self.store.classes)
+        if op['name'] not in classes:
+            raise consonant.service.services.ClassNotFoundError(
+                self.commit, op['name'])
+        return classes[op['name']]
+
+    def _op_name(self, op):
+        return self._lookup('name', self.store.name)
+
+    def _op_schema(self, op):
+        return self._lookup('schema', self.store.schema)
+
+    def _op_services(self, op):
+        return self._lookup('services', self.store.services)
 
 
 class TransactionsPage(Page):
 
-    """Renders /transactions."""
+    """Renders /transactions.
+
+    If the context has a transaction queue, submitted transactions are
+    queued and written in batches. Otherwise they are applied straight
+    away. Either way, the response contains the SHA1 of the commit the
+    transaction resulted in. Transactions conflicting with changes made
+    to the target ref since their source commit are answered with 409
+    Conflict, other errors with 500 Internal Server Error.
+
+    """
 
     def render_POST(self, request):
         """Try to apply a submitted transaction and return a response."""
@@ -350,11 +843,393 @@ class TransactionsPage(Page):
             request.setResponseCode(406)
             return ''
         else:
-            body = request.content.read()
+            # parse the transaction straight from the request content,
+            # which Twisted spools to a temporary file for large bodies
+            request.content.seek(0)
             parser = consonant.transaction.parser.TransactionParser()
-            transaction = parser.parse(body)
-            self.context.store.apply_transaction(transaction)
+            transaction = parser.parse(request.content)
+
+            started = time.time()
+            metrics = self.context.metrics
+
+            queue = self.context.transaction_queue
+            if queue is None:
+                try:
+                    commit = self.context.store.apply_transaction(transaction)
+                except Exception, e:
+                    if metrics:
+                        metrics.transaction_finished(started, error=e)
+                    return self._error_response(request, e)
+                if metrics:
+                    metrics.transaction_finished(started, commit)
+                return self._commit_response(request, commit)
+
+            def written(commit):
+                if metrics:
+                    metrics.transaction_finished(started, commit)
+                request.write(self._commit_response(request, commit))
+                request.finish()
+
+            def failed(failure):
+                error = failure.value
+                if metrics:
+                    metrics.transaction_finished(started, error=error)
+                request.write(self._error_response(request, error))
+                request.finish()
+
+            queue.queue_transaction(transaction).addCallbacks(written, failed)
+            return NOT_DONE_YET
+
+    def _commit_response(self, request, commit):
+        request.setHeader('Content-Type', 'text/plain')
+        return '%s\n' % commit.sha1 if commit else ''
+
+    def _error_response(self, request, error):
+        validation = consonant.transaction.validation
+        if isinstance(error, validation.TransactionConflictError):
+            request.setResponseCode(409)
+        else:
+            request.setResponseCode(500)
+        request.setHeader('Content-Type', 'text/plain')
+        return '%s: %s\n' % (error.__class__.__name__, error)
+
+
+class TransactionQueue(object):
+
+    """Queues submitted transactions and writes them in batches.
+
+    The first transaction queued after a flush schedules the next flush
+    flush_interval seconds later. All transactions queued until then
+    are written together, with every target ref updated only once.
+    The transactions are written in the order they were submitted.
+
+    """
+
+    def __init__(self, store, flush_interval):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.timer = None
+
+    def queue_transaction(self, transaction):
+        """Queue a transaction and return a Deferred for the commit.
+
+        The Deferred fires with the resulting commit or None if the
+        transaction was rejected by a validation hook, or fails with
+        the error the transaction caused.
+
+        """
+
+        deferred = defer.Deferred()
+        self.pending.append((transaction, deferred))
+        if self.timer is None:
+            self.timer = reactor.callLater(self.flush_interval, self.flush)
+        return deferred
+
+    def flush(self):
+        """Write all queued transactions and fire their Deferreds."""
+
+        self.timer = None
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        try:
+            results = self.store.apply_transactions(
+                [transaction for transaction, _ in pending])
+        except Exception, e:
+            for _, deferred in pending:
+                deferred.errback(e)
+            return
+
+        for result, (_, deferred) in zip(results, pending):
+            if result.error is not None:
+                deferred.errback(result.error)
+            else:
+                deferred.callback(result.commit)
+
+
+class RequestCoalescer(object):
+
+    """Runs identical concurrent page loads in a thread only once.
+
+    Loads are identified by a key, e.g. the resolved commit, the
+    operation and its arguments. A load is run in the reactor's thread
+    pool. Identical loads requested before it finishes share its
+    result (or failure) instead of running again. The number of loads
+    run is counted in executions, the number of requests that waited
+    for a load started by another request in waiters and the largest
+    number of requests waiting for a single load in max_waiters.
+
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.executions = 0
+        self.waiters = 0
+        self.max_waiters = 0
+
+    def call(self, key, func, *args):
+        """Return a Deferred for the result of func(*args)."""
+
+        deferred = defer.Deferred()
+        if key in self.pending:
+            self.pending[key].append(deferred)
+            self.waiters += 1
+            self.max_waiters = max(
+                self.max_waiters, len(self.pending[key]) - 1)
+            return deferred
+
+        self.pending[key] = [deferred]
+        self.executions += 1
+
+        def finished(result):
+            for waiting in self.pending.pop(key):
+                if isinstance(result, failure.Failure):
+                    waiting.errback(result)
+                else:
+                    waiting.callback(result)
+
+        threads.deferToThread(func, *args).addBoth(finished)
+        return deferred
+
+
+class MetricsPage(Page):
+
+    """Renders /_metrics in the Prometheus text format."""
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        """Return a response for a /_metrics request."""
+
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.context.metrics.registry.render()
+
+
+class ProfilePage(Page):
+
+    """Renders /_profile to profile requests on demand.
+
+    POST /_profile?requests=N makes the profiler of the context profile
+    the next N requests. GET /_profile returns the number of requests
+    that remain to be profiled and where the profiles are written.
+
+    """
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        """Return a response for a /_profile request."""
+
+        profiler = self.context.profiler
+        return self.respond(request, {
+            'pending': profiler.pending,
+            'directory': profiler.directory,
+            })
+
+    def render_POST(self, request):
+        """Request profiling the next N requests and return a response."""
+
+        try:
+            count = int(request.args.get('requests', ['1'])[0])
+        except ValueError:
+            request.setResponseCode(400)
             return ''
+        self.context.profiler.profile_requests(count)
+        return self.render_GET(request)
+
+
+class RequestProfiler(object):
+
+    """Profiles requests and writes the profiles to a directory.
+
+    Requests are profiled on demand: after profile_requests(N), the
+    next N requests are profiled with cProfile while they are processed
+    in the reactor thread. Their profiles are written to .pstats files,
+    which can be read with the pstats module or turned into call graphs
+    and flame graphs with tools like gprof2dot or flameprof.
+
+    If sample_threshold is set, the stacks of all threads are sampled
+    every sample_interval seconds while a request has been running for
+    longer than sample_threshold seconds. The samples are written to
+    .folded files, which flamegraph.pl turns into flame graphs.
+
+    Files are named after the time, a sequence number and the route of
+    the request.
+
+    """
+
+    def __init__(self, directory, sample_threshold=None,
+                 sample_interval=0.01):
+        self.directory = directory
+        self.pending = 0
+        self.written = 0
+        self.sampler = None
+        if sample_threshold:
+            self.sampler = profiling.StackSampler(
+                sample_threshold, sample_interval)
+
+    def profile_requests(self, count):
+        """Profile the next count requests."""
+
+        self.pending = max(0, count)
+
+    def request_started(self, request):
+        """Start profiling or watching a request if requested."""
+
+        if self.pending > 0:
+            self.pending -= 1
+            request.profile = cProfile.Profile()
+        if self.sampler is not None:
+            self.sampler.watch(request)
+        if request.profile is not None or self.sampler is not None:
+            request.notifyFinish().addBoth(self._request_finished, request)
+
+    def request_ignored(self, request):
+        """Stop watching a long-lived request."""
+
+        if self.sampler is not None:
+            self.sampler.unwatch(request)
+
+    def _request_finished(self, result, request):
+        samples = None
+        if self.sampler is not None:
+            samples = self.sampler.unwatch(request)
+        if not samples and request.profile is None:
+            return
+
+        self.written += 1
+        basename = os.path.join(self.directory, '%s-%d-%s' % (
+            time.strftime('%Y%m%d-%H%M%S'), self.written,
+            request.route or 'none'))
+        if samples:
+            profiling.write_folded(basename + '.folded', samples)
+        if request.profile is not None:
+            request.profile.dump_stats(basename + '.pstats')
+
+
+class WebServiceMetrics(object):
+
+    """Metrics about the health of a web service and its store.
+
+    Request latencies, requests in flight and transaction outcomes are
+    recorded by the web service. Everything else is collected from the
+    counts kept by the store, its object cache, the request coalescer
+    and the reactor's thread pool when the metrics are rendered, so
+    that keeping the metrics costs next to nothing.
+
+    """
+
+    def __init__(self, store, coalescer=None):
+        self.store = store
+        self.coalescer = coalescer
+
+        self.registry = consonant.util.metrics.Registry()
+        self.request_latency = self.registry.histogram(
+            'consonant_http_request_duration_seconds',
+            'Time spent handling HTTP requests.',
+            ('route', 'method', 'status'))
+        self.requests_in_flight = self.registry.gauge(
+            'consonant_http_requests_in_flight',
+            'Number of HTTP requests being handled.')
+        self.registry.callback(
+            'consonant_thread_pool_queue_depth',
+            'Number of loads waiting for a thread in the thread pool.',
+            (), self._thread_pool_queue_depth)
+        self.registry.callback(
+            'consonant_thread_pool_workers',
+            'Number of threads in the thread pool by state.',
+            ('state',), self._thread_pool_workers)
+        self.registry.callback(
+            'consonant_cache_hits_total',
+            'Number of object cache lookups answered by a cache tier.',
+            ('tier',), self._cache_statistics('hits'), 'counter')
+        self.registry.callback(
+            'consonant_cache_misses_total',
+            'Number of object cache lookups missed by a cache tier.',
+            ('tier',), self._cache_statistics('misses'), 'counter')
+        self.registry.callback(
+            'consonant_cache_evictions_total',
+            'Number of entries evicted from a cache tier.',
+            ('tier',), self._cache_statistics('evictions'), 'counter')
+        self.registry.callback(
+            'consonant_coalesced_loads_total',
+            'Number of loads run and of loads shared with identical ones.',
+            ('layer', 'result'), self._coalesced_loads, 'counter')
+        self.transaction_latency = self.registry.histogram(
+            'consonant_transaction_duration_seconds',
+            'Time spent applying submitted transactions by outcome.',
+            ('outcome',))
+        self.transactions = self.registry.counter(
+            'consonant_transactions_total',
+            'Number of submitted transactions by outcome.',
+            ('outcome',))
+        self.registry.callback(
+            'consonant_ref_update_conflicts_total',
+            'Number of ref updates that failed because the ref had moved '
+            'on or was locked.',
+            (), self._ref_update_conflicts, 'counter')
+
+    def request_started(self, request):
+        """Count a request as in flight until it is finished."""
+
+        started = time.time()
+        self.requests_in_flight.inc()
+
+        def finished(result):
+            self.requests_in_flight.dec()
+            self.request_latency.observe(
+                time.time() - started,
+                (request.route or 'none', request.method, str(request.code)))
+
+        request.notifyFinish().addBoth(finished)
+
+    def transaction_finished(self, started, commit=None, error=None):
+        """Record the outcome and latency of a submitted transaction."""
+
+        if error is not None:
+            validation = consonant.transaction.validation
+            if isinstance(error, validation.TransactionConflictError):
+                outcome = 'conflict'
+            else:
+                outcome = 'failed'
+        elif commit is not None:
+            outcome = 'committed'
+        else:
+            outcome = 'rejected'
+        self.transactions.inc((outcome,))
+        self.transaction_latency.observe(time.time() - started, (outcome,))
+
+    def _thread_pool_queue_depth(self):
+        pool = reactor.getThreadPool()
+        return [((), pool.q.qsize())]
+
+    def _thread_pool_workers(self):
+        pool = reactor.getThreadPool()
+        return [(('busy',), len(pool.working)),
+                (('idle',), len(pool.waiters))]
+
+    def _cache_statistics(self, name):
+        def collect():
+            cache = getattr(self.store, 'cache', None)
+            statistics = getattr(cache, 'statistics', [])
+            return [((entry.tier.__class__.__name__,), getattr(entry, name))
+                    for entry in statistics]
+        return collect
+
+    def _coalesced_loads(self):
+        samples = []
+        coalescers = [('request', self.coalescer),
+                      ('store', getattr(self.store, 'coalescer', None))]
+        for layer, coalescer in coalescers:
+            if coalescer is not None:
+                samples.append(((layer, 'executed'), coalescer.executions))
+                samples.append(((layer, 'shared'), coalescer.waiters))
+        return samples
+
+    def _ref_update_conflicts(self):
+        return [((), getattr(self.store, 'ref_update_conflicts', None))]
 
 
 class SimpleWebService(object):
@@ -366,14 +1241,120 @@ class SimpleWebService(object):
 
     """
 
-    def __init__(self, store):
+    def __init__(self, store, watch_interval=1.0, flush_interval=None,
+                 coalesce_requests=True, server_timing=False,
+                 timing_log=False, slow_request_threshold=None,
+                 profile_directory=None, sample_slow_requests=False,
+                 warm_new_heads=False):
         self.store = store
+        self.watch_interval = watch_interval
+        self.flush_interval = flush_interval
+        self.coalesce_requests = coalesce_requests
+        self.server_timing = server_timing
+        self.timing_log = timing_log
+        self.slow_request_threshold = slow_request_threshold
+        self.profile_directory = profile_directory
+        self.sample_slow_requests = sample_slow_requests
+        self.warm_new_heads = warm_new_heads
+
+    def site(self):
+        """Return a Twisted site serving the web service."""
+
+        context = PageContext().extend(store=self.store, ref='master')
+
+        # load objects in threads, sharing the results of identical
+        # requests arriving at the same time, if requested
+        if self.coalesce_requests:
+            context.coalescer = RequestCoalescer()
+
+        # keep metrics about the health of the service, exposed via
+        # /_metrics in the Prometheus text format
+        context.metrics = WebServiceMetrics(self.store, context.coalescer)
+
+        # write submitted transactions in batches if requested
+        if self.flush_interval:
+            context.transaction_queue = TransactionQueue(
+                self.store, self.flush_interval)
+
+        # profile requests on demand via /_profile and sample the
+        # stacks of slow requests if requested
+        if self.profile_directory:
+            sample_threshold = None
+            if self.sample_slow_requests:
+                sample_threshold = self.slow_request_threshold
+            context.profiler = RequestProfiler(
+                self.profile_directory, sample_threshold)
+
+        # many pages load objects in the reactor thread; never block it
+        # waiting for entries that another thread or process is loading
+        # into the cache
+        reactor.callWhenRunning(
+            consonant.store.local.loaders.set_lease_waiting, False)
+
+        resource = RefPage(context)
+        resource.putChild('_metrics', MetricsPage(context))
+        if context.profiler:
+            resource.putChild('_profile', ProfilePage(context))
+        factory = Site(resource, requestFactory=TimedRequest)
+        factory.metrics = context.metrics
+        factory.profiler = context.profiler
+
+        # record where the time handling requests goes if requested
+        factory.server_timing = self.server_timing
+        factory.timing_log = self.timing_log
+        factory.slow_request_threshold = self.slow_request_threshold
+
+        return factory
 
     def run(self, port):
         """Serve a Consonant web service over the given port."""
 
-        context = PageContext().extend(store=self.store, ref='master')
-        resource = RefPage(context)
-        factory = Site(resource)
-        reactor.listenTCP(port, factory)
+        reactor.listenTCP(port, self.site())
+
+        # check the store for ref changes made outside the web service,
+        # e.g. by pushing to the store repository, so that clients
+        # listening for ref events are notified about them
+        watcher = getattr(self.store, 'watcher', None)
+        if watcher and self.watch_interval:
+            if self.warm_new_heads and hasattr(self.store, 'warm_cache'):
+                check = self._warm_and_notify
+            else:
+                check = watcher.check
+            task.LoopingCall(check).start(self.watch_interval)
+
         reactor.run()
+
+    def _warm_and_notify(self):
+        """Fill the caches with new ref heads before notifying listeners.
+
+        The new heads are loaded in a thread. Listeners, and through
+        them the clients waiting for ref events, are only notified once
+        that is done, so the requests they make for the new heads do
+        not find the caches cold. Requests resolving the refs on their
+        own may still see the new heads before they are loaded. The
+        watcher is held in the meantime, so changes found by other
+        checks, e.g. after transactions, are queued behind the ones
+        being warmed up rather than overtaking them. The returned
+        deferred makes the looping call wait until then.
+
+        """
+
+        watcher = self.store.watcher
+        watcher.hold()
+        ref_changes = watcher.poll()
+        watcher.notify(ref_changes)
+        sha1s = set(change.new_sha1 for change in ref_changes
+                    if change.new_sha1)
+        if not sha1s:
+            watcher.release()
+            return None
+
+        try:
+            commits = [self.store.commit(sha1) for sha1 in sorted(sha1s)]
+        except Exception:
+            watcher.release()
+            raise
+        deferred = threads.deferToThread(self.store.warm_cache, commits)
+        deferred.addErrback(log.err, 'Failed to warm the caches')
+        deferred.addCallback(lambda _: watcher.release())
+        return deferred
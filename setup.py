@@ -180,7 +180,8 @@ setup(
     author='Codethink Limited',
     author_email='jannis.pohlmann@codethink.co.uk',
     url='http://github.com/CodethinkLabs/python-consonant',
-    scripts=['python-consonant-server'],
+    scripts=['consonant-export', 'consonant-import', 'consonant-warm',
+             'python-consonant-server'],
     packages=['consonant'],
     package_data={},
     data_files=[],
@@ -71,7 +71,9 @@ assert isinstance(store, consonant.store.local.store.LocalStore) \
     or isinstance(store, consonant.store.remote.RemoteStore)
 
 if os.path.exists('use-memcached'):
-    store.set_cache(consonant.store.caches.MemcachedObjectCache(['127.0.0.1']))
+    store.set_cache(consonant.store.caches.MemcachedObjectCache(
+        ['127.0.0.1'],
+        namespace=consonant.store.caches.default_namespace(store_location)))
 
 $CODE
 EOF
@@ -148,6 +150,20 @@ def http_post(path, content_type, data):
     handle = urllib2.urlopen(request)
     return handle.read()
 
+def http_post_json_or_yaml(path, data):
+    api = os.environ.get('API')
+    url = 'http://localhost:42000%s' % path
+    request = urllib2.Request(url, data=data)
+    request.add_header('Content-Type', 'application/json')
+    if api == 'consonant.web.service.json':
+      request.add_header('Accept', 'application/json')
+      return json.dumps(json.loads(urllib2.urlopen(request).read()), indent=2)
+    elif api == 'consonant.web.service.yaml':
+      request.add_header('Accept', 'application/x-yaml')
+      return urllib2.urlopen(request).read()
+    else:
+      raise Exception('API "%s" unsupported' % api)
+
 executable = os.path.join("$SRCDIR", "python-consonant-server")
 args = []
 if os.path.exists('use-memcached'):